@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import traceback
+import argparse
 import time
-import hid
 import json
 from pathlib import Path
 import os.path
-from PySide6.QtGui import QIcon, QAction, QGuiApplication
+from PySide6.QtGui import QAction, QCursor, QGuiApplication
 from PySide6.QtWidgets import QApplication, QSystemTrayIcon, QMenu
 from PySide6.QtCore import (
     Signal,
@@ -16,128 +15,38 @@ from PySide6.QtCore import (
     QObject,
     QStandardPaths,
     QSysInfo,
-    Qt,
     QTimer,
 )
 import logging
 
 import protocol
+import messages
+import session
+import hid_process
+import forward
+import bus
+import hooks
 import overlay
 import keycodes
-
-from pynput.keyboard import Key, Controller
-from pynput.mouse import Button, Controller as MouseController
+import settings
+import heatmap
+import tray_icons
+import output
+import motion
+import power
+import profiler
+
+from pynput.keyboard import Controller
+from pynput.mouse import Controller as MouseController
 import copykitten
 
 logging.basicConfig(encoding="utf-8", level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
-keyboard = Controller()
-mouse = MouseController()
-
-device = None
-stop = False
-
-
-def load_keymaps(device, capabilities, meta):
-    if meta is None and capabilities.get("vial") is not None:
-        meta = protocol.load_vial_meta(device)
-
-    layers_keymaps = None
-    if capabilities.get("via") is not None and meta is not None:
-        layout_options = protocol.load_layout_options(device, meta)
-        layers_count = protocol.load_layers_count(device)
-        layers_keymaps = protocol.load_layers_keymaps(
-            device,
-            layers_count,
-            meta["matrix"]["rows"],
-            meta["matrix"]["cols"],
-        )
-
-    return meta, layers_keymaps, layout_options
-
-
-def process_loop(
-    config_meta,
-    callback_state,
-    callback_wait,
-    callback_select_device,
-    callback_press,
-    callback_keymaps,
-):
-    global device
-    try:
-        while not stop:
-            callback_wait()
-            candidates = protocol.candidates()
-            if len(candidates) > 0:
-                active_device_index = callback_select_device(candidates)
-                device_info = candidates[active_device_index]
-                device = protocol.open(
-                    device_info["vendor_id"],
-                    device_info["product_id"],
-                    device_info["path"],
-                )
-                if device is not None:
-                    capabilities = protocol.discover_capabilities(device)
-                    log.info("device capabilities discovered %s", capabilities)
-                    state = None
-                    if capabilities.get("companion_hid") is not None:
-                        state = protocol.enable_reporting_and_get_state(device)
-
-                    if state is None:
-                        protocol.close(device)
-                    else:
-                        current_layer, caps_word = state
-                        if callback_keymaps is not None:
-                            vial_meta, layers, layout_options = load_keymaps(
-                                device, capabilities, config_meta
-                            )
-                            callback_keymaps(vial_meta, layers, layout_options)
-
-                        callback_state(current_layer, caps_word)
-
-                        while True:
-                            try:
-                                message = protocol.recv(device)
-                                if message is None:
-                                    protocol.close(device)
-                                    break
-                                if message[0] == protocol.HID_LAYERS_OUT_STATE:
-                                    current_layer, caps_word = message[1], message[2]
-                                    callback_state(current_layer, caps_word)
-                                elif message[0] == protocol.HID_LAYERS_OUT_PRESS:
-                                    symbol = message[1:5].decode("utf32")
-                                    row, col = message[5:7]
-                                    action = "release" if message[7] == 0 else "press"
-                                    callback_press(symbol, row, col, action)
-                                else:
-                                    print("unexpected hid message", message)
-
-                            except hid.HIDException as e:
-                                log.error(
-                                    "hid receive error %s, %s", device_info["path"], e
-                                )
-                                break
-            else:
-                log.error("No candidate devices found. I'll wait and try later.")
-
-            time.sleep(1)
-    except Exception:
-        traceback.print_exc()
-
-
 APPLICATION_NAME = "QmkLayoutWidget"
 CONFIG_FILE = "configuration.json"
 TOUCHBOARD_META_FILE = "touchboard-meta.json"
 
-DEFAULT_TOUCHBOARD_MOVE_KEYCODE = "0x7E00"
-
-DEFAULT_TOUCHBOARD_MOVE = "🐁"
-DEFAULT_TOUCHBOARD_LEFT = "←"
-DEFAULT_TOUCHBOARD_RIGHT = "→"
-DEFAULT_TOUCHBOARD_MULTICLICK_PERIOD = 250
-
 DEFAULT_CONFIG = {
     "mode": "dark" if QSysInfo.kernelType() == "darwin" else "light",
     "icons": {
@@ -216,54 +125,71 @@ def init_config():
 
 class Signals(QObject):
     devices_update = Signal(object)
-    state_update = Signal(object)
-    press_received = Signal(object)
+    events_received = Signal(object)
+    keymaps_loaded = Signal()
+
+
+# layer state is applied at most once per display frame, latest state wins
+FRAME_INTERVAL = 16
 
 
 def setup_application(config):
     wait_pos = 0
+    current_icon = None
+    pending_state = None
+    last_state_flush = 0.0
     touchboard_displayed = False
     multiclick_waiting = False
-    touchboard_layer = int(config.get("touchboard-layer", -1))
+    drag_locked = False
+    touchboard_layer = config.touchboard_layer
+    current_layer = 0
 
     def shutdown():
-        global stop
         log.info("shutting down app")
         app.quit()
-        log.info("shutting down device connection")
-        stop = True
-        protocol.disable_reporting(device)
-        protocol.close(device)
+        if session.heatmap is not None:
+            session.heatmap.stop()
+        output_backend.close()
+        if forwarder is not None:
+            forwarder.stop()
+        if event_bus is not None:
+            event_bus.stop()
+        if lock_monitor is not None:
+            lock_monitor.stop()
+        if config.forward_listen is None:
+            log.info("shutting down device connection")
+            if hid_child is not None:
+                hid_child.stop()
+            else:
+                session.stop = True
+                protocol.disable_reporting(session.device)
+                protocol.close(session.device)
         log.info("app should quit now")
 
     def select_device(candidates):
-        device_index = 0
-        if "product-id" in config:
-            for idx, candidate in enumerate(candidates):
-                if candidate["product_id"] == config["product-id"]:
-                    log.info(
-                        "found device matching config product_id %s in index %s",
-                        candidate,
-                        idx,
-                    )
-                    device_index = idx
-
+        device_index = session.select_candidate(candidates, config.product_id)
         signals.devices_update.emit((candidates, device_index))
+        if event_bus is not None:
+            event_bus.publish(bus.Devices(candidates, device_index))
 
         return device_index
 
+    def set_icon(name):
+        nonlocal current_icon
+        if name != current_icon:
+            tray.setIcon(icons.get(name))
+            current_icon = name
+
     def wait_for_device():
         nonlocal wait_pos
-        tray.setIcon(icons[wait_icon_names[wait_pos]])
+        set_icon(wait_icon_names[wait_pos])
         wait_pos = (wait_pos + 1) % len(wait_icon_names)
 
-    def update_state(layer, caps_word):
-        signals.state_update.emit(
-            (
-                layer,
-                caps_word,
-            )
-        )
+    def events_received(events):
+        # one queued call per batch of reports read from device
+        signals.events_received.emit(events)
+        if event_bus is not None:
+            event_bus.publish_all(events)
 
     def emulate_keypress(symbol):
         try:
@@ -275,10 +201,7 @@ def setup_application(config):
         copykitten.copy(symbol)
         # FIXME imperical value and potentially reduces typing speed
         time.sleep(0.02)
-        keyboard.press(Key.cmd_l)
-        keyboard.press("v")
-        keyboard.release("v")
-        keyboard.release(Key.cmd_l)
+        output_backend.paste()
         # FIXME imperical value and potentially reduces typing speed
         time.sleep(0.02)
         try:
@@ -286,63 +209,57 @@ def setup_application(config):
         except Exception as e:
             log.error("copykitten.copy %s", e)
 
-    def press_received(symbol, row, col, action):
-        signals.press_received.emit(
-            (
-                symbol,
-                row,
-                col,
-                action,
-            )
-        )
-
     wait_icon_names = list(
-        filter(lambda i: i.startswith("wait"), config["icons"].keys())
+        filter(lambda i: i.startswith("wait"), config.icons.keys())
     )
 
     signals = Signals()
 
     app = QApplication([])
     app.setQuitOnLastWindowClosed(False)
-    touchboard = overlay.Window(app)
-
-    icon_tail = "white"
-    if config.get("mode", "dark").lower() == "light":
-        icon_tail = "black"
-    elif config.get("mode", "dark").lower() == "auto":
-        os_color_scheme = QGuiApplication.styleHints().colorScheme()
-        log.info("os color scheme detected: %s", os_color_scheme)
-        if os_color_scheme == Qt.ColorScheme.Light:
-            icon_tail = "black"
-        elif os_color_scheme == Qt.ColorScheme.Dark:
-            icon_tail = "white"
-        else:
-            icon_tail = "white"
-
-    current_dir = Path(__file__).parent
-    icons = {}
-    for name, icon in config["icons"].items():
-        app_icon_path = os.path.join(current_dir, "icons", f"{icon}_{icon_tail}.png")
-        config_icon_path_tail = os.path.join(
-            config["config_directory"], f"{icon}_{icon_tail}.png"
-        )
-        config_icon_path = os.path.join(config["config_directory"], f"{icon}.png")
-        if os.path.isfile(app_icon_path):
-            icons[name] = QIcon(app_icon_path)
-            log.info("icon '%s' loaded from file '%s'", name, app_icon_path)
-        elif os.path.isfile(config_icon_path):
-            icons[name] = QIcon(config_icon_path)
-            log.info("icon '%s' loaded from file '%s'", name, config_icon_path)
-        elif os.path.isfile(config_icon_path_tail):
-            icons[name] = QIcon(config_icon_path_tail)
-            log.info("icon '%s' loaded from file '%s'", name, config_icon_path_tail)
-        else:
-            log.error(
-                "failed to load icon '%s' from paths %s",
-                name,
-                [app_icon_path, config_icon_path, config_icon_path_tail],
+    touchboard = overlay.Touchboard(app, hints=config.touchboard_mode == "hints")
+    if touchboard.frames is not None:
+        profiler.gauges["touchboard frame cache"] = lambda: touchboard.frames.size
+
+    output_geometry = app.primaryScreen().virtualGeometry().getRect()
+    output_backend = output.create_output(
+        config.output_backend, mouse, keyboard, output_geometry
+    )
+
+    def update_output_geometry(*args):
+        nonlocal output_backend, output_geometry
+        # absolute axes of uinput pointer cover the whole virtual desktop
+        geometry = app.primaryScreen().virtualGeometry().getRect()
+        if geometry != output_geometry and config.output_backend == "uinput":
+            output_geometry = geometry
+            output_backend.close()
+            output_backend = output.create_output(
+                config.output_backend, mouse, keyboard, geometry
             )
 
+    app.screenAdded.connect(update_output_geometry)
+    app.screenRemoved.connect(update_output_geometry)
+
+    heatmap_overlay = None
+    if config.heatmap and config.config_directory is not None:
+        session.heatmap = heatmap.Heatmap(
+            os.path.join(config.config_directory, heatmap.FILE_NAME)
+        )
+        session.heatmap.start()
+        heatmap_overlay = overlay.Touchboard(app, prerender=False)
+
+    icons = tray_icons.IconCache(app, config)
+
+    def refresh_icon():
+        # colour scheme or screen changed, cached icons are already rendered
+        icons.update_ratios()
+        if current_icon is not None:
+            tray.setIcon(icons.get(current_icon))
+
+    QGuiApplication.styleHints().colorSchemeChanged.connect(refresh_icon)
+    app.screenAdded.connect(refresh_icon)
+    app.screenRemoved.connect(refresh_icon)
+
     menu = QMenu()
 
     # I don't expect > 5 keyboards to be connected at once
@@ -351,43 +268,69 @@ def setup_application(config):
         a = QAction(str(da))
         device_actions.append(a)
 
+    def update_heatmap_overlay():
+        counts = session.heatmap.layer_counts(current_layer)
+        top = max(counts.values(), default=0)
+        heatmap_overlay.set_key_colors(
+            {pos: overlay.heat_color(count / top) for pos, count in counts.items()}
+        )
+        heatmap_overlay.set_keymap_labels(
+            {pos: str(count) for pos, count in counts.items()}
+        )
+        heatmap_overlay.draw_initial()
+
+    @Slot()
+    def show_heatmap(checked):
+        if checked:
+            update_heatmap_overlay()
+            heatmap_overlay.show()
+        else:
+            heatmap_overlay.hide()
+
+    heatmap_action = None
+    if heatmap_overlay is not None:
+        heatmap_action = QAction("Heatmap")
+        heatmap_action.setCheckable(True)
+        heatmap_action.toggled.connect(show_heatmap)
+        menu.addAction(heatmap_action)
+
     quit = QAction("Quit")
     quit.triggered.connect(shutdown)
     menu.addAction(quit)
 
     tray = QSystemTrayIcon()
-    tray.setIcon(icons["wait0"])
+    set_icon("wait0")
     tray.setContextMenu(menu)
     tray.setVisible(True)
 
     def keymaps_update(vial_meta, layers, layout_options):
         nonlocal touchboard_layer
-        touchboard_move_keycode = int(
-            config.get("touchboard-move-keycode", DEFAULT_TOUCHBOARD_MOVE_KEYCODE), 0
-        )
+        if event_bus is not None:
+            event_bus.publish(bus.Keymaps(vial_meta, layers, layout_options))
         move_buttons_positions = None
         if layers is not None:
             for layer, keys in enumerate(layers):
                 mmove = list(
                     map(
                         lambda i: i[0],
-                        filter(lambda i: i[1] == touchboard_move_keycode, keys.items()),
+                        filter(
+                            lambda i: i[1] == config.touchboard_move_keycode,
+                            keys.items(),
+                        ),
                     )
                 )
                 log.info("on layer %s TB_MOVE buttons count = %s", layer, len(mmove))
                 if len(mmove) > 0 and touchboard_layer == -1:
                     touchboard_layer = layer
                     log.info("detected touchboard-layer is %s", layer)
+                # keymaps come again after remap or reconnect, layer is known by then
+                if layer == touchboard_layer:
                     move_buttons_positions = mmove
 
-        if (
-            config.get("touchboard-meta") is not None
-            and config["touchboard-meta"].get("layouts") is not None
-            and config["touchboard-meta"]["layouts"].get("keymap") is not None
-        ):
+        if config.touchboard_keymap is not None:
             log.info("keymap loaded from config")
             touchboard.set_keymap(
-                config["touchboard-meta"]["layouts"]["keymap"],
+                config.touchboard_keymap,
                 move_buttons_positions,
                 layout_options,
             )
@@ -401,32 +344,107 @@ def setup_application(config):
                 "keyboard fw have no Vial support nor touchboard-meta.json found, touchboard will not work"
             )
 
-        if config.get("touchboard-keymap-labels") is not None:
+        if heatmap_overlay is not None:
+            keymap = config.touchboard_keymap
+            if keymap is None and vial_meta is not None:
+                keymap = vial_meta["layouts"]["keymap"]
+            if keymap is not None:
+                heatmap_overlay.set_keymap(
+                    keymap, overlay.keymap_positions(keymap), layout_options
+                )
+
+        if config.touchboard_keymap_labels is not None:
             log.info("keymap-labels loaded from config")
-            touchboard.set_keymap_labels(config["touchboard-keymap-labels"])
-        elif layers is not None:
-            keymap_labels = {}
-            for pos, code in layers[0].items():
-                keymap_labels[pos] = keycodes.label_by_qmk_id(code)
-
-            log.info("keymap-labels loaded from via")
-            touchboard.set_keymap_labels(keymap_labels)
+            touchboard.set_keymap_labels(config.touchboard_keymap_labels)
+        elif layers is not None and len(layers) > 0:
+            table = keycodes.layer_labels(layers)
+            # overlay is shown only on touchboard layer, scene is laid out once with its
+            # labels, keys which type nothing there (TB_MOVE, KC_NO, MO) are blank
+            layer = touchboard_layer if 0 <= touchboard_layer < len(table) else 0
+            log.info("keymap-labels of layer %s loaded from via", layer)
+            touchboard.set_keymap_labels(table[layer])
         else:
             log.error(
                 "keyboard fw have no Via support nor touchboard-keymap-labels found in config file, touchboard will not work"
             )
 
-    pool = QThreadPool()
-    pool.start(
-        lambda: process_loop(
-            config.get("touchboard-meta"),
-            update_state,
-            wait_for_device,
-            select_device,
-            press_received,
+        signals.keymaps_loaded.emit()
+
+    # hooks run user scripts, they get events through the bus and never the GUI thread
+    event_bus = None
+    if len(config.hooks) > 0:
+        event_bus = bus.Bus()
+        hooks.start_hooks(event_bus, config.hooks)
+
+    session_events = events_received
+    session_keymaps = keymaps_update
+    forwarder = None
+    if config.forward_listen is not None:
+        # peer instance, events come from host with keyboard instead of HID session
+        if session.heatmap is not None:
+            session_events = session.recording_events(events_received, session.heatmap)
+        forwarder = forward.Receiver(
+            forward.parse_address(config.forward_listen),
+            config.forward_transport,
+            config.forward_secret,
+            session_events,
             keymaps_update,
+            wait_for_device,
         )
-    )
+        forwarder.start()
+    elif config.forward_to is not None:
+        # presses are handled by peer, layer state is still shown in tray
+        def forward_events(events):
+            forwarder.events_received(events)
+            states = [e for e in events if type(e) is messages.LayerState]
+            if len(states) > 0:
+                events_received(states)
+
+        forwarder = forward.Sender(
+            forward.parse_address(config.forward_to),
+            config.forward_transport,
+            config.forward_secret,
+            lambda data: send_interactive(data),
+        )
+        forwarder.start()
+        session_events = forward_events
+        session_keymaps = forwarder.keymaps_update
+
+    hid_child = None
+    if config.forward_listen is not None:
+        send_interactive = forwarder.send_command
+    elif config.hid_process:
+        hid_child = hid_process.HidProcess(
+            config.touchboard_meta, config.product_id, config.heartbeat_idle
+        )
+        # presses are counted in GUI process, child only reads and decodes reports
+        if session.heatmap is not None:
+            session_events = session.recording_events(session_events, session.heatmap)
+        hid_child.start(session_events, wait_for_device, select_device, session_keymaps)
+        send_interactive = hid_child.send
+    else:
+        session.heartbeat_idle = config.heartbeat_idle
+        pool = QThreadPool()
+        pool.start(
+            lambda: session.process_loop(
+                config.touchboard_meta,
+                session_events,
+                wait_for_device,
+                select_device,
+                session_keymaps,
+            )
+        )
+        send_interactive = session.send_interactive
+
+    # keyboard of forwarding host might be in use while host itself is locked
+    lock_monitor = None
+    lock_source = power.create_source(config.lock_monitor, config.lock_monitor_idle)
+    if forwarder is None and lock_source is not None:
+        lock_monitor = power.LockMonitor(
+            lock_source,
+            hid_child.suspend if hid_child is not None else session.set_suspended,
+        )
+        lock_monitor.start()
 
     @Slot()
     def draw_devices_menu(arg):
@@ -446,20 +464,23 @@ def setup_application(config):
             menu.addAction(da)
 
         menu.addSeparator()
+        if heatmap_action is not None:
+            menu.addAction(heatmap_action)
         menu.addAction(quit)
         # pp(devices)
 
     @Slot()
     def update_icon_and_touchboard(arg):
-        nonlocal touchboard_displayed
-        layer, caps_word = arg
-        layer = str(layer)
+        nonlocal touchboard_displayed, current_layer
+        if arg.layer != current_layer:
+            current_layer = arg.layer
+            if heatmap_action is not None and heatmap_action.isChecked():
+                update_heatmap_overlay()
+        layer, caps_word = str(arg.layer), arg.caps_word
         if caps_word != 0:
-            tray.setIcon(icons["caps_word"])
-        elif layer in icons:
-            tray.setIcon(icons[layer])
+            set_icon("caps_word")
         else:
-            tray.setIcon(icons["not_found"])
+            set_icon(layer)
 
         if layer == str(touchboard_layer):
             if not multiclick_waiting and not touchboard_displayed:
@@ -477,74 +498,201 @@ def setup_application(config):
         nonlocal multiclick_waiting
         if multiclick_waiting:
             # recv is not allowed here, read happens in other thread
-            protocol.send(device, [protocol.INVERT_LAYER, touchboard_layer])
+            send_interactive([protocol.INVERT_LAYER, touchboard_layer])
             multiclick_waiting = False
             # macosx specific benavior of pynput multiclicks, it's a hack sorry
             mouse._click = None
 
     multiclick_timer = QTimer()
-    multiclick_timer.setInterval(
-        int(
-            config.get(
-                "touchboard-multiclick-period", DEFAULT_TOUCHBOARD_MULTICLICK_PERIOD
-            )
-        )
-    )
+    multiclick_timer.setInterval(config.touchboard_multiclick_period)
     multiclick_timer.timeout.connect(multiclick_timeout)
     multiclick_timer.setSingleShot(True)
 
-    @Slot()
-    def handle_press(arg):
-        nonlocal touchboard_displayed, multiclick_waiting, multiclick_timer
-        symbol, row, col, action = arg
-        if (
-            symbol == config.get("touchboard-move", DEFAULT_TOUCHBOARD_MOVE)
-            and action == "release"
-        ):
-            x, y = touchboard.dive(row, col)
-            mouse.position = (x, y)
-        elif (
-            symbol == config.get("touchboard-button-1", DEFAULT_TOUCHBOARD_LEFT)
-            and action == "press"
-        ):
-            mouse.press(Button.left)
-            if not multiclick_waiting:
-                touchboard.draw_initial()
-        elif (
-            symbol == config.get("touchboard-button-2", DEFAULT_TOUCHBOARD_RIGHT)
-            and action == "press"
-        ):
-            mouse.press(Button.right)
+    def hide_touchboard_for_multiclick():
+        nonlocal touchboard_displayed, multiclick_waiting
+        if not multiclick_waiting and touchboard_displayed:
+            touchboard.hide()
+            touchboard_displayed = False
+            multiclick_waiting = True
+            multiclick_timer.start()
+
+    motion_engine = None
+    if config.touchboard_motion_rate > 0:
+        motion_engine = motion.MotionEngine(
+            # backend is recreated when screens change
+            lambda x, y: output_backend.move(x, y),
+            config.touchboard_motion_rate,
+            config.touchboard_motion_hold / 1000,
+            config.touchboard_motion_ramp / 1000,
+            config.touchboard_motion_min_speed,
+            config.touchboard_motion_max_speed,
+            config.touchboard_motion_curve,
+        )
+
+    def move_press(row, col):
+        # hint codes are typed with TB_MOVE keys, holding one must not move pointer
+        if motion_engine is not None and not touchboard.hints_mode:
+            motion_engine.start(
+                touchboard.direction(row, col),
+                QCursor.pos().toTuple(),
+                app.primaryScreen().virtualGeometry().getRect(),
+            )
+
+    def move(row, col):
+        # key held longer than hold period moved pointer continuously, tap dives
+        if motion_engine is not None and motion_engine.stop():
+            return
+        if touchboard.hints_mode:
+            position = touchboard.hint(row, col)
+            if position is not None:
+                output_backend.move(*position)
+            return
+        x, y = touchboard.dive(row, col)
+        output_backend.move(x, y)
+
+    def button_press(button):
+        def handler(row, col):
+            output_backend.press(button)
             if not multiclick_waiting:
                 touchboard.draw_initial()
-        elif (
-            symbol == config.get("touchboard-button-1", DEFAULT_TOUCHBOARD_LEFT)
-            and action == "release"
-        ):
-            mouse.release(Button.left)
-            if not multiclick_waiting and touchboard_displayed:
-                touchboard.hide()
-                touchboard_displayed = False
-                multiclick_waiting = True
-                multiclick_timer.start()
-        elif (
-            symbol == config.get("touchboard-button-2", DEFAULT_TOUCHBOARD_RIGHT)
-            and action == "release"
-        ):
-            mouse.release(Button.right)
-            if not multiclick_waiting and touchboard_displayed:
-                touchboard.hide()
-                touchboard_displayed = False
-                multiclick_waiting = True
-                multiclick_timer.start()
-        elif action == "release":
-            emulate_keypress(symbol)
+
+        return handler
+
+    def button_release(button):
+        def handler(row, col):
+            output_backend.release(button)
+            hide_touchboard_for_multiclick()
+
+        return handler
+
+    def scroll(dy):
+        def handler(row, col):
+            output_backend.scroll(dy)
+
+        return handler
+
+    def drag_lock(row, col):
+        nonlocal drag_locked
+        if drag_locked:
+            output_backend.release(output.LEFT)
+            hide_touchboard_for_multiclick()
+        else:
+            output_backend.press(output.LEFT)
+            touchboard.draw_initial()
+        drag_locked = not drag_locked
+
+    def ignore(row, col):
+        pass
+
+    # (symbol, action) -> handler(row, col), everything else is unicode input on release
+    press_handlers = {}
+
+    def register_press_handler(symbol, action, handler):
+        if symbol is None:
+            return
+        if (symbol, action) in press_handlers:
+            log.error("touchboard symbol %s %s is assigned twice", symbol, action)
+            return
+        press_handlers[(symbol, action)] = handler
+
+    register_press_handler(config.touchboard_move, "press", move_press)
+    register_press_handler(config.touchboard_move, "release", move)
+    register_press_handler(
+        config.touchboard_button_1, "press", button_press(output.LEFT)
+    )
+    register_press_handler(
+        config.touchboard_button_1, "release", button_release(output.LEFT)
+    )
+    register_press_handler(
+        config.touchboard_button_2, "press", button_press(output.RIGHT)
+    )
+    register_press_handler(
+        config.touchboard_button_2, "release", button_release(output.RIGHT)
+    )
+    register_press_handler(
+        config.touchboard_button_3, "press", button_press(output.MIDDLE)
+    )
+    register_press_handler(
+        config.touchboard_button_3, "release", button_release(output.MIDDLE)
+    )
+    register_press_handler(config.touchboard_scroll_up, "press", scroll(1))
+    register_press_handler(config.touchboard_scroll_down, "press", scroll(-1))
+    register_press_handler(config.touchboard_drag_lock, "release", drag_lock)
+
+    # touchboard symbols must not be typed as unicode on the other edge
+    for symbol, action in list(press_handlers.keys()):
+        if action == "press" and (symbol, "release") not in press_handlers:
+            press_handlers[(symbol, "release")] = ignore
+
+    @Slot()
+    def handle_press(press):
+        handler = press_handlers.get((press.symbol, press.action))
+        if handler is not None:
+            handler(press.row, press.col)
+        elif press.action == "release":
+            emulate_keypress(press.symbol)
+
+    @Slot()
+    def flush_state():
+        nonlocal pending_state, last_state_flush
+        state_timer.stop()
+        if pending_state is not None:
+            state = pending_state
+            pending_state = None
+            last_state_flush = time.monotonic()
+            update_icon_and_touchboard(state)
+
+    state_timer = QTimer()
+    state_timer.setSingleShot(True)
+    state_timer.timeout.connect(flush_state)
+
+    @Slot()
+    def handle_events(events):
+        nonlocal pending_state
+        for event in events:
+            if type(event) is messages.LayerState:
+                pending_state = event
+            elif type(event) is messages.Press:
+                # press might depend on layer state received before it
+                flush_state()
+                handle_press(event)
+
+        if pending_state is not None and not state_timer.isActive():
+            since_flush = (time.monotonic() - last_state_flush) * 1000
+            if since_flush >= FRAME_INTERVAL:
+                flush_state()
+            else:
+                state_timer.start(int(FRAME_INTERVAL - since_flush))
 
     signals.devices_update.connect(draw_devices_menu)
-    signals.state_update.connect(update_icon_and_touchboard)
-    signals.press_received.connect(handle_press)
+    signals.events_received.connect(handle_events)
+    signals.keymaps_loaded.connect(touchboard.prepare)
 
     app.exec()
 
 
-setup_application(init_config())
+# module is imported again by spawned hid process, only GUI process gets past this check
+if __name__ == "__main__":
+    keyboard = Controller()
+    mouse = MouseController()
+
+    parser = argparse.ArgumentParser(description="QMK companion app")
+    parser.add_argument(
+        "--profile", metavar="FILE", help="sample all threads into folded stacks file"
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="append tracemalloc snapshots to FILE.memory",
+    )
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile is not None:
+        profile = profiler.Profiler(args.profile, memory=args.profile_memory)
+        profile.start()
+
+    setup_application(settings.Settings(init_config()))
+
+    if profile is not None:
+        profile.stop()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Publish/subscribe bus for automation hooks, no Qt here. Subscribers are registered
+# by event type (messages.LayerState, messages.Press, Devices, Keymaps) and every one
+# of them runs in its own thread with bounded queue, so publish from HID reader thread
+# only appends to queues and never waits for subscriber code.
+#
+# Full queue drops the oldest or the newest event depending on policy, queue of size 1
+# with drop-oldest keeps only the latest event. Callback running longer than its timeout
+# can't be interrupted, events for that subscriber are dropped until it returns.
+
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_QUEUE = 64
+
+
+class Devices:
+    __slots__ = ("candidates", "index")
+
+    def __init__(self, candidates, index):
+        self.candidates = candidates
+        self.index = index
+
+    def __repr__(self):
+        return f"Devices(candidates={len(self.candidates)}, index={self.index})"
+
+
+class Keymaps:
+    __slots__ = ("meta", "layers", "layout_options")
+
+    def __init__(self, meta, layers, layout_options):
+        self.meta = meta
+        self.layers = layers
+        self.layout_options = layout_options
+
+    def __repr__(self):
+        layers = None if self.layers is None else len(self.layers)
+        return f"Keymaps(layers={layers}, layout_options={self.layout_options})"
+
+
+class Subscriber:
+    def __init__(self, name, callback, timeout, queue_size, policy):
+        if policy not in POLICIES:
+            log.error(
+                "unknown drop policy %s of %s, %s is used", policy, name, DROP_OLDEST
+            )
+            policy = DROP_OLDEST
+        self.name = name
+        self.callback = callback
+        self.timeout = timeout
+        self.queue_size = max(1, queue_size)
+        self.policy = policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        # monotonic start of running callback, None when subscriber is idle
+        self.busy_since = None
+        self.stuck = False
+        self.stopped = False
+        self.delivered = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.max_duration = 0.0
+        self.thread = threading.Thread(
+            target=self.run, name=f"bus {name}", daemon=True
+        )
+
+    def offer(self, event, now):
+        with self.condition:
+            if self.busy_since is not None and now - self.busy_since > self.timeout:
+                if not self.stuck:
+                    log.error(
+                        "subscriber %s runs over %s seconds, its events are dropped",
+                        self.name,
+                        self.timeout,
+                    )
+                    self.stuck = True
+                    self.timeouts += 1
+                self.dropped += 1
+                return
+
+            if len(self.queue) >= self.queue_size:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                self.queue.popleft()
+            self.queue.append(event)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                event = self.queue.popleft()
+                self.busy_since = time.monotonic()
+
+            try:
+                self.callback(event)
+            except Exception:
+                log.exception("subscriber %s failed on %s", self.name, event)
+                self.errors += 1
+
+            with self.condition:
+                duration = time.monotonic() - self.busy_since
+                self.busy_since = None
+                self.delivered += 1
+                self.max_duration = max(self.max_duration, duration)
+                if duration > self.timeout and not self.stuck:
+                    log.error(
+                        "subscriber %s took %.3f seconds over timeout %s",
+                        self.name,
+                        duration,
+                        self.timeout,
+                    )
+                    self.timeouts += 1
+                self.stuck = False
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def metrics(self):
+        return {
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "max_duration_ms": round(self.max_duration * 1000, 3),
+        }
+
+
+class Bus:
+    def __init__(self):
+        # event type -> tuple of subscribers, replaced on subscribe, publish has no lock
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(
+        self,
+        event_type,
+        callback,
+        name=None,
+        timeout=DEFAULT_TIMEOUT,
+        queue_size=DEFAULT_QUEUE,
+        policy=DROP_OLDEST,
+    ):
+        if name is None:
+            name = getattr(callback, "__name__", event_type.__name__)
+        subscriber = Subscriber(name, callback, timeout, queue_size, policy)
+        with self.lock:
+            self.subscribers[event_type] = self.subscribers.get(event_type, ()) + (
+                subscriber,
+            )
+        subscriber.thread.start()
+        log.info("%s subscribed to %s", name, event_type.__name__)
+        return subscriber
+
+    def publish(self, event):
+        subscribers = self.subscribers.get(type(event))
+        if subscribers is not None:
+            now = time.monotonic()
+            for subscriber in subscribers:
+                subscriber.offer(event, now)
+
+    def publish_all(self, events):
+        for event in events:
+            self.publish(event)
+
+    def stop(self):
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                subscriber.stop()
+                log.info(
+                    "bus subscriber %s metrics %s",
+                    subscriber.name,
+                    subscriber.metrics(),
+                )
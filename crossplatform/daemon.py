@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Headless companion: runs HID session without Qt and publishes layer/caps_word state
+# and presses as newline delimited json over unix domain socket.
+#
+#   python daemon.py --socket /run/user/1000/qmk-companion.sock
+#   socat - UNIX-CONNECT:/run/user/1000/qmk-companion.sock
+#   {"type": "state", "layer": 1, "caps_word": 0, "time": 1760000000.123}
+
+import argparse
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+
+import protocol
+import messages
+import session
+import profiler
+import power
+
+logging.basicConfig(encoding="utf-8", level=logging.INFO)
+log = logging.getLogger(__name__)
+
+SOCKET_NAME = "qmk-companion.sock"
+# subscriber which doesn't read its socket is resynced with the latest state when buffer grows over limit
+MAX_SUBSCRIBER_BUFFER = 64 * 1024
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is None:
+        runtime_dir = "/tmp"
+    return os.path.join(runtime_dir, SOCKET_NAME)
+
+
+class Subscriber:
+    __slots__ = ("sock", "buffer", "dropped")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.dropped = 0
+
+
+class Publisher:
+    def __init__(self, path, max_buffer=MAX_SUBSCRIBER_BUFFER):
+        self.path = path
+        self.max_buffer = max_buffer
+        self.subscribers = {}
+        self.last_state = None
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, "accept")
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, "wakeup")
+        log.info("publishing events on %s", self.path)
+
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, message):
+        line = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf8")
+        with self.lock:
+            if message["type"] == "state":
+                self.last_state = line
+
+            wakeup = False
+            for subscriber in self.subscribers.values():
+                if len(subscriber.buffer) == 0:
+                    # fast path, try to deliver right away without waking selector thread
+                    try:
+                        sent = subscriber.sock.send(line)
+                    except BlockingIOError:
+                        sent = 0
+                    except OSError:
+                        # closed subscriber is collected by selector thread
+                        continue
+                    if sent == len(line):
+                        continue
+                    subscriber.buffer += line[sent:]
+                else:
+                    subscriber.buffer += line
+
+                if len(subscriber.buffer) > self.max_buffer:
+                    subscriber.dropped += 1
+                    log.log(
+                        logging.WARNING if subscriber.dropped == 1 else logging.DEBUG,
+                        "subscriber is too slow, dropping %s buffered bytes (%s times)",
+                        len(subscriber.buffer),
+                        subscriber.dropped,
+                    )
+                    # state is idempotent, slow reader gets the latest one instead of backlog
+                    subscriber.buffer = bytearray(self.last_state or b"")
+                wakeup = True
+
+        if wakeup:
+            try:
+                self.wakeup_send.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def serve(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.data == "accept":
+                    self.accept()
+                elif key.data == "wakeup":
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    subscriber = key.data
+                    if mask & selectors.EVENT_READ:
+                        try:
+                            data = subscriber.sock.recv(4096)
+                        except OSError:
+                            data = b""
+                        if len(data) == 0:
+                            self.disconnect(subscriber)
+                            continue
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(subscriber)
+
+            self.update_interest()
+
+    def accept(self):
+        try:
+            sock, _ = self.server.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock)
+        with self.lock:
+            if self.last_state is not None:
+                subscriber.buffer += self.last_state
+            self.subscribers[sock.fileno()] = subscriber
+        self.selector.register(sock, selectors.EVENT_READ, subscriber)
+        log.info("subscriber connected, %s total", len(self.subscribers))
+
+    def disconnect(self, subscriber):
+        with self.lock:
+            self.subscribers.pop(subscriber.sock.fileno(), None)
+        self.selector.unregister(subscriber.sock)
+        subscriber.sock.close()
+        log.info("subscriber disconnected, %s total", len(self.subscribers))
+
+    def flush(self, subscriber):
+        with self.lock:
+            try:
+                sent = subscriber.sock.send(subscriber.buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                sent = len(subscriber.buffer)
+            del subscriber.buffer[:sent]
+
+    def update_interest(self):
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        for subscriber in subscribers:
+            events = selectors.EVENT_READ
+            if len(subscriber.buffer) > 0:
+                events |= selectors.EVENT_WRITE
+            self.selector.modify(subscriber.sock, events, subscriber)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QMK companion headless daemon")
+    parser.add_argument("--socket", default=default_socket_path())
+    parser.add_argument("--product-id", type=lambda v: int(v, 0), default=None)
+    parser.add_argument("--heartbeat-idle", type=float, default=session.heartbeat_idle)
+    parser.add_argument(
+        "--lock-monitor",
+        default="auto",
+        help="auto, logind, logind-poll, off or file:PATH, "
+        "reporting is off while session is locked",
+    )
+    parser.add_argument("--profile", metavar="FILE")
+    parser.add_argument("--profile-memory", action="store_true")
+    args = parser.parse_args()
+    session.heartbeat_idle = args.heartbeat_idle
+
+    profile = None
+    if args.profile is not None:
+        profile = profiler.Profiler(args.profile, memory=args.profile_memory)
+        profile.start()
+
+    publisher = Publisher(args.socket)
+    publisher.start()
+
+    published_state = None
+
+    def events_received(events):
+        nonlocal published_state
+        for event in events:
+            if type(event) is messages.LayerState:
+                # heartbeat replies repeat the same state, subscribers get changes only
+                state = (event.layer, event.caps_word)
+                if state == published_state:
+                    continue
+                published_state = state
+                publisher.publish(
+                    {
+                        "type": "state",
+                        "layer": event.layer,
+                        "caps_word": event.caps_word,
+                        "time": time.time(),
+                    }
+                )
+            elif type(event) is messages.Press:
+                publisher.publish(
+                    {
+                        "type": "press",
+                        "symbol": event.symbol,
+                        "row": event.row,
+                        "col": event.col,
+                        "action": event.action,
+                        "time": time.time(),
+                    }
+                )
+
+    def wait_for_device():
+        nonlocal published_state
+        published_state = None
+        publisher.publish({"type": "wait", "time": time.time()})
+
+    def select_device(candidates):
+        device_index = 0
+        for idx, candidate in enumerate(candidates):
+            if candidate["product_id"] == args.product_id:
+                device_index = idx
+
+        device_info = candidates[device_index]
+        publisher.publish(
+            {
+                "type": "device",
+                "product_string": device_info["product_string"],
+                "vendor_id": device_info["vendor_id"],
+                "product_id": device_info["product_id"],
+                "time": time.time(),
+            }
+        )
+        return device_index
+
+    threading.Thread(
+        target=session.process_loop,
+        args=(None, events_received, wait_for_device, select_device, None),
+        daemon=True,
+    ).start()
+
+    lock_monitor = None
+    lock_source = power.create_source(args.lock_monitor)
+    if lock_source is not None:
+        lock_monitor = power.LockMonitor(lock_source, session.set_suspended)
+        lock_monitor.start()
+
+    stopped = threading.Event()
+
+    def shutdown(signum, frame):
+        log.info("shutting down daemon")
+        if lock_monitor is not None:
+            lock_monitor.stop()
+        session.stop = True
+        if session.device is not None:
+            protocol.disable_reporting(session.device)
+            protocol.close(session.device)
+        publisher.stop()
+        stopped.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    stopped.wait()
+    if profile is not None:
+        profile.stop()
+
+
+if __name__ == "__main__":
+    main()
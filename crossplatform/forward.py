@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Forwarding of layer state and presses from the host with keyboard to peer instance on
+# another machine (KVM, Synergy like setups), which shows touchboard and types unicode.
+# Host connects to peer ("forward-to"), peer listens ("forward-listen"), both over TCP or
+# UDP. Every frame is
+#
+#   header:  uint8 magic, uint8 kind, uint16 payload length, uint32 sequence, int64 send time ns
+#   tag:     16 bytes of HMAC-SHA256 of nonce of receiving side, header and payload with
+#            shared secret, HELLO has empty nonce
+#   HELLO:   16 bytes of random nonce of sending side, new for every connection
+#   EVENTS:  events encoded in report format of messages.py, messages.MAX_SIZE bytes each
+#   PING:    empty, send time of header is clock of pinging side
+#   PONG:    int64 send time of PING
+#   COMMAND: bytes of send_interactive request from peer to keyboard
+#   KEYMAPS: zlib compressed json of [vial meta, layers keymaps, layout options]
+#
+# Sequence numbers are per direction, gaps are counted as lost frames and stale UDP frames
+# are dropped. Both sides ping each other every second, clock offset is taken from the
+# sample with the lowest round trip of last ones, one way latency of events is receive
+# time minus send time corrected by offset. Frame with sequence 0 means restarted side,
+# host sends keymaps and the latest state again then.
+#
+# Frames without valid tag are dropped, so only hosts knowing "forward-secret" can
+# press keys on peer or send commands to keyboard. Both sides start with HELLO and tag
+# the rest of frames with nonce of the other side, so recorded stream can't be replayed,
+# its tags were made for nonce of connection which is gone. UDP peer takes a new nonce
+# for every HELLO of host and answers with its own HELLO, host repeats HELLO until it's
+# answered and whenever peer is silent for LINK_TIMEOUT. UDP peer replies to the first
+# host which sent authenticated frame, other addresses are ignored until that host is
+# silent for LINK_TIMEOUT and another one starts from sequence 0.
+#
+#   python forward.py --loopback --transport udp
+
+import argparse
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import messages
+
+log = logging.getLogger(__name__)
+
+MAGIC = 0x51
+HEADER = struct.Struct("<BBHIq")
+PONG_PAYLOAD = struct.Struct("<q")
+SLOT_SIZE = messages.MAX_SIZE
+MAX_PAYLOAD = 0xFFFF
+SEQUENCE_MASK = 0xFFFFFFFF
+TAG_SIZE = 16
+NONCE_SIZE = 16
+# raised by decoding of broken payload (json, zlib, struct, chr)
+MALFORMED = (ValueError, OverflowError, TypeError, KeyError, struct.error, zlib.error)
+
+EVENTS = 0
+PING = 1
+PONG = 2
+COMMAND = 3
+KEYMAPS = 4
+HELLO = 5
+
+DEFAULT_PORT = 7373
+SYNC_INTERVAL = 1.0
+# clock offset is taken from the best of this many last samples
+SYNC_WINDOW = 16
+# link without any frame (pings included) for this long is considered dead
+LINK_TIMEOUT = 3.0
+RECONNECT_DELAY = 1.0
+METRICS_INTERVAL = 60.0
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    if host == "":
+        return text, DEFAULT_PORT
+    return host.strip("[]"), int(port)
+
+
+def encode_events(events):
+    return b"".join(messages.encode(event).ljust(SLOT_SIZE, b"\0") for event in events)
+
+
+def decode_events(payload):
+    events = []
+    for offset in range(0, len(payload), SLOT_SIZE):
+        event = messages.decode(payload[offset : offset + SLOT_SIZE])
+        if event is not None:
+            events.append(event)
+    return events
+
+
+def frame_tag(key, nonce, data):
+    return hmac.new(key, nonce + data, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+# (family, socket address) of the first address host name resolves to
+def resolve(address, kind, flags=0):
+    family, _, _, _, sockaddr = socket.getaddrinfo(
+        address[0], address[1], type=kind, flags=flags
+    )[0]
+    return family, sockaddr
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class Link:
+    # stream socket of TCP connection or datagram socket with address of the other side
+
+    def __init__(self, sock, key, datagram=False, address=None):
+        self.sock = sock
+        self.key = key
+        self.datagram = datagram
+        self.address = address
+        self.last_seen = time.monotonic()
+        # frames to this side are tagged with nonce, frames to the other one with peer's
+        self.nonce = os.urandom(NONCE_SIZE)
+        self.peer_nonce = None
+
+    def send(self, data):
+        nonce = b"" if data[1] == HELLO else self.peer_nonce
+        data += frame_tag(self.key, nonce, data)
+        if self.datagram:
+            self.sock.sendto(data, self.address)
+        else:
+            self.sock.sendall(data)
+
+    # None when connection is closed, ValueError for malformed frame
+    def recv_frame(self):
+        if self.datagram:
+            data, address = self.sock.recvfrom(HEADER.size + MAX_PAYLOAD + TAG_SIZE)
+            if len(data) < HEADER.size + TAG_SIZE:
+                raise ValueError(f"short datagram of {len(data)} bytes")
+            magic, kind, size, sequence, sent = HEADER.unpack_from(data)
+            if len(data) != HEADER.size + size + TAG_SIZE:
+                raise ValueError(f"truncated datagram of {len(data)} bytes")
+            header = data[: HEADER.size]
+            payload = data[HEADER.size : HEADER.size + size]
+            tag = data[HEADER.size + size :]
+        else:
+            header = recv_exact(self.sock, HEADER.size)
+            if header is None:
+                return None
+            magic, kind, size, sequence, sent = HEADER.unpack(header)
+            payload = recv_exact(self.sock, size + TAG_SIZE)
+            if payload is None:
+                return None
+            payload, tag = payload[:size], payload[size:]
+
+        if magic != MAGIC:
+            raise ValueError(f"bad magic {magic:#x}")
+        nonce = b"" if kind == HELLO else self.nonce
+        if not hmac.compare_digest(tag, frame_tag(self.key, nonce, header + payload)):
+            raise ValueError("frame is not authenticated")
+
+        now = time.monotonic()
+        if self.datagram and address != self.address:
+            # reply path moves only to host which restarted after pinned one went silent
+            if self.address is not None and (
+                sequence != 0 or now - self.last_seen < LINK_TIMEOUT
+            ):
+                raise ValueError(f"datagram from unexpected address {address}")
+            log.info("forward link is pinned to %s", address)
+            self.address = address
+        self.last_seen = now
+        return kind, sequence, sent, payload
+
+    def close(self):
+        self.sock.close()
+
+
+class Endpoint:
+    def __init__(self, address, transport, secret):
+        self.address = address
+        self.key = secret.encode("utf8")
+        self.datagram = transport == "udp"
+        if transport not in ("tcp", "udp"):
+            log.error("unknown forward transport %s, tcp is used", transport)
+        self.link = None
+        self.stopped = False
+        self.send_lock = threading.Lock()
+        self.sequence = 0
+        self.received = None
+        self.last_frame = time.monotonic()
+        self.sync_samples = collections.deque(maxlen=SYNC_WINDOW)
+        self.offset = None
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.sent = 0
+        self.frames = 0
+        self.lost = 0
+        self.stale = 0
+        self.latency_total = 0
+        self.latency_count = 0
+        self.latency_max = None
+
+    def start(self):
+        threading.Thread(target=self.run, name="forward", daemon=True).start()
+        threading.Thread(
+            target=self.sync_loop, name="forward sync", daemon=True
+        ).start()
+
+    def stop(self):
+        self.stopped = True
+        link = self.link
+        if link is not None:
+            link.close()
+
+    def send(self, kind, payload=b""):
+        link = self.link
+        # UDP peer learns address of host from its first frame, frames other than HELLO
+        # wait for nonce of the other side
+        if link is None or (link.datagram and link.address is None):
+            return False
+        if kind != HELLO and link.peer_nonce is None:
+            return False
+        if len(payload) > MAX_PAYLOAD:
+            log.error("forward frame of %s bytes is too long, dropped", len(payload))
+            return False
+        try:
+            # HID reader, receive and sync threads send, sequence follows order on the wire
+            with self.send_lock:
+                header = HEADER.pack(
+                    MAGIC, kind, len(payload), self.sequence, time.time_ns()
+                )
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+                link.send(header + payload)
+        except OSError as e:
+            log.error("failed to forward frame to %s, %s", self.address, e)
+            if not link.datagram:
+                link.close()
+            return False
+        self.sent += 1
+        return True
+
+    def new_link(self, link):
+        self.link = link
+        self.sequence = 0
+        self.received = None
+        self.last_frame = time.monotonic()
+        self.sync_samples.clear()
+        self.offset = None
+
+    # True if frame is in order, late UDP frames are dropped
+    def in_sequence(self, sequence):
+        if sequence == 0 or self.received is None:
+            self.received = sequence
+            return True
+        gap = (sequence - self.received) & SEQUENCE_MASK
+        if gap == 0 or gap > SEQUENCE_MASK // 2:
+            self.stale += 1
+            return False
+        self.lost += gap - 1
+        self.received = sequence
+        return True
+
+    def receive_loop(self, link):
+        link.sock.settimeout(SYNC_INTERVAL)
+        while not self.stopped:
+            try:
+                frame = link.recv_frame()
+            except TimeoutError:
+                if not self.idle(link):
+                    return
+                continue
+            except ValueError as e:
+                log.error("malformed forward frame, %s", e)
+                if link.datagram:
+                    continue
+                return
+            except OSError as e:
+                if not self.stopped:
+                    log.error("forward link to %s failed, %s", self.address, e)
+                return
+            if frame is None:
+                log.info("forward link to %s closed", self.address)
+                return
+
+            kind, sequence, sent, payload = frame
+            self.last_frame = time.monotonic()
+            self.frames += 1
+            if kind == HELLO:
+                if len(payload) != NONCE_SIZE:
+                    log.error("forward hello of %s bytes dropped", len(payload))
+                    continue
+                self.hello(link, payload)
+            if sequence == 0:
+                self.restarted()
+            if not self.in_sequence(sequence) or kind == HELLO:
+                continue
+
+            try:
+                if kind == PING:
+                    self.send(PONG, PONG_PAYLOAD.pack(sent))
+                elif kind == PONG:
+                    self.sync(PONG_PAYLOAD.unpack(payload)[0], sent)
+                else:
+                    self.dispatch(kind, sent, payload)
+            except MALFORMED as e:
+                # authenticated but malformed payload, only this frame is lost
+                log.error("bad forward frame of kind %s dropped, %s", kind, e)
+
+    def hello(self, link, nonce):
+        link.peer_nonce = nonce
+
+    def ping(self, link):
+        self.send(PING)
+
+    # link is kept while True is returned
+    def idle(self, link):
+        return link.datagram or time.monotonic() - self.last_frame < LINK_TIMEOUT
+
+    def restarted(self):
+        pass
+
+    def dispatch(self, kind, sent, payload):
+        log.error("unexpected forward frame kind %s", kind)
+
+    def sync(self, pinged, other_time):
+        now = time.time_ns()
+        rtt = now - pinged
+        # clock of the other side minus own, half of round trip is assumed for each way
+        self.sync_samples.append((rtt, other_time - (pinged + now) // 2))
+        self.offset = min(self.sync_samples)[1]
+
+    def sync_loop(self):
+        next_metrics = time.monotonic() + METRICS_INTERVAL
+        while not self.stopped:
+            time.sleep(SYNC_INTERVAL)
+            link = self.link
+            if link is not None:
+                self.ping(link)
+            if time.monotonic() >= next_metrics:
+                next_metrics = time.monotonic() + METRICS_INTERVAL
+                log.info("forward metrics %s", self.metrics())
+                self.reset_metrics()
+
+    def record_latency(self, sent):
+        if self.offset is None:
+            return
+        latency = time.time_ns() - (sent - self.offset)
+        self.latency_total += latency
+        self.latency_count += 1
+        if self.latency_max is None or latency > self.latency_max:
+            self.latency_max = latency
+
+    def metrics(self):
+        metrics = {
+            "sent": self.sent,
+            "received": self.frames,
+            "lost": self.lost,
+            "stale": self.stale,
+        }
+        if len(self.sync_samples) > 0:
+            metrics["rtt_ms"] = round(min(self.sync_samples)[0] / 1e6, 3)
+            metrics["clock_offset_ms"] = round(self.offset / 1e6, 3)
+        if self.latency_count > 0:
+            metrics["latency_mean_ms"] = round(
+                self.latency_total / self.latency_count / 1e6, 3
+            )
+            metrics["latency_max_ms"] = round(self.latency_max / 1e6, 3)
+        return metrics
+
+
+class Sender(Endpoint):
+    # host side, events of HID session go to peer, peer commands go to keyboard
+
+    def __init__(self, address, transport, secret, on_command):
+        super().__init__(address, transport, secret)
+        self.on_command = on_command
+        self.last_state = None
+        self.last_keymaps = None
+
+    def events_received(self, events):
+        for event in events:
+            if type(event) is messages.LayerState:
+                self.last_state = event
+        self.send(EVENTS, encode_events(events))
+
+    def keymaps_update(self, vial_meta, layers, layout_options):
+        self.last_keymaps = zlib.compress(
+            json.dumps([vial_meta, layers, layout_options]).encode("utf8")
+        )
+        self.send(KEYMAPS, self.last_keymaps)
+
+    def restarted(self):
+        log.info("forward peer %s (re)started, sending keymaps and state", self.address)
+        if self.last_keymaps is not None:
+            self.send(KEYMAPS, self.last_keymaps)
+        if self.last_state is not None:
+            self.send(EVENTS, encode_events([self.last_state]))
+
+    def dispatch(self, kind, sent, payload):
+        if kind == COMMAND:
+            self.on_command(list(payload))
+        else:
+            super().dispatch(kind, sent, payload)
+
+    # UDP HELLO or its answer might be lost, peer might restart and take new nonce
+    def ping(self, link):
+        if link.datagram and (
+            link.peer_nonce is None
+            or time.monotonic() - self.last_frame >= LINK_TIMEOUT
+        ):
+            self.send(HELLO, link.nonce)
+        else:
+            self.send(PING)
+
+    def run(self):
+        while not self.stopped:
+            try:
+                if self.datagram:
+                    # replies come from numeric address, it's what link is pinned to
+                    family, address = resolve(self.address, socket.SOCK_DGRAM)
+                    sock = socket.socket(family, socket.SOCK_DGRAM)
+                    link = Link(sock, self.key, datagram=True, address=address)
+                else:
+                    sock = socket.create_connection(self.address, timeout=LINK_TIMEOUT)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    link = Link(sock, self.key)
+            except OSError as e:
+                log.error("failed to connect forward peer %s, %s", self.address, e)
+                time.sleep(RECONNECT_DELAY)
+                continue
+
+            log.info("forwarding events to %s", self.address)
+            # keymaps and state are sent when HELLO of peer arrives
+            self.new_link(link)
+            self.send(HELLO, link.nonce)
+            self.receive_loop(link)
+            self.link = None
+            link.close()
+            if not self.stopped:
+                time.sleep(RECONNECT_DELAY)
+
+
+class Receiver(Endpoint):
+    # peer side, replaces HID session of the app
+
+    def __init__(
+        self,
+        address,
+        transport,
+        secret,
+        callback_events,
+        callback_keymaps,
+        callback_wait,
+    ):
+        super().__init__(address, transport, secret)
+        self.callback_events = callback_events
+        self.callback_keymaps = callback_keymaps
+        self.callback_wait = callback_wait
+
+    def send_command(self, data):
+        if not self.send(COMMAND, bytes(data)):
+            log.error("no forward link, %s is not sent", data)
+
+    def dispatch(self, kind, sent, payload):
+        if kind == EVENTS:
+            self.record_latency(sent)
+            events = decode_events(payload)
+            if len(events) > 0:
+                self.callback_events(events)
+        elif kind == KEYMAPS:
+            vial_meta, layers, layout_options = json.loads(zlib.decompress(payload))
+            self.callback_keymaps(vial_meta, layers, layout_options)
+        else:
+            super().dispatch(kind, sent, payload)
+
+    def idle(self, link):
+        if time.monotonic() - self.last_frame >= LINK_TIMEOUT:
+            self.callback_wait()
+            return link.datagram
+        return True
+
+    # UDP socket outlives hosts, every HELLO starts new session with new nonce, so
+    # frames recorded before it are never accepted again
+    def hello(self, link, nonce):
+        super().hello(link, nonce)
+        if link.datagram:
+            link.nonce = os.urandom(NONCE_SIZE)
+            self.new_link(link)
+            self.send(HELLO, link.nonce)
+
+    def run(self):
+        kind = socket.SOCK_DGRAM if self.datagram else socket.SOCK_STREAM
+        family, address = resolve(self.address, kind, socket.AI_PASSIVE)
+        if self.datagram:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            sock.bind(address)
+            log.info("waiting for forwarded events on udp %s", self.address)
+            link = Link(sock, self.key, datagram=True)
+            self.new_link(link)
+            self.receive_loop(link)
+            return
+
+        server = socket.socket(family, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(address)
+        server.listen()
+        server.settimeout(SYNC_INTERVAL)
+        log.info("waiting for forwarded events on tcp %s", self.address)
+        while not self.stopped:
+            try:
+                sock, address = server.accept()
+            except TimeoutError:
+                self.callback_wait()
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.info("forwarding host %s connected", address)
+            link = Link(sock, self.key)
+            self.new_link(link)
+            # host resyncs as soon as it gets frame with sequence 0
+            self.send(HELLO, link.nonce)
+            self.receive_loop(link)
+            self.link = None
+            link.close()
+        server.close()
+
+
+# sender and receiver over loopback, events are generated instead of read from keyboard
+def loopback(transport, count, interval, secret="loopback"):
+    received = []
+    keymaps = []
+    commands = []
+    receiver = Receiver(
+        ("127.0.0.1", 0 if transport == "tcp" else DEFAULT_PORT),
+        transport,
+        secret,
+        received.extend,
+        lambda *args: keymaps.append(args),
+        lambda: None,
+    )
+    if transport == "tcp":
+        # ephemeral port is picked before receiver thread starts listening
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        receiver.address = probe.getsockname()
+        probe.close()
+    receiver.start()
+    time.sleep(0.2)
+
+    sender = Sender(receiver.address, transport, secret, commands.append)
+    sender.keymaps_update({"matrix": {"rows": 1, "cols": 2}}, [{"0,0": 4}], [[0, 0]])
+    sender.start()
+    # offset needs a few ping rounds
+    time.sleep(SYNC_INTERVAL * 3.5)
+
+    for i in range(count):
+        sender.events_received(
+            [messages.Press(chr(0x41 + i % 26), i % 4, i % 6, "press")]
+        )
+        time.sleep(interval)
+    receiver.send_command([0x03, 1])
+    time.sleep(0.2)
+
+    log.info("sender metrics %s", sender.metrics())
+    log.info("receiver metrics %s", receiver.metrics())
+    log.info(
+        "%s of %s presses received, keymaps received %s, commands %s",
+        len(received),
+        count,
+        len(keymaps),
+        commands,
+    )
+    sender.stop()
+    receiver.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(encoding="utf-8", level=logging.INFO)
+    parser = argparse.ArgumentParser(description="event forwarding over loopback")
+    parser.add_argument("--loopback", action="store_true", required=True)
+    parser.add_argument("--transport", choices=("tcp", "udp"), default="tcp")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--interval", type=float, default=0.002)
+    args = parser.parse_args()
+    loopback(args.transport, args.count, args.interval)
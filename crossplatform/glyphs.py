@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Nerd Font glyphs of tray icons, shared by render_icons.py (prebuilt png files)
+# and tray_icons.py (icons rendered at runtime)
+
+FONT_FILE = "UbuntuMonoNerdFontMono-Regular.ttf"
+FONT_FAMILY = "UbuntuMono Nerd Font Mono"
+
+ICONS = {
+    #'default': '\U000F030C',
+    #'default': '\U000F09FA',
+    "default": "\U000f132e",
+    # "default": "\U000004d4",
+    "navigation": "\U0000f0ec",
+    "pointer": "\U000f037d",
+    "numpad": "\U0000215b",
+    # 'gaming': '\U000F0297',
+    "gaming": "\U000f0eb5",
+    "shortcuts": "\U000f1935",
+    "media": "\U000f127a",
+    # 'caps_word': '\U000F030E',
+    "caps_word": "\U000f0a9b",
+    "symbols": "\U00002248",
+    "emoji": "\U0000eb54",
+    "functional": "\U000f0295",
+    "touchboard": "\U0000f11c",
+    "modifiers": "\U000f030e",
+    "wait0": "\U0000f251",
+    "wait1": "\U0000f252",
+    "wait2": "\U0000f253",
+    "not_found": "\U0000eef9",
+}
+
+APP_ICON = "\U000000c6"
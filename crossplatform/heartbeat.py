@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Keyboard which stops responding without HID error (hub power glitch, firmware hang)
+# is detected by GET_LAYERS_STATE sent when link was silent for IDLE seconds. Any report
+# received in REPLY_TIMEOUT counts as reply, device is declared dead after MAX_MISSED
+# replies in a row and session is resumed. Reply repeating layer state which is already
+# shown is not dispatched.
+
+import logging
+import time
+
+import hid
+
+import protocol
+
+log = logging.getLogger(__name__)
+
+IDLE = 0.5
+CHECK_INTERVAL = 0.25
+REPLY_TIMEOUT = 0.25
+MAX_MISSED = 2
+# weight of the latest rtt in average
+RTT_SMOOTHING = 0.125
+
+
+class DeviceDead(hid.HIDException):
+    pass
+
+
+class Heartbeat:
+    def __init__(self, idle=IDLE, reply_timeout=REPLY_TIMEOUT, max_missed=MAX_MISSED):
+        self.idle = idle
+        self.reply_timeout = reply_timeout
+        self.max_missed = max_missed
+        self.last_reply = time.monotonic()
+        self.missed = 0
+        self.sent = 0
+        self.rtt_last = None
+        self.rtt_average = None
+        self.rtt_max = 0.0
+
+    # executed by scheduler as background job
+    def check(self, device):
+        now = time.monotonic()
+        if now - max(device.last_activity, self.last_reply) < self.idle:
+            self.missed = 0
+            return
+
+        self.sent += 1
+        protocol.send(device, [protocol.GET_LAYERS_STATE])
+        if device.wait_report(round(self.reply_timeout * 1000)):
+            self.last_reply = time.monotonic()
+            self.update_rtt(self.last_reply - now)
+            self.missed = 0
+            return
+
+        self.missed += 1
+        log.error("no heartbeat reply, %s missed in a row", self.missed)
+        if self.missed >= self.max_missed:
+            raise DeviceDead(f"no reply to {self.missed} heartbeats")
+
+    def update_rtt(self, rtt):
+        self.rtt_last = rtt
+        self.rtt_max = max(self.rtt_max, rtt)
+        if self.rtt_average is None:
+            self.rtt_average = rtt
+        else:
+            self.rtt_average += (rtt - self.rtt_average) * RTT_SMOOTHING
+
+    def metrics(self):
+        return {
+            "sent": self.sent,
+            "missed": self.missed,
+            "rtt_last": self.rtt_last,
+            "rtt_average": self.rtt_average,
+            "rtt_max": self.rtt_max,
+        }
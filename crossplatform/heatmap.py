@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Per key press counters by layer and matrix position. Counting happens in HID reader
+# thread after events are dispatched and doesn't allocate, counters live in one fixed
+# array. Flusher thread appends counters changed since previous flush to the file:
+#
+#   record: float64 time, uint16 number of entries
+#   entry:  uint16 index of counter ((layer * MAX_ROWS + row) * MAX_COLS + col), uint32 increment
+
+import logging
+import os.path
+import struct
+import threading
+import time
+from array import array
+
+import messages
+
+log = logging.getLogger(__name__)
+
+MAX_LAYERS = 32
+MAX_ROWS = 32
+MAX_COLS = 32
+SIZE = MAX_LAYERS * MAX_ROWS * MAX_COLS
+
+FLUSH_INTERVAL = 60.0
+FILE_NAME = "heatmap.bin"
+
+RECORD = struct.Struct("<dH")
+ENTRY = struct.Struct("<HI")
+# entries count of one record is uint16
+MAX_RECORD_ENTRIES = 0xFFFF
+
+
+class Heatmap:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.counts = array("I", bytes(SIZE * 4))
+        self.layer = 0
+        self.load()
+        # counters as they are in the file, difference is written by next flush
+        self.flushed = array("I", self.counts)
+        self.stopped = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.flush_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+    def record(self, events):
+        for event in events:
+            if type(event) is messages.Press:
+                if (
+                    event.action == "press"
+                    and event.row < MAX_ROWS
+                    and event.col < MAX_COLS
+                ):
+                    self.counts[
+                        (self.layer * MAX_ROWS + event.row) * MAX_COLS + event.col
+                    ] += 1
+            elif type(event) is messages.LayerState:
+                if event.layer < MAX_LAYERS:
+                    self.layer = event.layer
+
+    def layer_counts(self, layer):
+        counts = {}
+        start = layer * MAX_ROWS * MAX_COLS
+        for index in range(start, start + MAX_ROWS * MAX_COLS):
+            count = self.counts[index]
+            if count > 0:
+                row, col = divmod(index - start, MAX_COLS)
+                counts[f"{row},{col}"] = count
+        return counts
+
+    def flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            self.write_changes()
+
+    def write_changes(self):
+        entries = []
+        for index in range(SIZE):
+            # counter might be incremented meanwhile, the rest goes into next flush
+            count = self.counts[index]
+            if count != self.flushed[index]:
+                entries.append((index, count - self.flushed[index]))
+                self.flushed[index] = count
+
+        if len(entries) == 0:
+            return
+
+        data = bytearray()
+        now = time.time()
+        for start in range(0, len(entries), MAX_RECORD_ENTRIES):
+            chunk = entries[start : start + MAX_RECORD_ENTRIES]
+            data += RECORD.pack(now, len(chunk))
+            for index, increment in chunk:
+                data += ENTRY.pack(index, increment)
+
+        try:
+            with open(self.path, "ab") as f:
+                f.write(data)
+        except OSError as e:
+            log.error("failed to write heatmap to %s, %s", self.path, e)
+            return
+        log.debug("heatmap flushed, %s counters changed", len(entries))
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        offset = 0
+        records = 0
+        while offset + RECORD.size <= len(data):
+            _, count = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + count * ENTRY.size
+            if end > len(data):
+                break
+            for index, increment in ENTRY.iter_unpack(
+                data[offset + RECORD.size : end]
+            ):
+                if index < SIZE:
+                    self.counts[index] += increment
+            offset = end
+            records += 1
+
+        if offset != len(data):
+            # interrupted write, following records are appended right after the last complete one
+            log.error(
+                "heatmap file %s has %s bytes of incomplete record, truncating",
+                self.path,
+                len(data) - offset,
+            )
+            os.truncate(self.path, offset)
+        log.info("heatmap loaded from %s, %s records", self.path, records)
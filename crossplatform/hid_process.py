@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Optional HID session in child process, so HID reads don't wait for GIL held by overlay
+# rendering, emulate_keypress sleeps and Qt painting of GUI process.
+#
+# Events are passed to GUI process through single producer single consumer ring in
+# shared memory, every slot holds one event encoded in report format of messages.py.
+# Producer (HID reader of child) only moves write index, consumer (event thread of GUI
+# process) only moves read index. Slots are copied without lock, only loads and stores
+# of indices are done under shared lock, see EventRing. Event is the doorbell
+# for consumer sleeping on empty ring. Commands (send_interactive, suspend, stop) go to
+# child through small queue, rare notifications (devices, keymaps, wait) come back
+# through another one.
+#
+#   header: uint64 write index, uint64 read index, uint64 dropped events
+#   slot:   messages.MAX_SIZE bytes of encoded event
+
+import logging
+import multiprocessing
+import queue
+import struct
+import threading
+from multiprocessing import shared_memory
+
+import messages
+import protocol
+import session
+
+log = logging.getLogger(__name__)
+
+RING_SLOTS = 4096
+STOP_TIMEOUT = 2.0
+# child checks if GUI process is still alive this often
+PARENT_CHECK_INTERVAL = 1.0
+
+INDEX = struct.Struct("<Q")
+WRITE_OFFSET = 0
+READ_OFFSET = 8
+DROPPED_OFFSET = 16
+HEADER_SIZE = 24
+SLOT_SIZE = messages.MAX_SIZE
+
+
+class EventRing:
+    # python has no memory barriers, so index published by one process is loaded by the
+    # other one under lock (semaphore of multiprocessing), its release and acquire order
+    # slot copy before the store of index on every cpu, arm64 included. Each side loads
+    # its own index without lock, lock is held only for a single load or store.
+    def __init__(self, memory, slots, lock):
+        self.memory = memory
+        self.slots = slots
+        self.lock = lock
+        self.buffer = memory.buf
+        self.name = memory.name
+
+    @classmethod
+    def create(cls, lock, slots=RING_SLOTS):
+        memory = shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + slots * SLOT_SIZE
+        )
+        memory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        return cls(memory, slots, lock)
+
+    @classmethod
+    def attach(cls, name, lock, slots=RING_SLOTS):
+        # spawned child shares resource tracker of GUI process, which unlinks segment
+        return cls(shared_memory.SharedMemory(name=name), slots, lock)
+
+    def index(self, offset):
+        return INDEX.unpack_from(self.buffer, offset)[0]
+
+    def shared_index(self, offset):
+        with self.lock:
+            return self.index(offset)
+
+    def publish(self, offset, value):
+        with self.lock:
+            INDEX.pack_into(self.buffer, offset, value)
+
+    # producer side, event is dropped when consumer is a whole ring behind
+    def push(self, data):
+        write = self.index(WRITE_OFFSET)
+        if write - self.shared_index(READ_OFFSET) >= self.slots:
+            self.publish(DROPPED_OFFSET, self.index(DROPPED_OFFSET) + 1)
+            return False
+        offset = HEADER_SIZE + (write % self.slots) * SLOT_SIZE
+        self.buffer[offset : offset + len(data)] = data
+        self.publish(WRITE_OFFSET, write + 1)
+        return True
+
+    # consumer side
+    def pop_all(self):
+        read = self.index(READ_OFFSET)
+        write = self.shared_index(WRITE_OFFSET)
+        events = []
+        for index in range(read, write):
+            offset = HEADER_SIZE + (index % self.slots) * SLOT_SIZE
+            event = messages.decode(self.buffer[offset : offset + SLOT_SIZE])
+            if event is not None:
+                events.append(event)
+        self.publish(READ_OFFSET, write)
+        return events
+
+    def dropped(self):
+        return self.shared_index(DROPPED_OFFSET)
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+class HidProcess:
+    def __init__(self, config_meta, product_id, heartbeat_idle, slots=RING_SLOTS):
+        # fork is unsafe once Qt started its threads and isn't available on Windows
+        context = multiprocessing.get_context("spawn")
+        self.ring = EventRing.create(context.Lock(), slots)
+        self.ready = context.Event()
+        self.commands = context.Queue()
+        self.notifications = context.Queue()
+        self.stopped = False
+        self.process = context.Process(
+            target=child_main,
+            args=(
+                self.ring.name,
+                self.ring.lock,
+                slots,
+                self.ready,
+                self.commands,
+                self.notifications,
+                config_meta,
+                product_id,
+                heartbeat_idle,
+            ),
+            name="hid",
+            daemon=True,
+        )
+
+    def start(
+        self, callback_events, callback_wait, callback_select_device, callback_keymaps
+    ):
+        self.process.start()
+        log.info("hid session started in process %s", self.process.pid)
+        threading.Thread(
+            target=self.event_loop,
+            args=(callback_events,),
+            name="hid events",
+            daemon=True,
+        ).start()
+        threading.Thread(
+            target=self.notification_loop,
+            args=(callback_wait, callback_select_device, callback_keymaps),
+            name="hid notifications",
+            daemon=True,
+        ).start()
+
+    def event_loop(self, callback_events):
+        dropped = 0
+        while not self.stopped:
+            self.ready.wait()
+            # cleared before ring is drained, so event pushed meanwhile rings again
+            self.ready.clear()
+            if self.stopped:
+                break
+            events = self.ring.pop_all()
+            if len(events) > 0:
+                callback_events(events)
+            if self.ring.dropped() != dropped:
+                log.error(
+                    "event ring overflow, %s events dropped",
+                    self.ring.dropped() - dropped,
+                )
+                dropped = self.ring.dropped()
+
+    def notification_loop(
+        self, callback_wait, callback_select_device, callback_keymaps
+    ):
+        while True:
+            kind, payload = self.notifications.get()
+            if kind == "wait":
+                callback_wait()
+            elif kind == "devices":
+                callback_select_device(payload)
+            elif kind == "keymaps":
+                callback_keymaps(*payload)
+            elif kind == "stopped":
+                return
+
+    def send(self, data):
+        self.commands.put(("send", data))
+
+    def suspend(self, suspended):
+        self.commands.put(("suspend", suspended))
+
+    def stop(self):
+        self.stopped = True
+        self.commands.put(("stop", None))
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            log.error(
+                "hid process didn't stop in %s seconds, terminating", STOP_TIMEOUT
+            )
+            self.process.terminate()
+        self.ready.set()
+        self.notifications.put(("stopped", None))
+        self.ring.unlink()
+
+
+def command_loop(commands):
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            command, payload = commands.get(timeout=PARENT_CHECK_INTERVAL)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                log.error("gui process is gone, stopping hid session")
+                command = "stop"
+            else:
+                continue
+
+        if command == "send":
+            session.send_interactive(payload)
+        elif command == "suspend":
+            session.set_suspended(payload)
+        elif command == "stop":
+            session.stop = True
+            protocol.disable_reporting(session.device)
+            protocol.close(session.device)
+            return
+
+
+def child_main(
+    ring_name,
+    ring_lock,
+    slots,
+    ready,
+    commands,
+    notifications,
+    config_meta,
+    product_id,
+    heartbeat_idle,
+):
+    ring = EventRing.attach(ring_name, ring_lock, slots)
+    session.heartbeat_idle = heartbeat_idle
+
+    def events_received(events):
+        for event in events:
+            ring.push(messages.encode(event))
+        ready.set()
+
+    def wait_for_device():
+        notifications.put(("wait", None))
+
+    def select_device(candidates):
+        notifications.put(("devices", candidates))
+        return session.select_candidate(candidates, product_id)
+
+    def keymaps_update(vial_meta, layers, layout_options):
+        notifications.put(("keymaps", (vial_meta, layers, layout_options)))
+
+    threading.Thread(
+        target=command_loop, args=(commands,), name="hid commands", daemon=True
+    ).start()
+    session.process_loop(
+        config_meta, events_received, wait_for_device, select_device, keymaps_update
+    )
+    ring.close()
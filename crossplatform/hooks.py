@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Script hooks of "hooks" config section, every hook is own bus subscriber, so slow or
+# hanging script delays only its own later runs. Script gets event in environment
+#
+#   QMK_EVENT=layer QMK_LAYER=3 QMK_PREVIOUS_LAYER=0 QMK_CAPS_WORD=0
+#   QMK_EVENT=press QMK_SYMBOL=⏎ QMK_ROW=1 QMK_COL=4 QMK_ACTION=release
+#   QMK_EVENT=device QMK_DEVICE="Corne" QMK_PRODUCT_ID=18003
+#   QMK_EVENT=keymaps QMK_LAYERS=8
+#
+# and is killed when it runs longer than hook timeout.
+
+import logging
+import os
+import subprocess
+
+import bus
+import messages
+
+log = logging.getLogger(__name__)
+
+# layer hooks only care about the layer keyboard ended up on
+LAYER_QUEUE = 1
+# killed script is reaped a bit after its timeout, it's not an overrun of subscriber
+KILL_GRACE = 0.5
+
+
+class ScriptHook:
+    def __init__(self, name, run, timeout, match):
+        self.name = name
+        self.run = run
+        self.timeout = timeout
+        # event -> dict of environment variables or None if hook doesn't fire
+        self.match = match
+
+    def __call__(self, event):
+        variables = self.match(event)
+        if variables is None:
+            return
+        env = dict(os.environ)
+        env.update({f"QMK_{k.upper()}": str(v) for k, v in variables.items()})
+        try:
+            result = subprocess.run(
+                self.run,
+                shell=isinstance(self.run, str),
+                env=env,
+                timeout=self.timeout,
+                stdin=subprocess.DEVNULL,
+            )
+        except subprocess.TimeoutExpired:
+            log.error("hook %s killed after %s seconds", self.name, self.timeout)
+            return
+        except OSError as e:
+            log.error("hook %s failed to start, %s", self.name, e)
+            return
+        if result.returncode != 0:
+            log.error("hook %s exited with %s", self.name, result.returncode)
+
+
+def layer_match(layer):
+    previous = None
+
+    # called only from subscriber thread of the hook
+    def match(state):
+        nonlocal previous
+        changed = state.layer != previous
+        variables = {
+            "event": "layer",
+            "layer": state.layer,
+            "previous_layer": "" if previous is None else previous,
+            "caps_word": state.caps_word,
+        }
+        previous = state.layer
+        if not changed or (layer is not None and state.layer != layer):
+            return None
+        return variables
+
+    return match
+
+
+def press_match(symbol, action):
+    def match(press):
+        if press.action != action or (symbol is not None and press.symbol != symbol):
+            return None
+        return {
+            "event": "press",
+            "symbol": press.symbol,
+            "row": press.row,
+            "col": press.col,
+            "action": press.action,
+        }
+
+    return match
+
+
+def device_match(devices):
+    device = devices.candidates[devices.index]
+    return {
+        "event": "device",
+        "device": device.get("product_string") or "",
+        "product_id": device["product_id"],
+    }
+
+
+def keymaps_match(keymaps):
+    return {
+        "event": "keymaps",
+        "layers": 0 if keymaps.layers is None else len(keymaps.layers),
+    }
+
+
+def start_hooks(event_bus, hooks_config):
+    for idx, hook in enumerate(hooks_config):
+        on = hook.get("on")
+        run = hook.get("run")
+        if run is None:
+            log.error("hook %s has no run command, skipped", idx)
+            continue
+
+        queue_size = hook.get("queue", bus.DEFAULT_QUEUE)
+        if on == "layer":
+            event_type = messages.LayerState
+            match = layer_match(hook.get("layer"))
+            queue_size = hook.get("queue", LAYER_QUEUE)
+        elif on == "press":
+            event_type = messages.Press
+            match = press_match(hook.get("symbol"), hook.get("action", "release"))
+        elif on == "device":
+            event_type = bus.Devices
+            match = device_match
+        elif on == "keymaps":
+            event_type = bus.Keymaps
+            match = keymaps_match
+        else:
+            log.error("hook %s has unknown event %s, skipped", idx, on)
+            continue
+
+        timeout = float(hook.get("timeout", bus.DEFAULT_TIMEOUT))
+        name = hook.get("name", f"hook {idx} on {on}")
+        event_bus.subscribe(
+            event_type,
+            ScriptHook(name, run, timeout, match),
+            name=name,
+            timeout=timeout + KILL_GRACE,
+            queue_size=int(queue_size),
+            policy=hook.get("policy", bus.DROP_OLDEST),
+        )
@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+# KC_TRNS falls through to the same key of the layer below
+TRANSPARENT = 0x0001
+
 labels = {
     0x0004: "A",  # KC_A
     0x0005: "B",  # KC_B
@@ -127,3 +130,19 @@ labels = {
 
 def label_by_qmk_id(id):
     return labels.get(id)
+
+
+# effective labels of every layer, computed once per keymap load. Transparent key takes
+# keycode of the nearest lower layer where the key isn't transparent, layers below are
+# assumed active as with momentary layers stacked over the base one. Every layer dict
+# has every key, None for keycodes without label.
+def layer_labels(layers):
+    table = []
+    resolved = {}
+    for keys in layers:
+        resolved = {
+            pos: resolved.get(pos, code) if code == TRANSPARENT else code
+            for pos, code in keys.items()
+        }
+        table.append({pos: labels.get(code) for pos, code in resolved.items()})
+    return table
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Detects keymap changes made with Vial while app is running. Keymap buffer is sampled
+# chunk by chunk in round robin, one request per CHECK_INTERVAL as background job of
+# scheduler, so requests are sent only when keyboard is idle. Layer with mismatched chunk
+# is fetched again. Every response must echo offset and size of its request (see
+# protocol.load_keymap_buffer), late response to an earlier request is never compared
+# or applied, and reloaded layer replaces keymap only when all its chunks came back.
+
+import logging
+
+import protocol
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1.0
+
+
+class KeymapWatcher:
+    def __init__(self, layers_keymaps, rows, cols, on_change):
+        self.layers_keymaps = layers_keymaps
+        self.rows = rows
+        self.cols = cols
+        self.on_change = on_change
+        self.layer_size = rows * cols * 2
+        self.keymap = protocol.layers_keymaps_to_buffer(layers_keymaps, rows, cols)
+        self.sample_offsets = list(
+            range(0, len(self.keymap), protocol.BUFFER_FETCH_CHUNK)
+        )
+        self.sample_index = 0
+
+    # executed by scheduler with device proxy, events keep flowing while it waits for responses
+    def check(self, device):
+        offset = self.sample_offsets[self.sample_index]
+        self.sample_index = (self.sample_index + 1) % len(self.sample_offsets)
+        size = min(len(self.keymap) - offset, protocol.BUFFER_FETCH_CHUNK)
+
+        chunk = protocol.load_keymap_buffer(
+            device, offset, size, attempts=1, retries=1, retry_delay=0
+        )
+        if chunk is None or len(chunk) != size:
+            log.error("no valid response to keymap check request at %s", offset)
+            return
+        if chunk == self.keymap[offset : offset + size]:
+            return
+
+        log.info("keymap chunk at %s changed on device", offset)
+        first = offset // self.layer_size
+        last = (offset + size - 1) // self.layer_size
+        for layer in range(first, last + 1):
+            self.reload_layer(device, layer)
+
+    def reload_layer(self, device, layer):
+        start = layer * self.layer_size
+        # job runs in reader thread, resending is left to load_keymap_buffer attempts
+        data = protocol.load_keymap_buffer(
+            device, start, self.layer_size, retries=1, retry_delay=0
+        )
+        if data is None or len(data) != self.layer_size:
+            log.error("failed to reload keymap of layer %s", layer)
+            return
+        if data == self.keymap[start : start + self.layer_size]:
+            return
+
+        self.keymap[start : start + self.layer_size] = data
+        keydict = protocol.layer_keymap_from_buffer(
+            self.keymap, layer, self.rows, self.cols
+        )
+        # dict is shared with session cache, it's updated in place
+        self.layers_keymaps[layer].clear()
+        self.layers_keymaps[layer].update(keydict)
+        log.info("layer %s keymap reloaded", layer)
+        self.on_change(layer)
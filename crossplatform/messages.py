@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# companion_hid wire format, the only place where offsets of report fields are defined
+# https://github.com/bskaplou/qmk_modules
+
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+HID_LAYERS_OUT_STATE = 0x89
+HID_LAYERS_OUT_PRESS = 0x90
+HID_LAYERS_OUT_VERSION = 0x91
+HID_LAYERS_OUT_ERROR = 0x92
+
+# message id, layer, caps_word, layer change reporting enabled, press reporting enabled
+STATE = struct.Struct("<BBBBB")
+# message id, unicode code point, row, col, pressed
+PRESS = struct.Struct("<BIBBB")
+# message id, version
+VERSION = struct.Struct("<BB")
+# message id, error code
+ERROR = struct.Struct("<BB")
+
+
+class LayerState:
+    __slots__ = ("layer", "caps_word", "report_change", "report_press")
+
+    def __init__(self, layer, caps_word, report_change=0, report_press=0):
+        self.layer = layer
+        self.caps_word = caps_word
+        self.report_change = report_change
+        self.report_press = report_press
+
+    def __repr__(self):
+        return f"LayerState(layer={self.layer}, caps_word={self.caps_word}, report_change={self.report_change}, report_press={self.report_press})"
+
+
+class Press:
+    __slots__ = ("symbol", "row", "col", "action")
+
+    def __init__(self, symbol, row, col, action):
+        self.symbol = symbol
+        self.row = row
+        self.col = col
+        self.action = action
+
+    def __repr__(self):
+        return f"Press(symbol={self.symbol!r}, row={self.row}, col={self.col}, action={self.action!r})"
+
+
+class Version:
+    __slots__ = ("version",)
+
+    def __init__(self, version):
+        self.version = version
+
+    def __repr__(self):
+        return f"Version(version={self.version})"
+
+
+class Error:
+    __slots__ = ("code",)
+
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return f"Error(code={self.code})"
+
+
+def decode_state(buffer):
+    _, layer, caps_word, report_change, report_press = STATE.unpack_from(buffer)
+    return LayerState(layer, caps_word, report_change, report_press)
+
+
+def decode_press(buffer):
+    _, code_point, row, col, pressed = PRESS.unpack_from(buffer)
+    try:
+        symbol = chr(code_point)
+    except (ValueError, OverflowError):
+        log.error("invalid code point %s in press report", code_point)
+        symbol = ""
+    return Press(symbol, row, col, "press" if pressed != 0 else "release")
+
+
+def decode_version(buffer):
+    return Version(VERSION.unpack_from(buffer)[1])
+
+
+def decode_error(buffer):
+    return Error(ERROR.unpack_from(buffer)[1])
+
+
+DECODERS = {
+    HID_LAYERS_OUT_STATE: decode_state,
+    HID_LAYERS_OUT_PRESS: decode_press,
+    HID_LAYERS_OUT_VERSION: decode_version,
+    HID_LAYERS_OUT_ERROR: decode_error,
+}
+
+
+def decode(buffer):
+    decoder = DECODERS.get(buffer[0])
+    if decoder is None:
+        return None
+    return decoder(buffer)
+
+
+def encode_state(state):
+    return STATE.pack(
+        HID_LAYERS_OUT_STATE,
+        state.layer,
+        state.caps_word,
+        state.report_change,
+        state.report_press,
+    )
+
+
+def encode_press(press):
+    code_point = ord(press.symbol) if len(press.symbol) == 1 else 0
+    pressed = 1 if press.action == "press" else 0
+    return PRESS.pack(HID_LAYERS_OUT_PRESS, code_point, press.row, press.col, pressed)
+
+
+def encode_version(version):
+    return VERSION.pack(HID_LAYERS_OUT_VERSION, version.version)
+
+
+def encode_error(error):
+    return ERROR.pack(HID_LAYERS_OUT_ERROR, error.code)
+
+
+# decoded events are encoded back into report format to cross process boundary
+ENCODERS = {
+    LayerState: encode_state,
+    Press: encode_press,
+    Version: encode_version,
+    Error: encode_error,
+}
+
+# the longest encoded event
+MAX_SIZE = max(STATE.size, PRESS.size, VERSION.size, ERROR.size)
+
+
+def encode(event):
+    return ENCODERS[type(event)](event)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Continuous pointer motion of touchboard. While TB_MOVE key is held longer than hold
+# period pointer moves towards that key from the centre of TB_MOVE cluster, speed grows
+# from min to max speed along acceleration curve during ramp period.
+#
+# Motion thread ticks at fixed rate on absolute deadlines, so sleep overshoot doesn't
+# accumulate. Distance of every tick is computed from real time elapsed since previous
+# one, so when thread or output falls behind missed ticks are coalesced into single move
+# and pointer speed doesn't depend on achieved rate.
+
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CURVE = "quadratic"
+
+# progress of ramp 0..1 -> part of speed range 0..1
+CURVES = {
+    "linear": lambda t: t,
+    "quadratic": lambda t: t * t,
+    "cubic": lambda t: t * t * t,
+    "smoothstep": lambda t: t * t * (3.0 - 2.0 * t),
+}
+
+
+class Motion:
+    __slots__ = ("dx", "dy", "x", "y", "bounds", "started", "last", "position")
+
+    def __init__(self, dx, dy, position, bounds, started):
+        self.dx = dx
+        self.dy = dy
+        self.x, self.y = position
+        self.bounds = bounds
+        self.started = started
+        self.last = started
+        # last position sent to output, None until the first move
+        self.position = None
+
+
+class MotionEngine:
+    # rate in Hz, hold and ramp in seconds, speeds in pixels per second
+    def __init__(self, move, rate, hold, ramp, min_speed, max_speed, curve):
+        self.move = move
+        self.period = 1.0 / rate
+        self.hold = hold
+        self.ramp = ramp
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.curve = CURVES.get(curve)
+        if self.curve is None:
+            log.error("unknown acceleration curve %s, %s is used", curve, DEFAULT_CURVE)
+            self.curve = CURVES[DEFAULT_CURVE]
+
+        self.motion = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.reset_metrics()
+        self.thread = threading.Thread(
+            target=self.run, name="pointer motion", daemon=True
+        )
+        self.thread.start()
+
+    def reset_metrics(self):
+        self.ticks = 0
+        self.moves = 0
+        self.coalesced = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+
+    def speed(self, held):
+        progress = min(1.0, held / self.ramp) if self.ramp > 0 else 1.0
+        return self.min_speed + (self.max_speed - self.min_speed) * self.curve(progress)
+
+    # position is current pointer position, bounds is (x, y, width, height) of desktop
+    def start(self, direction, position, bounds):
+        dx, dy = direction
+        if dx == 0 and dy == 0:
+            return
+        with self.lock:
+            self.reset_metrics()
+            self.motion = Motion(dx, dy, position, bounds, time.perf_counter())
+        self.wakeup.set()
+
+    # returns True if pointer was moved, otherwise key press was a tap
+    def stop(self):
+        with self.lock:
+            motion = self.motion
+            self.motion = None
+        if motion is None or motion.position is None:
+            return False
+
+        duration = motion.last - motion.started - self.hold
+        log.info(
+            "pointer motion %.2fs, %s ticks %.0f Hz, %s moves, %s ticks coalesced, lateness mean %.3f ms max %.3f ms",
+            duration,
+            self.ticks,
+            self.ticks / duration if duration > 0 else 0.0,
+            self.moves,
+            self.coalesced,
+            self.lateness_total * 1000 / max(1, self.ticks),
+            self.lateness_max * 1000,
+        )
+        return True
+
+    def run(self):
+        deadline = None
+        while True:
+            motion = self.motion
+            if motion is None:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                deadline = None
+                continue
+
+            if deadline is None:
+                # nothing moves until hold period is over, tap doesn't wake thread up at all
+                deadline = motion.started + self.hold
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            now = time.perf_counter()
+            with self.lock:
+                if self.motion is not motion:
+                    deadline = None
+                    continue
+                lateness = now - deadline
+                self.lateness_total += lateness
+                self.lateness_max = max(self.lateness_max, lateness)
+                self.ticks += 1
+                self.tick(motion, now)
+
+            deadline += self.period
+            behind = time.perf_counter() - deadline
+            if behind > self.period:
+                # whole periods are skipped, their distance is part of the next tick
+                skipped = math.floor(behind / self.period)
+                with self.lock:
+                    self.coalesced += skipped
+                deadline += skipped * self.period
+
+    def tick(self, motion, now):
+        begin = max(motion.last, motion.started + self.hold)
+        dt = now - begin
+        motion.last = now
+        if dt <= 0:
+            return
+        # speed in the middle of the interval, so integration doesn't depend on rate
+        speed = self.speed((begin + now) / 2 - motion.started - self.hold)
+
+        left, top, width, height = motion.bounds
+        motion.x = min(max(motion.x + motion.dx * speed * dt, left), left + width - 1)
+        motion.y = min(max(motion.y + motion.dy * speed * dt, top), top + height - 1)
+
+        position = (round(motion.x), round(motion.y))
+        if position != motion.position:
+            self.move(*position)
+            motion.position = position
+            self.moves += 1
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Pointer and keyboard output of touchboard and unicode input.
+#
+# pynput works everywhere pynput does (X11 on Linux). uinput creates virtual absolute
+# pointer and keyboard with /dev/uinput, every action is one write of evdev events
+# terminated by single SYN_REPORT, it works with any compositor including Wayland.
+# User needs write access to /dev/uinput (usually group input plus udev rule).
+
+import logging
+import os
+import struct
+
+from pynput.keyboard import Key
+from pynput.mouse import Button
+
+log = logging.getLogger(__name__)
+
+LEFT = "left"
+RIGHT = "right"
+MIDDLE = "middle"
+
+
+class PynputOutput:
+    def __init__(self, mouse, keyboard):
+        self.mouse = mouse
+        self.keyboard = keyboard
+        self.paste_modifier = Key.cmd_l
+        self.buttons = {LEFT: Button.left, RIGHT: Button.right, MIDDLE: Button.middle}
+
+    def move(self, x, y):
+        self.mouse.position = (x, y)
+
+    def press(self, button):
+        self.mouse.press(self.buttons[button])
+
+    def release(self, button):
+        self.mouse.release(self.buttons[button])
+
+    def scroll(self, dy):
+        self.mouse.scroll(0, dy)
+
+    def paste(self):
+        self.keyboard.press(self.paste_modifier)
+        self.keyboard.press("v")
+        self.keyboard.release("v")
+        self.keyboard.release(self.paste_modifier)
+
+    def close(self):
+        pass
+
+
+# linux/uinput.h and linux/input-event-codes.h
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_SET_EVBIT = 0x40045564
+UI_SET_KEYBIT = 0x40045565
+UI_SET_RELBIT = 0x40045566
+UI_SET_ABSBIT = 0x40045567
+
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_REL = 0x02
+EV_ABS = 0x03
+SYN_REPORT = 0
+REL_WHEEL = 0x08
+ABS_X = 0x00
+ABS_Y = 0x01
+
+BTN_LEFT = 0x110
+BTN_RIGHT = 0x111
+BTN_MIDDLE = 0x112
+KEY_LEFTCTRL = 29
+KEY_V = 47
+
+BUS_VIRTUAL = 0x06
+ABS_CNT = 64
+
+# struct input_event, timeval is filled by kernel when zero
+INPUT_EVENT = struct.Struct("llHHi")
+# struct uinput_user_dev: name, input_id, ff_effects_max, absmax, absmin, absfuzz, absflat
+USER_DEV = struct.Struct(f"80sHHHHI{ABS_CNT}i{ABS_CNT}i{ABS_CNT}i{ABS_CNT}i")
+SYN = INPUT_EVENT.pack(0, 0, EV_SYN, SYN_REPORT, 0)
+
+
+def event(type, code, value):
+    return INPUT_EVENT.pack(0, 0, type, code, value)
+
+
+def create_device(name, setup, absmax=None):
+    # fcntl doesn't exist on Windows
+    import fcntl
+
+    fd = os.open("/dev/uinput", os.O_WRONLY | os.O_NONBLOCK)
+    try:
+        for request, value in setup:
+            fcntl.ioctl(fd, request, value)
+
+        absmax_values = [0] * ABS_CNT
+        if absmax is not None:
+            for code, value in absmax.items():
+                absmax_values[code] = value
+        os.write(
+            fd,
+            USER_DEV.pack(
+                name.encode("utf8"),
+                BUS_VIRTUAL,
+                0x1209,
+                0x0001,
+                1,
+                0,
+                *absmax_values,
+                *([0] * ABS_CNT * 3),
+            ),
+        )
+        fcntl.ioctl(fd, UI_DEV_CREATE)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+# pointer is set up like qemu usb tablet (absolute axes, buttons, wheel) which compositors support
+class UinputOutput:
+    # geometry is (x, y, width, height) of virtual desktop, absolute axes cover all of it
+    def __init__(self, geometry):
+        self.origin_x, self.origin_y, width, height = geometry
+        self.buttons = {LEFT: BTN_LEFT, RIGHT: BTN_RIGHT, MIDDLE: BTN_MIDDLE}
+        self.pointer = create_device(
+            "QMK companion pointer",
+            [
+                (UI_SET_EVBIT, EV_KEY),
+                (UI_SET_EVBIT, EV_ABS),
+                (UI_SET_EVBIT, EV_REL),
+                (UI_SET_KEYBIT, BTN_LEFT),
+                (UI_SET_KEYBIT, BTN_RIGHT),
+                (UI_SET_KEYBIT, BTN_MIDDLE),
+                (UI_SET_ABSBIT, ABS_X),
+                (UI_SET_ABSBIT, ABS_Y),
+                (UI_SET_RELBIT, REL_WHEEL),
+            ],
+            {ABS_X: width - 1, ABS_Y: height - 1},
+        )
+        try:
+            self.keyboard = create_device(
+                "QMK companion keyboard",
+                [
+                    (UI_SET_EVBIT, EV_KEY),
+                    (UI_SET_KEYBIT, KEY_LEFTCTRL),
+                    (UI_SET_KEYBIT, KEY_V),
+                ],
+            )
+        except OSError:
+            self.destroy(self.pointer)
+            raise
+        log.info("uinput devices created for desktop %s", geometry)
+
+    def move(self, x, y):
+        os.write(
+            self.pointer,
+            event(EV_ABS, ABS_X, round(x - self.origin_x))
+            + event(EV_ABS, ABS_Y, round(y - self.origin_y))
+            + SYN,
+        )
+
+    def press(self, button):
+        os.write(self.pointer, event(EV_KEY, self.buttons[button], 1) + SYN)
+
+    def release(self, button):
+        os.write(self.pointer, event(EV_KEY, self.buttons[button], 0) + SYN)
+
+    def scroll(self, dy):
+        os.write(self.pointer, event(EV_REL, REL_WHEEL, dy) + SYN)
+
+    def paste(self):
+        # every state change needs own report, otherwise ctrl and v might be seen at once
+        for code, value in (
+            (KEY_LEFTCTRL, 1),
+            (KEY_V, 1),
+            (KEY_V, 0),
+            (KEY_LEFTCTRL, 0),
+        ):
+            os.write(self.keyboard, event(EV_KEY, code, value) + SYN)
+
+    def destroy(self, fd):
+        import fcntl
+
+        try:
+            fcntl.ioctl(fd, UI_DEV_DESTROY)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        # failed destroy of pointer must not leave virtual keyboard behind
+        try:
+            self.destroy(self.pointer)
+        finally:
+            self.destroy(self.keyboard)
+
+
+def create_output(name, mouse, keyboard, geometry):
+    if name == "uinput":
+        try:
+            return UinputOutput(geometry)
+        except OSError as e:
+            log.error("failed to create uinput devices %s, falling back to pynput", e)
+    elif name != "pynput":
+        log.error("unknown output backend %s, pynput is used", name)
+    return PynputOutput(mouse, keyboard)
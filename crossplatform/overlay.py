@@ -1,11 +1,17 @@
+import itertools
 import math
+import threading
+from collections import OrderedDict
+
 from PySide6 import QtCore, QtGui, QtWidgets
-from PySide6.QtCore import Qt, QMargins, QRect, QPoint, QSysInfo
-from PySide6.QtWidgets import QHBoxLayout, QWidget
+from PySide6.QtCore import Qt
 
 
 # FIXME kle seems to be more complex, some ready and tested lib required here
 def keymap_to_positions(keymap, move_buttons_positions, layout_options):
+    # keyboards without Via report no layout options, default variants are shown then
+    if layout_options is None:
+        layout_options = [(0, 0)]
     layout_options = list(map(lambda o: f"{o[0]},{o[1]}", layout_options))
     buttons = {}
     x_margin = 0.25
@@ -77,9 +83,189 @@ def keymap_to_positions(keymap, move_buttons_positions, layout_options):
     return aligned_buttons, max_x - min_x + 0.5 + x_margin * 2.0, max_y - min_y + 0.5
 
 
-class Window(QWidget):
-
-    def __init__(self, app):
+def keymap_positions(keymap):
+    positions = []
+    for line in keymap:
+        for data in line:
+            if not isinstance(data, dict):
+                positions.append(data.split("\n")[0])
+    return positions
+
+
+# TB_MOVE keys grouped in rows by y, every row ordered by x
+def hint_rows(buttons):
+    rows = []
+    for pos, (x, y, w) in sorted(buttons.items(), key=lambda b: (b[1][1], b[1][0])):
+        if len(rows) == 0 or y - rows[-1][0][1] >= HINT_ROW_TOLERANCE:
+            rows.append([])
+        rows[-1].append((x, y, pos))
+    return [[pos for _, _, pos in sorted(row)] for row in rows]
+
+
+def split_rect(rect, rows):
+    x, y, width, height = rect
+    band = height / len(rows)
+    for r, keys in enumerate(rows):
+        cell = width / len(keys)
+        for c, pos in enumerate(keys):
+            yield pos, (x + c * cell, y + r * band, cell, band)
+
+
+# rect is split in regions laid out as TB_MOVE keys, every region is split the same way,
+# (first key, second key) -> (x, y, width, height) of cell, the whole rect is covered
+def hint_grid(buttons, width, height):
+    if len(buttons) == 0:
+        return {}
+    rows = hint_rows(buttons)
+    grid = {}
+    for first, region in split_rect((0.0, 0.0, width, height), rows):
+        for second, cell in split_rect(region, rows):
+            grid[(first, second)] = cell
+    return grid
+
+
+# labels must tell keys apart, key without label or with label of another key gets the
+# first unused letter of HINT_ALPHABET
+def hint_labels(buttons, keymap_labels):
+    labels = {}
+    used = set()
+    for pos in sorted(buttons):
+        label = None if keymap_labels is None else keymap_labels.get(pos)
+        if label and label not in used:
+            labels[pos] = label
+            used.add(label)
+    spare = (
+        code
+        for length in itertools.count(1)
+        for code in map("".join, itertools.product(HINT_ALPHABET, repeat=length))
+        if code not in used
+    )
+    for pos in sorted(buttons):
+        if pos not in labels:
+            labels[pos] = next(spare)
+    return labels
+
+
+# 0.0 is blue for rare keys, 1.0 is red for the most pressed key
+def heat_color(ratio):
+    return QtGui.QColor.fromHsvF((1.0 - ratio) * 0.66, 1.0, 1.0)
+
+
+# dive step zoom transition, 0 disables animation
+DIVE_ANIMATION_DURATION = 80
+# memory for prerendered frames of the next dive step, least recently used are dropped
+FRAME_CACHE_BYTES = 256 * 1024 * 1024
+# TB_MOVE key closer than this (in key units) to the centre of cluster has no direction
+CENTER_RADIUS = 0.5
+# TB_MOVE keys with centres closer than this (in key units) by y make a hint grid row
+HINT_ROW_TOLERANCE = 0.5
+# hint code letters of keys without label
+HINT_ALPHABET = "asdfghjklqwertyuiopzxcvbnm"
+# FIXME 26 is strange macosx constant
+POINTER_OFFSET_Y = 26
+
+# frames of rebuilt scene never match frames of the previous one
+scene_generations = itertools.count(1)
+
+
+# thread safe, only QImage and value classes are used
+def render_frame(shapes, labels, font, transform, size, ratio, show_labels):
+    width, height = size
+    image = QtGui.QImage(
+        round(width * ratio),
+        round(height * ratio),
+        QtGui.QImage.Format_ARGB32_Premultiplied,
+    )
+    image.setDevicePixelRatio(ratio)
+    image.fill(Qt.white)
+    painter = QtGui.QPainter(image)
+    painter.setRenderHints(
+        QtGui.QPainter.Antialiasing | QtGui.QPainter.TextAntialiasing
+    )
+    painter.setTransform(transform)
+    for path, color in shapes:
+        painter.fillPath(path, color)
+    if show_labels:
+        painter.setFont(font)
+        painter.setPen(Qt.black)
+        for rect, text in labels:
+            painter.drawText(rect, Qt.AlignCenter, text)
+    painter.end()
+    return image
+
+
+def transform_key(transform):
+    return (
+        round(transform.m11(), 6),
+        round(transform.m22(), 6),
+        round(transform.dx(), 2),
+        round(transform.dy(), 2),
+    )
+
+
+class FrameCache:
+    # frames are rendered by one background thread, newer request replaces pending one
+
+    def __init__(self, max_bytes=FRAME_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.render_loop, daemon=True)
+        self.thread.start()
+
+    def get(self, key):
+        with self.condition:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+            return frame
+
+    # jobs are (key, render_frame arguments) by priority, jobs which don't fit in the
+    # cache together with previous ones aren't rendered, so frames of one step are never
+    # evicted by each other
+    def request(self, jobs):
+        with self.condition:
+            pending = []
+            size = 0
+            for key, args in jobs:
+                width, height = args[4]
+                ratio = args[5]
+                size += round(width * ratio) * round(height * ratio) * 4
+                if size > self.max_bytes:
+                    break
+                if key in self.frames:
+                    self.frames.move_to_end(key)
+                else:
+                    pending.append((key, args))
+            self.pending = pending
+            self.condition.notify()
+
+    def render_loop(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                key, args = self.pending.pop(0)
+
+            frame = render_frame(*args)
+
+            with self.condition:
+                if key in self.frames:
+                    continue
+                self.frames[key] = frame
+                self.size += frame.sizeInBytes()
+                while self.size > self.max_bytes and len(self.frames) > 1:
+                    _, dropped = self.frames.popitem(last=False)
+                    self.size -= dropped.sizeInBytes()
+
+
+class Window(QtWidgets.QGraphicsView):
+
+    def __init__(
+        self, app, screen, animation_duration=DIVE_ANIMATION_DURATION, frames=None
+    ):
         super().__init__()
         self.setAttribute(Qt.WA_TransparentForMouseEvents)
         # self.setWindowOpacity(0.5)
@@ -88,48 +274,89 @@ class Window(QWidget):
         self.setWindowFlag(QtCore.Qt.NoDropShadowWindowHint, True)
         self.setWindowFlag(Qt.WindowType.ToolTip, True)
         self.app = app
+        self.overlay_screen = screen
+        self.setScreen(screen)
+
+        self.setFrameShape(QtWidgets.QFrame.NoFrame)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setBackgroundBrush(Qt.white)
+        self.setRenderHints(
+            QtGui.QPainter.Antialiasing | QtGui.QPainter.TextAntialiasing
+        )
 
-        self.label = QtWidgets.QLabel()
-        self.keymap_labels = None
-
-        lo = QHBoxLayout()
-        lo.setContentsMargins(QMargins(0, 0, 0, 0))
-        lo.addWidget(self.label)
-        self.setLayout(lo)
+        self.graphics_scene = QtWidgets.QGraphicsScene()
+        self.setScene(self.graphics_scene)
+
+        # keyboard is laid out once in step 0 coordinates, dive only changes transform of root item
+        self.root = None
+        self.labels_root = None
+        self.key_centers = {}
+        self.layout_size = None
+        # prerendered frame is shown instead of root when it's in cache
+        self.frames = frames
+        self.frame_item = None
+        self.generation = 0
+        self.shapes = []
+        self.labels = []
+        self.label_font = None
+        # hint grid is drawn over the keyboard in hints mode, one group per region
+        self.hints_root = None
+        self.hint_groups = {}
+        self.hints = None
 
+        self.keymap_labels = None
+        self.key_colors = None
+        self.buttons = {}
+        self.max_x, self.max_y = 0.0, 0.0
+        self.step = 0
+        self.step_scale = 2.5
+        self.base_transform = QtGui.QTransform()
+        self.base_factor = 1.0
+        self.target_transform = QtGui.QTransform()
+
+        self.animation = QtCore.QVariantAnimation()
+        self.animation.setDuration(animation_duration)
+        self.animation.setStartValue(0.0)
+        self.animation.setEndValue(1.0)
+        self.animation.setEasingCurve(QtCore.QEasingCurve.OutCubic)
+        self.animation.valueChanged.connect(self.animate)
+        self.animation.finished.connect(self.show_frame)
+        self.animation_from = QtGui.QTransform()
+
+    # set_keymap* are called from hid thread, scene is rebuilt lazily in GUI thread
     def set_keymap(self, keymap, move_buttons_positions=None, layout_options=None):
         self.buttons, self.max_x, self.max_y = keymap_to_positions(
             keymap, move_buttons_positions, layout_options
         )
+        self.layout_size = None
 
     def set_keymap_labels(self, labels):
         self.keymap_labels = labels
-
-    def draw_initial(self):
-        self.step = 0
-        self.step_scale = 2.5
-        self.width, self.height = self.app.primaryScreen().size().toTuple()
-        self.setGeometry(0, 0, self.width, self.height)
-        self.draw_overlay(0, 0, self.width, self.height)
-
-    def draw_overlay(self, left, top, width, height):
-        if QSysInfo.kernelType() == "darwin":
-            # Retina!
-            canvas = QtGui.QPixmap(self.width * 2, self.height * 2)
-            canvas.setDevicePixelRatio(2)
-            # End of retina
-        else:
-            canvas = QtGui.QPixmap(self.width, self.height)
-
-        canvas.fill(Qt.white)
-
-        painter = QtGui.QPainter(canvas)
-
-        label_pen = QtGui.QPen()
-        label_pen.setWidth(max(1, math.ceil(4 - self.step)))
-        label_pen.setColor(Qt.black)
-        painter.setPen(label_pen)
-        # painter.drawPoint(left + width /2, top + height / 2) # debug
+        self.layout_size = None
+
+    def set_key_colors(self, colors):
+        self.key_colors = colors
+        self.layout_size = None
+
+    def build_scene(self, width, height):
+        self.graphics_scene.clear()
+        self.root = QtWidgets.QGraphicsRectItem()
+        self.root.setPen(Qt.NoPen)
+        self.graphics_scene.addItem(self.root)
+        self.labels_root = QtWidgets.QGraphicsRectItem(self.root)
+        self.labels_root.setPen(Qt.NoPen)
+        self.labels_root.setZValue(1)
+        self.frame_item = self.graphics_scene.addPixmap(QtGui.QPixmap())
+        self.frame_item.setZValue(2)
+        self.frame_item.setVisible(False)
+        self.generation = next(scene_generations)
+        self.shapes = []
+        self.labels = []
+        self.hints_root = None
+        self.hint_groups = {}
+        self.hints = None
 
         scale_x = width / (self.max_x + 0.3)
         scale_y = height / (self.max_y + 0.3)
@@ -138,55 +365,215 @@ class Window(QWidget):
         dot_size = 0.45 * scale_x
         rounding = dot_size * 0.4
 
-        if self.step < 3:
-            font = painter.font()
-            font.setPixelSize(dot_size * 2 * 0.6)
-            painter.setFont(font)
+        font = QtGui.QFont(self.font())
+        font.setPixelSize(max(1, int(dot_size * 2 * 0.6)))
+        self.label_font = font
 
-        self.button_coordinates = {}
+        self.key_centers = {}
         for pos, (x, y, w) in self.buttons.items():
-            pos_x = left + shift_x + x * scale_x
-            pos_y = top + shift_y + y * scale_y
-            self.button_coordinates[pos] = (
-                pos_x,
-                pos_y,
-            )
-            point = QRect(
-                QPoint(pos_x - dot_size * w, pos_y - dot_size),
-                QPoint(pos_x + dot_size * w, pos_y + dot_size),
-            )
+            pos_x = shift_x + x * scale_x
+            pos_y = shift_y + y * scale_y
+            self.key_centers[pos] = QtCore.QPointF(pos_x, pos_y)
+
             path = QtGui.QPainterPath()
-            path.addRoundedRect(point, rounding, rounding)
-            painter.fillPath(path, Qt.gray)
-
-            if self.keymap_labels is not None and self.step < 3:
-                # if len(self.keymap_labels) > row and len(self.keymap_labels[row]) > col:
-                if self.keymap_labels.get(pos) is not None:
-                    painter.drawText(
-                        pos_x - dot_size,
-                        pos_y - dot_size,
-                        dot_size * 2,
-                        dot_size * 2,
-                        Qt.AlignCenter,
+            path.addRoundedRect(
+                QtCore.QRectF(
+                    pos_x - dot_size * w, pos_y - dot_size, dot_size * w * 2, dot_size * 2
+                ),
+                rounding,
+                rounding,
+            )
+            key = QtWidgets.QGraphicsPathItem(path, self.root)
+            key.setPen(Qt.NoPen)
+            color = QtGui.QColor(Qt.gray)
+            if self.key_colors is not None and pos in self.key_colors:
+                color = QtGui.QColor(self.key_colors[pos])
+            key.setBrush(color)
+            self.shapes.append((path, color))
+
+            if self.keymap_labels is not None and self.keymap_labels.get(pos) is not None:
+                label = QtWidgets.QGraphicsSimpleTextItem(
+                    self.keymap_labels[pos], self.labels_root
+                )
+                label.setFont(font)
+                label.setBrush(Qt.black)
+                bounds = label.boundingRect()
+                label.setPos(
+                    pos_x - bounds.width() / 2, pos_y - bounds.height() / 2
+                )
+                self.labels.append(
+                    (
+                        QtCore.QRectF(label.pos(), bounds.size()),
                         self.keymap_labels[pos],
                     )
+                )
+
+        self.layout_size = (width, height)
+
+    # step 0 keyboard is stretched over layout_rect (whole virtual desktop), each window shows own part of it
+    def draw_initial(self, layout_rect):
+        self.step = 0
+        geometry = self.overlay_screen.geometry()
+        self.setGeometry(geometry)
+        self.graphics_scene.setSceneRect(0, 0, geometry.width(), geometry.height())
+        layout_width, layout_height = layout_rect.size().toTuple()
+        if self.layout_size != (layout_width, layout_height):
+            self.build_scene(layout_width, layout_height)
+
+        self.layout_width, self.layout_height = layout_width, layout_height
+        self.base_factor = min(
+            geometry.width() / layout_width, geometry.height() / layout_height
+        )
+        self.base_transform = QtGui.QTransform.fromTranslate(
+            layout_rect.x() - geometry.x(), layout_rect.y() - geometry.y()
+        )
 
-        painter.end()
-        self.label.setPixmap(canvas)
+        self.animation.stop()
+        self.target_transform = self.base_transform
+        self.root.setTransform(self.target_transform)
+        self.labels_root.setVisible(True)
+        self.show_scene()
+        self.show_frame()
+
+    def build_hints(self, hints, labels):
+        if self.hints_root is not None:
+            self.graphics_scene.removeItem(self.hints_root)
+        self.hints_root = QtWidgets.QGraphicsRectItem()
+        self.hints_root.setPen(Qt.NoPen)
+        self.hints_root.setZValue(3)
+        self.graphics_scene.addItem(self.hints_root)
+        self.hint_groups = {}
+
+        font = QtGui.QFont(self.font())
+        size = min((min(w, h) for _, _, w, h in hints.values()), default=1)
+        font.setPixelSize(max(1, int(size * 0.4)))
+        pen = QtGui.QPen(Qt.gray)
+        pen.setCosmetic(True)
+
+        for (first, second), (x, y, w, h) in hints.items():
+            group = self.hint_groups.get(first)
+            if group is None:
+                group = QtWidgets.QGraphicsRectItem(self.hints_root)
+                group.setPen(Qt.NoPen)
+                self.hint_groups[first] = group
+            cell = QtWidgets.QGraphicsRectItem(x, y, w, h, group)
+            cell.setPen(pen)
+            label = QtWidgets.QGraphicsSimpleTextItem(
+                labels[first] + labels[second], group
+            )
+            label.setFont(font)
+            label.setBrush(Qt.black)
+            bounds = label.boundingRect()
+            label.setPos(
+                x + (w - bounds.width()) / 2, y + (h - bounds.height()) / 2
+            )
+        self.hints = hints
+
+    # hint grid replaces keyboard, it's rebuilt only when grid itself changes
+    def draw_hints(self, layout_rect, hints, labels):
+        self.draw_initial(layout_rect)
+        if self.hints is not hints:
+            self.build_hints(hints, labels)
+        self.root.setVisible(False)
+        if self.frame_item is not None:
+            self.frame_item.setVisible(False)
+        self.hints_root.setTransform(self.base_transform)
+        self.select_hint(None)
+
+    # only cells of region picked by the first key are shown, None shows all of them
+    def select_hint(self, first):
+        for key, group in self.hint_groups.items():
+            group.setVisible(first is None or key == first)
+
+    def key_position(self, row, col):
+        point = self.target_transform.map(self.key_centers[f"{row},{col}"])
+        return point + self.overlay_screen.geometry().topLeft().toPointF()
+
+    def animate(self, value):
+        a, b = self.animation_from, self.target_transform
+        self.root.setTransform(
+            QtGui.QTransform(
+                a.m11() + (b.m11() - a.m11()) * value,
+                0.0,
+                0.0,
+                a.m22() + (b.m22() - a.m22()) * value,
+                a.dx() + (b.dx() - a.dx()) * value,
+                a.dy() + (b.dy() - a.dy()) * value,
+            )
+        )
 
     def mousePressEvent(self, event):
         self.hide()
 
+    def next_transform(self, key):
+        # coordinates are taken from the final transform even if previous step is still animated
+        x, y = self.target_transform.map(self.key_centers[key]).toTuple()
+        factor = self.base_factor / (self.step_scale ** (self.step + 1))
+        width = self.layout_width * factor
+        height = self.layout_height * factor
+        return x, y, QtGui.QTransform(
+            factor, 0.0, 0.0, factor, x - width / 2, y - height / 2
+        )
+
+    def frame_key(self, transform, show_labels):
+        return (self.generation, transform_key(transform), show_labels)
+
+    def frame_job(self, transform, show_labels):
+        return (
+            self.frame_key(transform, show_labels),
+            (
+                self.shapes,
+                self.labels,
+                QtGui.QFont(self.label_font),
+                transform,
+                self.overlay_screen.geometry().size().toTuple(),
+                self.overlay_screen.devicePixelRatio(),
+                show_labels,
+            ),
+        )
+
+    # frames of the current step and of next dive step of every TB_MOVE key
+    def frame_jobs(self, keys=None):
+        if self.frames is None or self.root is None:
+            return []
+        jobs = [self.frame_job(self.target_transform, self.step < 3)]
+        for key in self.buttons if keys is None else keys:
+            jobs.append(self.frame_job(self.next_transform(key)[2], self.step + 1 < 3))
+        return jobs
+
+    def show_frame(self):
+        if self.frames is None or self.frame_item is None:
+            return
+        frame = self.frames.get(self.frame_key(self.target_transform, self.step < 3))
+        if frame is None:
+            return
+        self.frame_item.setPixmap(QtGui.QPixmap.fromImage(frame))
+        self.frame_item.setVisible(True)
+        self.root.setVisible(False)
+
+    def show_scene(self):
+        if self.frame_item is not None:
+            self.frame_item.setVisible(False)
+        self.root.setVisible(True)
+
     def dive(self, row, col):
         key = f"{row},{col}"
-        x, y = self.button_coordinates[key]
+        x, y, self.target_transform = self.next_transform(key)
         self.step = self.step + 1
-        width = self.width / (self.step_scale**self.step)
-        height = self.height / (self.step_scale**self.step)
-        self.draw_overlay(x - width / 2, y - height / 2, width, height)
 
-        # FIXME 26 is strange macosx constant
-        return x, y + 26
+        self.animation.stop()
+        self.animation_from = self.root.transform()
+        self.labels_root.setVisible(self.step < 3)
+        if self.animation.duration() > 0 and self.isVisible():
+            self.show_scene()
+            self.animation.start()
+        else:
+            self.root.setTransform(self.target_transform)
+            self.show_scene()
+            self.show_frame()
+
+        origin = self.overlay_screen.geometry().topLeft()
+        return x + origin.x(), y + origin.y() + POINTER_OFFSET_Y
 
     def mouseDoubleClickEvent(self, event):
         self.hide()
@@ -199,3 +586,194 @@ class Window(QWidget):
     def show(self):
         self.setWindowOpacity(0.5)
         super().show()
+
+
+class Touchboard:
+    # one overlay window per screen, the first dive picks the screen and others are hidden
+
+    def __init__(
+        self,
+        app,
+        animation_duration=DIVE_ANIMATION_DURATION,
+        prerender=True,
+        hints=False,
+    ):
+        self.app = app
+        self.animation_duration = animation_duration
+        # hints mode shows hint grid instead of keyboard and never dives
+        self.hints_mode = hints
+        self.frames = FrameCache() if prerender and not hints else None
+        # hint grid over the whole virtual desktop, built once per keymap and desktop
+        self.hints = None
+        self.hints_size = None
+        self.hint_labels = None
+        self.hint_first = None
+        self.keymap = None
+        self.keymap_labels = None
+        self.key_colors = None
+        self.windows = []
+        self.active = None
+        self.visible = False
+        self.create_windows()
+        app.screenAdded.connect(self.create_windows)
+        app.screenRemoved.connect(self.create_windows)
+
+    def create_windows(self, *args):
+        for window in self.windows:
+            window.hide()
+            window.deleteLater()
+
+        self.windows = [
+            Window(self.app, screen, self.animation_duration, self.frames)
+            for screen in self.app.screens()
+        ]
+        self.active = None
+        if self.keymap is not None:
+            self.set_keymap(*self.keymap)
+        if self.keymap_labels is not None:
+            self.set_keymap_labels(self.keymap_labels)
+        if self.key_colors is not None:
+            self.set_key_colors(self.key_colors)
+        if self.visible:
+            self.draw_initial()
+            self.show()
+
+    def set_keymap(self, keymap, move_buttons_positions=None, layout_options=None):
+        self.keymap = (keymap, move_buttons_positions, layout_options)
+        self.hints = None
+        for window in self.windows:
+            window.set_keymap(keymap, move_buttons_positions, layout_options)
+
+    def set_keymap_labels(self, labels):
+        self.keymap_labels = labels
+        self.hints = None
+        for window in self.windows:
+            window.set_keymap_labels(labels)
+
+    def set_key_colors(self, colors):
+        self.key_colors = colors
+        for window in self.windows:
+            window.set_key_colors(colors)
+
+    def draw_initial(self):
+        self.active = None
+        layout_rect = self.app.primaryScreen().virtualGeometry()
+        if self.hints_mode:
+            self.draw_hints(layout_rect)
+            return
+        for window in self.windows:
+            window.draw_initial(layout_rect)
+            if self.visible:
+                window.show()
+        self.prerender()
+
+    def draw_hints(self, layout_rect):
+        self.hint_first = None
+        if len(self.windows) == 0:
+            return
+        size = layout_rect.size().toTuple()
+        if self.hints is None or self.hints_size != size:
+            buttons = self.windows[0].buttons
+            self.hints = hint_grid(buttons, *size)
+            self.hints_size = size
+            self.hint_labels = hint_labels(buttons, self.keymap_labels)
+        for window in self.windows:
+            window.draw_hints(layout_rect, self.hints, self.hint_labels)
+            if self.visible:
+                window.show()
+
+    # hints mode, the first press picks region and the second one moves pointer to the
+    # centre of its cell, returns None until position is known
+    def hint(self, row, col):
+        key = f"{row},{col}"
+        if self.hints is None:
+            return None
+        if self.hint_first is None:
+            self.hint_first = key
+            for window in self.windows:
+                window.select_hint(key)
+            return None
+
+        cell = self.hints.get((self.hint_first, key))
+        self.hint_first = None
+        for window in self.windows:
+            window.select_hint(None)
+        if cell is None:
+            return None
+        x, y, width, height = cell
+        origin = self.app.primaryScreen().virtualGeometry().topLeft()
+        return (
+            origin.x() + x + width / 2,
+            origin.y() + y + height / 2 + POINTER_OFFSET_Y,
+        )
+
+    # called as soon as keymap is loaded, so activation of overlay shows ready frame
+    def prepare(self):
+        if self.keymap is not None and not self.visible:
+            self.draw_initial()
+
+    def nearest_window(self, row, col):
+        point = self.windows[0].key_position(row, col)
+        return min(
+            self.windows,
+            key=lambda w: distance_to_rect(point, w.overlay_screen.geometry()),
+        )
+
+    # unit vector from the centre of TB_MOVE cluster to the key, (0, 0) for central key
+    def direction(self, row, col):
+        buttons = self.windows[0].buttons if len(self.windows) > 0 else {}
+        button = buttons.get(f"{row},{col}")
+        if button is None:
+            return 0.0, 0.0
+        center_x = sum(b[0] for b in buttons.values()) / len(buttons)
+        center_y = sum(b[1] for b in buttons.values()) / len(buttons)
+        dx, dy = button[0] - center_x, button[1] - center_y
+        length = math.hypot(dx, dy)
+        if length < CENTER_RADIUS:
+            return 0.0, 0.0
+        return dx / length, dy / length
+
+    def prerender(self):
+        if self.frames is None or len(self.windows) == 0:
+            return
+        if self.active is not None:
+            self.frames.request(self.active.frame_jobs())
+            return
+
+        # first dive picks the window, so each key is prerendered only on its own screen
+        keys = {window: [] for window in self.windows}
+        for key in self.windows[0].buttons:
+            row, col = key.split(",")
+            keys[self.nearest_window(row, col)].append(key)
+        jobs = []
+        for window, window_keys in keys.items():
+            jobs.extend(window.frame_jobs(window_keys))
+        self.frames.request(jobs)
+
+    def dive(self, row, col):
+        if self.active is None:
+            self.active = self.nearest_window(row, col)
+            for window in self.windows:
+                if window is not self.active:
+                    window.hide()
+
+        position = self.active.dive(row, col)
+        self.prerender()
+        return position
+
+    def show(self):
+        self.visible = True
+        for window in self.windows:
+            if self.active is None or window is self.active:
+                window.show()
+
+    def hide(self):
+        self.visible = False
+        for window in self.windows:
+            window.hide()
+
+
+def distance_to_rect(point, rect):
+    dx = max(rect.left() - point.x(), 0, point.x() - rect.right())
+    dy = max(rect.top() - point.y(), 0, point.y() - rect.bottom())
+    return dx * dx + dy * dy
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Offscreen rendering benchmark of touchboard overlay, prints comparable json.
+#
+#   python overlay_benchmark.py > before.json
+#   python overlay_benchmark.py --definition vial-qmk/keyboards/crkbd/keymaps/vial/vial.json
+#
+# Every screen setup runs in own process with QT_QPA_PLATFORM=offscreen and screen
+# geometry from offscreen config file, so peak RSS is per screen. Built-in layouts
+# follow vial.json of split (Corne), full size (ANSI 104) and thumb cluster (Ergodox)
+# keyboards, real definitions are added with --definition. keymap_to_positions ignores
+# key rotation, so thumb clusters are measured unrotated.
+#
+# Prerender memory is measured with real FrameCache fed by frame jobs of TB_MOVE
+# cluster along the dive chain, as cache size and growth of resident memory.
+#
+# Presses-to-target compares dive and hints modes on TB_MOVE cluster of MOVE_KEYS
+# central keys. Hints reach every target in two presses with error up to half diagonal
+# of its cell, dive is replayed greedily towards the target until pointer is as close.
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from PySide6 import __version__ as pyside_version
+from PySide6.QtWidgets import QApplication
+
+import overlay
+
+log = logging.getLogger(__name__)
+
+SCREENS = {
+    "1080p": (1920, 1080, 1.0),
+    "4k": (3840, 2160, 1.0),
+    "1080p@2x": (1920, 1080, 2.0),
+}
+LABEL_SETS = ("none", "short", "long")
+DIVE_STEPS = 4
+REPEAT = 5
+MOVE_KEYS = 15
+TARGETS = 500
+MAX_DIVE_PRESSES = 8
+
+
+def split_keymap():
+    keymap = []
+    for row in range(3):
+        left = [f"{row},{col}" for col in range(6)]
+        right = [f"{row + 4},{col}" for col in range(5, -1, -1)]
+        keymap.append(left + [{"x": 3}] + right)
+    keymap.append(
+        [{"x": 3.5}, "3,3", "3,4", "3,5", {"x": 1}, "7,5", "7,4", "7,3"]
+    )
+    return keymap
+
+
+def full_size_keymap():
+    # ansi 104 keys, widths and gaps as in keyboard-layout-editor presets
+    rows = [
+        [1, {"x": 1}, 1, 1, 1, 1, {"x": 0.5}, 1, 1, 1, 1, {"x": 0.5}, 1, 1, 1, 1]
+        + [{"x": 0.25}, 1, 1, 1],
+        [{"y": 0.5}] + [1] * 13 + [{"w": 2}, 1, {"x": 0.25}, 1, 1, 1]
+        + [{"x": 0.25}, 1, 1, 1, 1],
+        [{"w": 1.5}, 1] + [1] * 12 + [{"w": 1.5}, 1, {"x": 0.25}, 1, 1, 1]
+        + [{"x": 0.25}, 1, 1, 1, {"h": 2}, 1],
+        [{"w": 1.75}, 1] + [1] * 11 + [{"w": 2.25}, 1, {"x": 3.5}, 1, 1, 1],
+        [{"w": 2.25}, 1] + [1] * 10 + [{"w": 2.75}, 1, {"x": 1.25}, 1]
+        + [{"x": 1.25}, 1, 1, 1, {"h": 2}, 1],
+        [{"w": 1.25}, 1, {"w": 1.25}, 1, {"w": 1.25}, 1, {"w": 6.25}, 1]
+        + [{"w": 1.25}, 1, {"w": 1.25}, 1, {"w": 1.25}, 1, {"w": 1.25}, 1]
+        + [{"x": 0.25}, 1, 1, 1, {"x": 0.25, "w": 2}, 1, 1],
+    ]
+    return numbered(rows)
+
+
+def thumb_cluster_keymap():
+    rows = [
+        [{"w": 1.5}, 1, 1, 1, 1, 1, 1, 1, {"x": 4.5}, 1, 1, 1, 1, 1, 1, {"w": 1.5}, 1],
+        [{"w": 1.5}, 1, 1, 1, 1, 1, 1, {"h": 1.5}, 1, {"x": 4.5, "h": 1.5}, 1]
+        + [1, 1, 1, 1, 1, {"w": 1.5}, 1],
+        [{"w": 1.5}, 1, 1, 1, 1, 1, 1, {"x": 6.5}, 1, 1, 1, 1, 1, {"w": 1.5}, 1],
+        [{"w": 1.5}, 1, 1, 1, 1, 1, 1, {"h": 1.5}, 1, {"x": 4.5, "h": 1.5}, 1]
+        + [1, 1, 1, 1, 1, {"w": 1.5}, 1],
+        [{"x": 0.5}, 1, 1, 1, 1, 1, {"x": 8.5}, 1, 1, 1, 1, 1],
+        [{"y": -1, "x": 0.5}, 1, 1],
+        [{"h": 2}, 1, {"h": 2}, 1, 1],
+        [{"x": 2}, 1],
+        [{"y": -1, "x": -3}, 1, 1],
+        [{"x": -3}, 1, {"h": 2}, 1, {"h": 2}, 1],
+        [{"x": -3}, 1],
+    ]
+    return numbered(rows)
+
+
+# 1 in rows is a key, keys get matrix positions row by row
+def numbered(rows):
+    keymap = []
+    for row, line in enumerate(rows):
+        col = 0
+        keys = []
+        for item in line:
+            if isinstance(item, dict):
+                keys.append(item)
+            else:
+                keys.append(f"{row},{col}")
+                col += 1
+        keymap.append(keys)
+    return keymap
+
+
+def builtin_layouts():
+    return {
+        "split": split_keymap(),
+        "full-size": full_size_keymap(),
+        "thumb-cluster": thumb_cluster_keymap(),
+    }
+
+
+def load_definition(path):
+    with open(path, "r") as f:
+        return json.loads(f.read())["layouts"]["keymap"]
+
+
+def labels(positions, label_set):
+    if label_set == "none":
+        return None
+    if label_set == "short":
+        return {pos: chr(0x41 + i % 26) for i, pos in enumerate(positions)}
+    return {pos: f"LT({i % 16},KC_{i})" for i, pos in enumerate(positions)}
+
+
+def milliseconds(samples):
+    return round(statistics.median(samples) * 1000, 3)
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macosx, kilobytes on linux
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+# resident memory now, linux only, growth of one layout doesn't show in peak RSS
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+# blocks until frames of the last request are rendered, capped jobs aren't waited for
+def wait_rendered(cache, timeout=60.0):
+    with cache.condition:
+        expected = [key for key, _ in cache.pending]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with cache.condition:
+            if all(key in cache.frames for key in expected):
+                return True
+        time.sleep(0.005)
+    log.error("frame cache didn't render %s frames in %ss", len(expected), timeout)
+    return False
+
+
+def benchmark_prerender(app, keymap, label_set, layout_rect):
+    cluster = move_cluster(keymap)
+    cache = overlay.FrameCache()
+    screen = app.primaryScreen()
+    window = overlay.Window(app, screen, animation_duration=0, frames=cache)
+    window.set_keymap(keymap, cluster, None)
+    window.set_keymap_labels(labels(cluster, label_set))
+    window.draw_initial(layout_rect)
+    window.grab()
+
+    rss_before = current_rss_kb()
+    jobs = 0
+    cache_peak = 0
+    cached_peak = 0
+    start = time.perf_counter()
+    for _ in range(DIVE_STEPS):
+        step_jobs = window.frame_jobs()
+        jobs = max(jobs, len(step_jobs))
+        cache.request(step_jobs)
+        wait_rendered(cache)
+        with cache.condition:
+            cache_peak = max(cache_peak, cache.size)
+            cached_peak = max(cached_peak, len(cache.frames))
+        row, col = central_key(window).split(",")
+        window.dive(row, col)
+        window.grab()
+    elapsed = time.perf_counter() - start
+    rss_after = current_rss_kb()
+
+    window.deleteLater()
+    # frames are released, next layout starts with empty cache
+    with cache.condition:
+        cache.pending = []
+        cache.frames.clear()
+        cache.size = 0
+
+    return {
+        "prerender_jobs": jobs,
+        "prerender_cached_frames": cached_peak,
+        "prerender_chain_ms": round(elapsed * 1000, 3),
+        "frame_cache_peak_bytes": cache_peak,
+        "prerender_rss_growth_kb": (
+            None if rss_before is None else rss_after - rss_before
+        ),
+    }
+
+
+# key nearest to the centre of the screen, dive chain stays inside the keyboard
+def central_key(window):
+    center = window.rect().center().toPointF()
+    return min(
+        window.key_centers,
+        key=lambda k: (window.target_transform.map(window.key_centers[k]) - center)
+        .manhattanLength(),
+    )
+
+
+def benchmark_layout(app, name, keymap, label_set, repeat):
+    positions = overlay.keymap_positions(keymap)
+    result = {"layout": name, "keys": len(positions), "labels": label_set}
+
+    result["keymap_to_positions_ms"] = milliseconds(
+        timed(lambda: overlay.keymap_to_positions(keymap, positions, None), repeat)
+    )
+
+    screen = app.primaryScreen()
+    window = overlay.Window(app, screen, animation_duration=0)
+    window.set_keymap(keymap, positions, None)
+    window.set_keymap_labels(labels(positions, label_set))
+    layout_rect = screen.virtualGeometry()
+
+    # the first draw builds scene, frame time includes painting of the whole view
+    start = time.perf_counter()
+    window.draw_initial(layout_rect)
+    window.grab()
+    result["draw_initial_cold_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+    def draw_initial():
+        window.draw_initial(layout_rect)
+        window.grab()
+
+    result["draw_initial_ms"] = milliseconds(timed(draw_initial, repeat))
+
+    # dive chain is replayed from initial step, every step is measured separately
+    dive_samples = [[] for _ in range(DIVE_STEPS)]
+    render_samples = []
+    frame_bytes = 0
+    for _ in range(repeat):
+        window.draw_initial(layout_rect)
+        for step in range(DIVE_STEPS):
+            row, col = central_key(window).split(",")
+
+            # background render of one frame of this step, as FrameCache does it
+            _, args = window.frame_job(
+                window.next_transform(f"{row},{col}")[2], window.step + 1 < 3
+            )
+            start = time.perf_counter()
+            frame = overlay.render_frame(*args)
+            render_samples.append(time.perf_counter() - start)
+            frame_bytes = frame.sizeInBytes()
+
+            start = time.perf_counter()
+            window.dive(row, col)
+            window.grab()
+            dive_samples[step].append(time.perf_counter() - start)
+
+    result["dive_ms"] = [milliseconds(samples) for samples in dive_samples]
+    result["render_frame_ms"] = milliseconds(render_samples)
+    result["frame_bytes"] = frame_bytes
+    # backing store of the window, image of the whole screen in device pixels
+    result["backing_store_bytes"] = window.grab().toImage().sizeInBytes()
+    window.deleteLater()
+
+    result.update(benchmark_prerender(app, keymap, label_set, layout_rect))
+    return result
+
+
+# keys nearest to the centre of layout, as TB_MOVE area usually is
+def move_cluster(keymap):
+    positions = overlay.keymap_positions(keymap)
+    buttons, width, height = overlay.keymap_to_positions(keymap, positions, None)
+    return sorted(
+        buttons,
+        key=lambda k: abs(buttons[k][0] - width / 2) + abs(buttons[k][1] - height / 2),
+    )[:MOVE_KEYS]
+
+
+# error of pointer at the centre of target cell and half diagonal of the cell
+def hint_error(hints, target):
+    tx, ty = target
+    for x, y, w, h in hints.values():
+        if x <= tx <= x + w and y <= ty <= y + h:
+            return math.hypot(x + w / 2 - tx, y + h / 2 - ty), math.hypot(w, h) / 2
+    return None
+
+
+# greedy dive, every press picks key which lands nearest to target
+def dive_presses(window, layout_rect, target, tolerance):
+    window.draw_initial(layout_rect)
+    error_2 = None
+    for presses in range(1, MAX_DIVE_PRESSES + 1):
+        best = None
+        for key in window.key_centers:
+            x, y, _ = window.next_transform(key)
+            error = math.hypot(x - target[0], y - target[1])
+            if best is None or error < best[0]:
+                best = (error, key)
+        error, key = best
+        row, col = key.split(",")
+        window.dive(row, col)
+        if presses == 2:
+            error_2 = error
+        if error <= tolerance:
+            return presses, error_2 if error_2 is not None else error
+    return None, error_2
+
+
+def benchmark_addressing(app, name, keymap, repeat):
+    cluster = move_cluster(keymap)
+    screen = app.primaryScreen()
+    layout_rect = screen.virtualGeometry()
+    width, height = layout_rect.size().toTuple()
+    buttons, _, _ = overlay.keymap_to_positions(keymap, cluster, None)
+    result = {"layout": name, "move_keys": len(cluster)}
+
+    result["hint_grid_ms"] = milliseconds(
+        timed(lambda: overlay.hint_grid(buttons, width, height), repeat)
+    )
+    hints = overlay.hint_grid(buttons, width, height)
+    labels = overlay.hint_labels(buttons, None)
+    result["hint_cells"] = len(hints)
+
+    window = overlay.Window(app, screen, animation_duration=0)
+    window.set_keymap(keymap, cluster, None)
+    start = time.perf_counter()
+    window.draw_hints(layout_rect, hints, labels)
+    window.grab()
+    result["draw_hints_cold_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+    def draw_hints():
+        window.draw_hints(layout_rect, hints, labels)
+        window.grab()
+
+    result["draw_hints_ms"] = milliseconds(timed(draw_hints, repeat))
+
+    def select_hint():
+        window.select_hint(next(iter(window.hint_groups)))
+        window.grab()
+
+    result["select_hint_ms"] = milliseconds(timed(select_hint, repeat))
+
+    generator = random.Random(0)
+    targets = [
+        (generator.uniform(0, width), generator.uniform(0, height))
+        for _ in range(TARGETS)
+    ]
+    hint_errors = []
+    dive = []
+    for target in targets:
+        error, tolerance = hint_error(hints, target)
+        hint_errors.append(error)
+        dive.append(dive_presses(window, layout_rect, target, tolerance))
+    reached = [presses for presses, _ in dive if presses is not None]
+
+    result["hint_presses"] = 2
+    result["hint_error_px_mean"] = round(statistics.mean(hint_errors), 1)
+    result["hint_error_px_max"] = round(max(hint_errors), 1)
+    result["dive_presses_mean"] = (
+        round(statistics.mean(reached), 2) if len(reached) > 0 else None
+    )
+    result["dive_presses_max"] = max(reached, default=None)
+    result["dive_unreached"] = len(targets) - len(reached)
+    result["dive_error_2_px_mean"] = round(
+        statistics.mean(error for _, error in dive if error is not None), 1
+    )
+
+    window.deleteLater()
+    return result
+
+
+def run_screen(screen_name, layouts, repeat):
+    app = QApplication([])
+    width, height, ratio = SCREENS[screen_name]
+    results = []
+    for name, keymap in layouts.items():
+        for label_set in LABEL_SETS:
+            log.info(
+                "benchmarking %s with %s labels on %s", name, label_set, screen_name
+            )
+            result = benchmark_layout(app, name, keymap, label_set, repeat)
+            result.update(
+                {"screen": screen_name, "width": width, "height": height, "dpr": ratio}
+            )
+            results.append(result)
+            app.processEvents()
+
+    addressing = []
+    for name, keymap in layouts.items():
+        log.info("benchmarking presses to target of %s on %s", name, screen_name)
+        result = benchmark_addressing(app, name, keymap, repeat)
+        result.update({"screen": screen_name, "width": width, "height": height})
+        addressing.append(result)
+        app.processEvents()
+
+    for result in results:
+        result["peak_rss_kb"] = peak_rss_kb()
+    return {"pyside": pyside_version, "results": results, "addressing": addressing}
+
+
+def spawn_screen(screen_name, arguments):
+    width, height, ratio = SCREENS[screen_name]
+    screen = {
+        "name": screen_name,
+        "x": 0,
+        "y": 0,
+        "width": width,
+        "height": height,
+        "logicalDpi": 96,
+        "logicalBaseDpi": 96,
+        "dpr": ratio,
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        f.write(json.dumps({"screens": [screen]}))
+        config_path = f.name
+    try:
+        env = dict(os.environ, QT_QPA_PLATFORM=f"offscreen:configfile={config_path}")
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--screen", screen_name]
+            + arguments,
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+    finally:
+        os.unlink(config_path)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="touchboard overlay benchmark")
+    parser.add_argument(
+        "--definition",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="via.json or vial.json to benchmark besides built-in layouts",
+    )
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument(
+        "--screens",
+        default=",".join(SCREENS),
+        help="comma separated subset of %s" % ", ".join(SCREENS),
+    )
+    parser.add_argument("--output", metavar="FILE", help="json file, stdout if omitted")
+    # internal, benchmark of one screen in offscreen child process
+    parser.add_argument("--screen", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.screen is not None:
+        layouts = builtin_layouts()
+        for path in args.definition:
+            layouts[path] = load_definition(path)
+        sys.stdout.write(json.dumps(run_screen(args.screen, layouts, args.repeat)))
+        return
+
+    arguments = ["--repeat", str(args.repeat)]
+    for path in args.definition:
+        arguments += ["--definition", os.path.abspath(path)]
+
+    report = {"python": sys.version.split()[0], "results": [], "addressing": []}
+    for screen_name in args.screens.split(","):
+        screen_report = spawn_screen(screen_name, arguments)
+        report["pyside"] = screen_report["pyside"]
+        report["results"].extend(screen_report["results"])
+        report["addressing"].extend(screen_report["addressing"])
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        log.info("benchmark written to %s", args.output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(encoding="utf-8", level=logging.INFO)
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Session lock monitor, no Qt here. While user session is locked (optionally idle as
+# well) keyboard reporting is turned off, so neither USB nor reader thread wake up on
+# every key press and layer change nobody sees. Lock state comes from:
+#
+#   logind       Lock/Unlock signals and LockedHint changes of the session, read from
+#                gdbus monitor, nothing is polled
+#   logind-poll  loginctl show-session $XDG_SESSION_ID --property=LockedHint, polled
+#   file:PATH    local stand-in, session is locked while PATH exists, polled
+#
+#   touch /tmp/qmk-locked; rm /tmp/qmk-locked
+
+import logging
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import threading
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 10.0
+LOGINCTL_TIMEOUT = 1.0
+# gdbus monitor which exited (logind restart) is started again after this delay
+MONITOR_RESTART_DELAY = 5.0
+SESSION_PATH = "/org/freedesktop/login1/session/"
+PROPERTY_CHANGE = re.compile(r"'(LockedHint|IdleHint)': <(true|false)>")
+
+
+class LogindSource:
+    def __init__(self, idle=False):
+        self.session = os.environ.get("XDG_SESSION_ID", "auto")
+        self.properties = ["LockedHint"]
+        if idle:
+            self.properties.append("IdleHint")
+
+    def __repr__(self):
+        return f"LogindSource(session={self.session}, properties={self.properties})"
+
+    # True if locked, None if state is unknown
+    def __call__(self):
+        hints = self.hints()
+        return None if hints is None else any(hints.values())
+
+    # property -> bool or None if state is unknown
+    def hints(self):
+        try:
+            output = subprocess.run(
+                ["loginctl", "show-session", self.session]
+                + [f"--property={p}" for p in self.properties],
+                capture_output=True,
+                text=True,
+                timeout=LOGINCTL_TIMEOUT,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error("failed to get session lock state, %s", e)
+            return None
+        return {
+            name: value == "yes"
+            for name, _, value in (line.partition("=") for line in output.splitlines())
+        }
+
+
+# escaped as sd_bus_path_encode does, session "2" is /org/freedesktop/login1/session/_32
+def session_path(session_id):
+    encoded = "".join(
+        c if c.isascii() and (c.isalpha() or c.isdigit() and i > 0) else f"_{ord(c):x}"
+        for i, c in enumerate(session_id)
+    )
+    return SESSION_PATH + encoded
+
+
+class LogindSignalSource:
+    def __init__(self, idle=False):
+        self.idle = idle
+        self.poll = LogindSource(idle)
+        self.hints = {}
+        self.process = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"LogindSignalSource(session={self.poll.session}, idle={self.idle})"
+
+    def session_id(self):
+        try:
+            return subprocess.run(
+                ["loginctl", "show-session", self.poll.session, "--property=Id"],
+                capture_output=True,
+                text=True,
+                timeout=LOGINCTL_TIMEOUT,
+                check=True,
+            ).stdout.strip()[len("Id=") :]
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error("failed to get session id, %s", e)
+            return None
+
+    # blocks until stopped, callback gets True if locked
+    def watch(self, callback, stopped):
+        while not stopped.is_set():
+            session_id = self.session_id()
+            if session_id:
+                self.monitor(session_path(session_id), callback, stopped)
+            stopped.wait(MONITOR_RESTART_DELAY)
+
+    def monitor(self, path, callback, stopped):
+        with self.lock:
+            if stopped.is_set():
+                return
+            try:
+                self.process = subprocess.Popen(
+                    [
+                        "gdbus",
+                        "monitor",
+                        "--system",
+                        "--dest",
+                        "org.freedesktop.login1",
+                        "--object-path",
+                        path,
+                    ],
+                    stdout=subprocess.PIPE,
+                    stdin=subprocess.DEVNULL,
+                    text=True,
+                )
+            except OSError as e:
+                log.error("failed to start gdbus monitor, %s", e)
+                return
+        log.info("lock monitor listens to %s", path)
+
+        # signals sent before monitor started are missed, state is read once
+        hints = self.poll.hints()
+        if hints is not None:
+            self.hints = hints
+            callback(any(hints.values()))
+        for line in self.process.stdout:
+            if ".Session.Lock " in line:
+                self.hints["LockedHint"] = True
+            elif ".Session.Unlock " in line:
+                self.hints["LockedHint"] = False
+            else:
+                changed = False
+                for name, value in PROPERTY_CHANGE.findall(line):
+                    if name in self.poll.properties:
+                        self.hints[name] = value == "true"
+                        changed = True
+                if not changed:
+                    continue
+            callback(any(self.hints.values()))
+
+        self.process.wait()
+        if not stopped.is_set():
+            log.error("gdbus monitor exited with %s", self.process.returncode)
+
+    def stop(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                self.process.terminate()
+
+
+class FileSource:
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return f"FileSource(path={self.path})"
+
+    def __call__(self):
+        return os.path.exists(self.path)
+
+
+def create_source(name, idle=False):
+    if name == "off":
+        return None
+    if name.startswith("file:"):
+        return FileSource(name[len("file:") :])
+    if name == "logind-poll":
+        if shutil.which("loginctl") is None:
+            log.error("loginctl not found, lock monitor is off")
+            return None
+        return LogindSource(idle)
+    if name in ("auto", "logind"):
+        if shutil.which("loginctl") is None or shutil.which("gdbus") is None:
+            if name == "logind":
+                log.error("loginctl or gdbus not found, lock monitor is off")
+            return None
+        return LogindSignalSource(idle)
+    log.error("unknown lock monitor %s, lock monitor is off", name)
+    return None
+
+
+class LockMonitor:
+    def __init__(self, source, callback, interval=POLL_INTERVAL):
+        self.source = source
+        self.callback = callback
+        self.interval = interval
+        self.locked = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="lock monitor", daemon=True
+        )
+        self.thread.start()
+        log.info("lock monitor started with %s", self.source)
+
+    def stop(self):
+        self.stopped.set()
+        if hasattr(self.source, "stop"):
+            self.source.stop()
+
+    def run(self):
+        if hasattr(self.source, "watch"):
+            self.source.watch(self.update, self.stopped)
+            return
+        while not self.stopped.is_set():
+            self.update(self.source())
+            self.stopped.wait(self.interval)
+
+    def update(self, locked):
+        if locked is not None and locked != self.locked:
+            self.locked = locked
+            log.info("session is %s", "locked" if locked else "unlocked")
+            self.callback(locked)
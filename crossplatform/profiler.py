@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Sampling profiler for --profile mode. Stacks of all threads (GUI, HID reader, workers)
+# are taken with sys._current_frames every INTERVAL and counted as folded stacks
+#
+#   thread;subsystem;module:function;module:function count
+#
+# which is the input format of flamegraph.pl and speedscope. Optional tracemalloc
+# snapshots are appended to <file>.memory every MEMORY_INTERVAL.
+
+import logging
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+INTERVAL = 0.005
+MEMORY_INTERVAL = 60.0
+MEMORY_TOP = 20
+MAX_DEPTH = 64
+
+# memory tracemalloc doesn't see (Qt pixmaps and images), name -> function returning bytes
+gauges = {}
+
+# innermost frame of these functions or modules decides subsystem of the sample
+SUBSYSTEMS = {
+    "QmkLayoutWidget:init_config": "config",
+    # no python frames above, GUI thread is waiting or busy inside Qt
+    "QmkLayoutWidget:setup_application": "qt event loop",
+    "QmkLayoutWidget": "gui",
+    "protocol": "protocol",
+    "messages": "protocol",
+    "session": "protocol",
+    "scheduler": "protocol",
+    "keymap_watch": "protocol",
+    "heartbeat": "protocol",
+    "power": "protocol",
+    "hid": "protocol",
+    "overlay": "overlay",
+    "tray_icons": "overlay",
+    "output": "output",
+    "pynput": "output",
+    "copykitten": "output",
+    "settings": "config",
+    "heatmap": "heatmap",
+    "daemon": "daemon",
+    "bus": "hooks",
+    "hooks": "hooks",
+}
+
+
+def module_name(frame):
+    name = frame.f_globals.get("__name__", "?")
+    if name == "__main__":
+        name = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return name
+
+
+def subsystem(stack):
+    for name in reversed(stack):
+        if name in SUBSYSTEMS:
+            return SUBSYSTEMS[name]
+        root = name.split(".", 1)[0].split(":", 1)[0]
+        if root in SUBSYSTEMS:
+            return SUBSYSTEMS[root]
+    return "other"
+
+
+class Profiler:
+    def __init__(self, path, interval=INTERVAL, memory=False):
+        self.path = path
+        self.interval = interval
+        self.memory = memory
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+        self.thread = threading.Thread(target=self.sample_loop, daemon=True)
+        self.thread.start()
+        log.info("profiling every %s ms into %s", self.interval * 1000, self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        if self.memory:
+            self.snapshot()
+            tracemalloc.stop()
+
+    def sample_loop(self):
+        own = threading.get_ident()
+        next_memory = time.monotonic() + MEMORY_INTERVAL
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.sample(names.get(ident, f"thread-{ident}"), frame)
+            self.samples += 1
+
+            if self.memory and time.monotonic() >= next_memory:
+                next_memory = time.monotonic() + MEMORY_INTERVAL
+                self.snapshot()
+
+    def sample(self, thread_name, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(f"{module_name(frame)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        stack.reverse()
+        key = ";".join([thread_name, subsystem(stack)] + stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self):
+        with open(self.path, "w") as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write(f"{key} {count}\n")
+
+        totals = {}
+        for key, count in self.stacks.items():
+            thread_name, name = key.split(";", 2)[:2]
+            totals[(thread_name, name)] = totals.get((thread_name, name), 0) + count
+        for (thread_name, name), count in sorted(totals.items()):
+            log.info(
+                "profile %s %s: %.1f%% of samples",
+                thread_name,
+                name,
+                count * 100.0 / max(1, self.samples),
+            )
+        log.info("profile with %s samples written to %s", self.samples, self.path)
+
+    def snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self.path + ".memory", "a") as f:
+            f.write(f"# {time.time():.3f} traced {current} bytes, peak {peak} bytes\n")
+            for name, gauge in gauges.items():
+                f.write(f"# {name} {gauge()} bytes\n")
+            for stat in snapshot.statistics("lineno")[:MEMORY_TOP]:
+                f.write(f"{stat}\n")
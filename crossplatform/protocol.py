@@ -2,11 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import hid
+import ctypes
 import time
 import logging
 import json
 import lzma
 import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import messages
+from messages import (
+    HID_LAYERS_OUT_STATE,
+    HID_LAYERS_OUT_VERSION,
+    HID_LAYERS_OUT_ERROR,
+)
 
 log = logging.getLogger(__name__)
 
@@ -16,10 +25,6 @@ RAW_USAGE_ID = 0x61
 
 # protocol
 HID_LAYERS_IN = 0x88
-HID_LAYERS_OUT_STATE = 0x89
-HID_LAYERS_OUT_PRESS = 0x90
-HID_LAYERS_OUT_VERSION = 0x91
-HID_LAYERS_OUT_ERROR = 0x92
 
 GET_VERSION = 0x00
 GET_LAYERS_STATE = 0x01
@@ -74,6 +79,7 @@ def candidates(raw_usage_page=RAW_USAGE_PAGE, raw_usage_id=RAW_USAGE_ID):
                     "path": dev["path"],
                     "vendor_id": dev["vendor_id"],
                     "product_id": dev["product_id"],
+                    "serial_number": dev["serial_number"],
                     "product_string": dev["product_string"],
                     "manufacturer_string": dev["manufacturer_string"],
                 }
@@ -108,61 +114,132 @@ def recv(device, timeout=None, raw=False):
         return None
 
 
-def send_recv(device, data, raw=False, retries=5):
+class RecvBuffer:
+    # reused for every report, ctypes view shares memory with bytearray which is parsed by messages
+    __slots__ = ("data", "c_data", "device", "handle")
+
+    def __init__(self):
+        self.data = bytearray(MESSAGE_LENGTH)
+        self.c_data = (ctypes.c_char * MESSAGE_LENGTH).from_buffer(self.data)
+        # device the handle was resolved for
+        self.device = None
+        self.handle = None
+
+
+# Best effort fast path. hid.Device of "hid" (pyhidapi) binding keeps hidapi handle in
+# private attribute and exposes ctypes library as hid.hidapi, when both are there hidapi
+# is called directly with reused buffer. Other bindings or versions use public read.
+def native_handle(device):
+    hidapi = getattr(hid, "hidapi", None)
+    handle = getattr(device, "_Device__dev", None)
+    if (
+        handle is None
+        or hidapi is None
+        or not hasattr(hidapi, "hid_read_timeout")
+        or not hasattr(hidapi, "hid_error")
+    ):
+        return None
+    return handle
+
+
+def read_into(device, buffer, timeout=None):
+    if buffer.device is not device:
+        buffer.device = device
+        buffer.handle = native_handle(device)
+        log.info(
+            "reports are read %s",
+            "by hidapi into reused buffer" if buffer.handle else "with device.read",
+        )
+
+    if buffer.handle is None:
+        # hid.Device.read allocates new ctypes buffer and bytes copy for every report
+        data = device.read(MESSAGE_LENGTH, timeout=timeout)
+        buffer.data[: len(data)] = data
+        return len(data)
+
+    size = hid.hidapi.hid_read_timeout(
+        buffer.handle,
+        buffer.c_data,
+        MESSAGE_LENGTH,
+        -1 if timeout is None else timeout,
+    )
+    if size == -1:
+        raise hid.HIDException(hid.hidapi.hid_error(buffer.handle))
+    return size
+
+
+# returns empty list on timeout
+def recv_events(device, buffer, timeout=None):
+    events = []
+    size = read_into(device, buffer, timeout)
+    # drain everything what is already queued without waiting, so caller is woken up once per burst
+    while size > 0:
+        event = messages.decode(buffer.data)
+        if event is not None:
+            events.append(event)
+        else:
+            log.error("non-protocol HID message received %s", bytes(buffer.data))
+        size = read_into(device, buffer, 0)
+
+    return events
+
+
+def send_recv(
+    device,
+    data,
+    raw=False,
+    retries=5,
+    timeout=500,
+    first_timeout=None,
+    retry_delay=0.5,
+):
+    attempt_timeout = timeout if first_timeout is None else first_timeout
     while retries > 0:
         send(device, data, raw=raw)
-        response = recv(device, timeout=500, raw=raw)
+        response = recv(device, timeout=attempt_timeout, raw=raw)
         if response is not None:
             return response
+        attempt_timeout = timeout
         retries = retries - 1
         log.error("empty response retries = %s", retries)
         if retries > 0:
-            time.sleep(0.5)
+            time.sleep(retry_delay)
 
     return None
 
 
-def enable_reporting_and_get_state(device):
+def enable_reporting_and_get_state(device, **send_recv_args):
     log.info("sending GET_LAYERS_STATE")
-    response = send_recv(device, [GET_LAYERS_STATE])
+    response = send_recv(device, [GET_LAYERS_STATE], **send_recv_args)
     if response is None:
         return None
 
-    if response[3] != 0:
-        log.info(
-            "layer reporting is enabled %s, presses are enabled %s, current layer %s, caps word %s",
-            response[3],
-            response[4],
-            response[1],
-            response[2],
-        )
-        state = response[1], response[2]  # layer num, caps sword
+    state = messages.decode_state(response)
+    if state.report_change != 0:
+        log.info("layer reporting is enabled %s", state)
     else:
-        log.info("layer reporting is not enabled %s, will enable it now", response[2])
-        response = send_recv(device, [SET_REPORT_CHANGE, 1])
-        if response is None or response[3] != 1:
+        log.info("layer reporting is not enabled %s, will enable it now", state)
+        response = send_recv(device, [SET_REPORT_CHANGE, 1], **send_recv_args)
+        if response is None:
+            log.error("failed to enable layer reporting, dig deeper!")
+            return None
+        state = messages.decode_state(response)
+        if state.report_change != 1:
             log.error("failed to enable layer reporting, dig deeper!")
             return None
 
-        log.info(
-            "layer reporting successfully enabled %s, presses are enabled %s, current layer %s, caps word %s",
-            response[3],
-            response[4],
-            response[1],
-            response[2],
-        )
-        state = response[1], response[2]
+        log.info("layer reporting successfully enabled %s", state)
 
-    if response[4] != 0:
-        log.info("report press already enabled %s", response[4])
+    if state.report_press != 0:
+        log.info("report press already enabled %s", state.report_press)
     else:
-        log.info("report press is not enabled %s, will enable it now", response[4])
-        response = send_recv(device, [SET_REPORT_PRESS, 1])
-        if response is None or response[4] != 1:
+        log.info("report press is not enabled %s, will enable it now", state.report_press)
+        response = send_recv(device, [SET_REPORT_PRESS, 1], **send_recv_args)
+        if response is None or messages.decode_state(response).report_press != 1:
             log.error("failed to enable press reporting, dig deeper!")
             return None
 
-        log.info("press reporting is successfully enabled %s", response[4])
+        log.info("press reporting is successfully enabled")
 
     return state
 
@@ -197,7 +274,7 @@ def load_vial_meta(device):
                 query,
                 raw=True,
             )
-            if query != data[1 : len(query) + 1]:
+            if data is None or query != data[1 : len(query) + 1]:
                 break
             else:
                 log.error(
@@ -245,62 +322,97 @@ def load_layers_count(device):
 BUFFER_FETCH_CHUNK = 28
 
 
-def load_layers_keymaps(device, layers, rows, cols):
+def load_layers_keymaps(device, layers, rows, cols, **send_recv_args):
     size = layers * rows * cols * 2
     log.info("loading layers/keymaps of size %s", size)
+    keymap = load_keymap_buffer(device, 0, size, **send_recv_args)
+    if keymap is None:
+        log.error("failed to load layers/keymaps")
+        return None
+
+    log.info("successfully loaded layers/keymaps")
+
+    return [
+        layer_keymap_from_buffer(keymap, layer, rows, cols) for layer in range(layers)
+    ]
+
+
+def load_keymap_buffer(device, offset, size, attempts=5, **send_recv_args):
     keymap = b""
-    for x in range(0, size, BUFFER_FETCH_CHUNK):
-        offset = x
-        sz = min(size - offset, BUFFER_FETCH_CHUNK)
+    for chunk_offset in range(offset, offset + size, BUFFER_FETCH_CHUNK):
+        sz = min(offset + size - chunk_offset, BUFFER_FETCH_CHUNK)
         data_ok = False
-        attempts = 5
-        while not data_ok and attempts > 0:
+        remaining = attempts
+        while not data_ok and remaining > 0:
             data = send_recv(
                 device,
-                struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, sz),
+                keymap_buffer_query(chunk_offset, sz),
                 raw=True,
+                **send_recv_args,
+            )
+            # response echoes offset and size, late response to previous request is
+            # dropped instead of being taken as this chunk
+            data_ok = (
+                data is not None
+                and data[0] == CMD_VIA_KEYMAP_GET_BUFFER
+                and struct.unpack_from(">HB", data, 1) == (chunk_offset, sz)
             )
-            data_ok = data is not None and data[0] == CMD_VIA_KEYMAP_GET_BUFFER
             if not data_ok:
-                attempts = attempts - 1
+                remaining = remaining - 1
                 log.error(
-                    "corrupted data received from keyboard %s during load_layers_keymaps attempts remaining %s",
+                    "corrupted data received from keyboard %s during load_keymap_buffer attempts remaining %s",
                     data,
-                    attempts,
+                    remaining,
                 )
 
         if not data_ok:
-            log.error("failed to load layers/keymaps")
             return None
 
         keymap += data[4 : 4 + sz]
 
-    log.info("successfully loaded layers/keymaps")
+    return keymap
+
+
+def keymap_buffer_query(offset, size):
+    return struct.pack(">BHB", CMD_VIA_KEYMAP_GET_BUFFER, offset, size)
+
 
-    layers_keymaps = []
-    for layer in range(layers):
-        keydict = {}
+def layer_keymap_from_buffer(keymap, layer, rows, cols):
+    keydict = {}
+    for row in range(rows):
+        for col in range(cols):
+            offset = layer * rows * cols * 2 + row * cols * 2 + col * 2
+            keycode = struct.unpack_from(">H", keymap, offset)[0]
+            keydict[f"{row},{col}"] = keycode
+
+    return keydict
+
+
+def layers_keymaps_to_buffer(layers_keymaps, rows, cols):
+    keymap = bytearray()
+    for keydict in layers_keymaps:
         for row in range(rows):
             for col in range(cols):
-                offset = layer * rows * cols * 2 + row * cols * 2 + col * 2
-                keycode = struct.unpack(">H", keymap[offset : offset + 2])[0]
-                keydict[f"{row},{col}"] = keycode
-
-        layers_keymaps.append(keydict)
+                keymap += struct.pack(">H", keydict[f"{row},{col}"])
 
-    return layers_keymaps
+    return keymap
 
 
-def discover_capabilities(device):
+def discover_capabilities(device, **send_recv_args):
     info = {}
-    response = send_recv(device, [CMD_VIA_GET_PROTOCOL_VERSION], raw=True)
+    response = send_recv(
+        device, [CMD_VIA_GET_PROTOCOL_VERSION], raw=True, **send_recv_args
+    )
     if response is None:
         info["via"] = None
     else:
         info["via"] = response[2]
 
     response = send_recv(
-        device, [CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_KEYBOARD_ID], raw=True
+        device,
+        [CMD_VIA_VIAL_PREFIX, CMD_VIAL_GET_KEYBOARD_ID],
+        raw=True,
+        **send_recv_args,
     )
     if response is None or response[0] == VIA_UNHANDLED:
         info["vial"] = None
@@ -309,15 +421,110 @@ def discover_capabilities(device):
             (response[3] << 24) + (response[2] << 16) + (response[1] << 8) + response[0]
         )
 
-    response = send_recv(device, [GET_VERSION])
+    response = send_recv(device, [GET_VERSION], **send_recv_args)
     if response is None or response[0] != HID_LAYERS_OUT_VERSION:
         info["companion_hid"] = None
     else:
-        info["companion_hid"] = response[1]
+        info["companion_hid"] = messages.decode_version(response).version
 
     return info
 
 
+# probing is done with short timeouts, devices without companion_hid don't answer
+# to GET_VERSION at all and waiting full send_recv timeouts for them is too long
+PROBE_RETRIES = 2
+PROBE_FIRST_TIMEOUT = 100
+PROBE_RETRY_DELAY = 0.05
+PROBE_WORKERS = 8
+
+CAPABILITIES_NEGATIVE_TTL = 60.0
+
+
+def device_key(candidate):
+    return (
+        candidate["vendor_id"],
+        candidate["product_id"],
+        candidate.get("serial_number"),
+        candidate["path"],
+    )
+
+
+class CapabilityCache:
+    def __init__(self, negative_ttl=CAPABILITIES_NEGATIVE_TTL, positive_ttl=None):
+        self.negative_ttl = negative_ttl
+        self.positive_ttl = positive_ttl
+        self.entries = {}
+
+    def get(self, candidate):
+        entry = self.entries.get(device_key(candidate))
+        if entry is None:
+            return None
+
+        capabilities, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self.entries[device_key(candidate)]
+            return None
+
+        return capabilities
+
+    def put(self, candidate, capabilities):
+        if capabilities.get("companion_hid") is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = self.positive_ttl
+
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.entries[device_key(candidate)] = (capabilities, expires)
+
+    def invalidate(self, candidate):
+        self.entries.pop(device_key(candidate), None)
+
+
+def probe(candidate):
+    device = open(candidate["vendor_id"], candidate["product_id"], candidate["path"])
+    if device is None:
+        return None
+
+    try:
+        return discover_capabilities(
+            device,
+            retries=PROBE_RETRIES,
+            first_timeout=PROBE_FIRST_TIMEOUT,
+            retry_delay=PROBE_RETRY_DELAY,
+        )
+    except hid.HIDException as e:
+        log.error("failed to probe device %s exception: %s", candidate["path"], e)
+        return None
+    finally:
+        close(device)
+
+
+def probe_candidates(candidates, cache):
+    unknown = [c for c in candidates if cache.get(c) is None]
+    if len(unknown) > 0:
+        log.info("probing %s candidate devices", len(unknown))
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            for candidate, capabilities in zip(
+                unknown, executor.map(probe, unknown)
+            ):
+                log.info(
+                    "device %s capabilities probed %s", candidate["path"], capabilities
+                )
+                # failure to open might be transient (permissions), don't remember it
+                if capabilities is not None:
+                    cache.put(candidate, capabilities)
+
+    result = []
+    for candidate in candidates:
+        capabilities = cache.get(candidate)
+        if capabilities is not None and capabilities.get("companion_hid") is not None:
+            result.append(dict(candidate, capabilities=capabilities))
+        else:
+            log.info("skipping non companion_hid device %s", candidate["path"])
+
+    return result
+
+
 def load_layout_options(device, meta):
     if meta.get("layouts") is None or meta["layouts"].get("labels") is None:
         return [(0, 0)]
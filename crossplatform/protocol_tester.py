@@ -3,6 +3,7 @@
 
 import logging
 import protocol
+import messages
 from pprint import pformat
 
 logging.basicConfig(encoding="utf-8", level=logging.DEBUG)
@@ -20,10 +21,11 @@ for dev in devs:
         if response is None:
             log.error("failed to get GET_LAYERS_STATE response")
         else:
+            state = messages.decode_state(response)
             log.info(
                 "current layer: %s, caps_word: %s, report_enabled: %s",
-                response[1],
-                response[2],
-                response[3],
+                state.layer,
+                state.caps_word,
+                state.report_change,
             )
         protocol.close(dd)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Host initiated HID commands during a session go through Scheduler.
+#
+# Interactive commands (INVERT_LAYER) are written right away from any thread.
+# Bulk (keymap loading) and background (keymap checks) jobs run in reader thread only after
+# the keyboard was silent for a while. While a job waits for its responses companion_hid
+# reports are dispatched as usual, so presses are never delayed by long transfers.
+# Response is told from report by command id which via echoes in its first byte. Vial
+# definition blocks echo nothing and may start with any byte, so quiet jobs (keymaps
+# loading) turn reporting off while they run and every read is their response.
+
+import logging
+import threading
+import time
+from collections import deque
+
+import hid
+
+import messages
+import protocol
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk", BACKGROUND: "background"}
+
+# seconds without key events before requests of class are sent
+IDLE = {INTERACTIVE: 0.0, BULK: 0.1, BACKGROUND: 0.5}
+# request waits for idle no longer than this
+STARVATION_LIMIT = {INTERACTIVE: 0.0, BULK: 2.0, BACKGROUND: 30.0}
+# keyboard acknowledges reporting off in this time or it's considered dead
+QUIET_TIMEOUT = 1.0
+
+METRICS_LOG_INTERVAL = 60.0
+
+
+class Job:
+    __slots__ = ("priority", "function", "enqueued", "quiet")
+
+    def __init__(self, priority, function, enqueued, quiet=False):
+        self.priority = priority
+        self.function = function
+        self.enqueued = enqueued
+        self.quiet = quiet
+
+
+class Scheduler:
+    def __init__(self, device, callback_events):
+        self.device = device
+        self.callback_events = callback_events
+        self.queues = {BULK: deque(), BACKGROUND: deque()}
+        self.periodic = []
+        self.lock = threading.Lock()
+        self.last_activity = 0.0
+        self.running = None
+        # periodic jobs (heartbeat, keymap checks) are held while reporting is suspended
+        self.paused = False
+        # last dispatched layer state, heartbeat reply repeating it isn't dispatched
+        self.state = None
+        # command id of the last request of running job, its response echoes it
+        self.request_id = None
+        self.metrics_logged = time.monotonic()
+        self.counters = {
+            priority: {
+                "jobs": 0,
+                "requests": 0,
+                "starved": 0,
+                "wait_total": 0.0,
+                "wait_max": 0.0,
+            }
+            for priority in PRIORITY_NAMES
+        }
+
+    # device like interface for protocol functions executed inside jobs
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def write(self, data):
+        if self.running is not None:
+            # reporting is off during quiet job, there is no activity to wait for
+            if not self.running.quiet:
+                self.wait_idle(self.running)
+            self.counters[self.running.priority]["requests"] += 1
+            self.request_id = data[1]
+        return self.device.write(data)
+
+    def read(self, size, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, round((deadline - time.monotonic()) * 1000))
+            data = self.device.read(size, timeout=remaining)
+            if (
+                len(data) == 0
+                or self.running is None
+                or self.running.quiet
+                or data[0] == self.request_id
+            ):
+                return data
+
+            # job expects raw response, reports of companion_hid are dispatched meanwhile
+            event = messages.decode(data)
+            if event is None:
+                return data
+            self.activity(time.monotonic())
+            self.dispatch([event])
+
+    # any report proves that device is alive, it's not user activity so jobs are not delayed
+    def wait_report(self, timeout):
+        data = self.device.read(protocol.MESSAGE_LENGTH, timeout=timeout)
+        if len(data) == 0:
+            return False
+        event = messages.decode(data)
+        if event is not None and not self.same_state(event):
+            self.dispatch([event])
+        return True
+
+    def same_state(self, event):
+        return (
+            type(event) is messages.LayerState
+            and self.state is not None
+            and event.layer == self.state.layer
+            and event.caps_word == self.state.caps_word
+        )
+
+    # all reports of the session are dispatched here, in reader thread
+    def dispatch(self, events):
+        for event in events:
+            if type(event) is messages.LayerState:
+                self.state = event
+        self.callback_events(events)
+
+    def wait_idle(self, job):
+        started = time.monotonic()
+        counters = self.counters[job.priority]
+        while True:
+            now = time.monotonic()
+            idle_at = self.last_activity + IDLE[job.priority]
+            if now >= idle_at:
+                break
+            # starvation counts from submission, starved job sends the rest of its requests without waiting
+            if now - job.enqueued >= STARVATION_LIMIT[job.priority]:
+                counters["starved"] += 1
+                log.debug(
+                    "%s request starved, sending anyway", PRIORITY_NAMES[job.priority]
+                )
+                break
+            # reading dispatches events and updates last_activity
+            self.read(32, timeout=max(1, round((idle_at - now) * 1000)))
+
+        waited = time.monotonic() - started
+        counters["wait_total"] += waited
+        counters["wait_max"] = max(counters["wait_max"], waited)
+
+    # scheduling
+
+    # may be called from any thread, goes to device directly and never reads
+    def interactive(self, data, raw=False):
+        counters = self.counters[INTERACTIVE]
+        counters["jobs"] += 1
+        counters["requests"] += 1
+        return protocol.send(self.device, data, raw=raw)
+
+    def submit(self, priority, function, quiet=False):
+        with self.lock:
+            self.queues[priority].append(
+                Job(priority, function, time.monotonic(), quiet)
+            )
+
+    def every(self, interval, priority, function):
+        self.periodic.append(
+            [time.monotonic() + interval, interval, priority, function]
+        )
+
+    def activity(self, now):
+        self.last_activity = now
+
+    def pause(self, paused):
+        self.paused = paused
+
+    def next_job(self, now):
+        with self.lock:
+            for priority in (BULK, BACKGROUND):
+                queue = self.queues[priority]
+                if len(queue) == 0:
+                    continue
+                job = queue[0]
+                if (
+                    now - self.last_activity >= IDLE[priority]
+                    or now - job.enqueued >= STARVATION_LIMIT[priority]
+                ):
+                    return queue.popleft()
+        return None
+
+    # seconds until the next job might run, used as read timeout by reader
+    def timeout(self, now):
+        candidates = []
+        if not self.paused:
+            candidates = [due for due, _, _, _ in self.periodic]
+        with self.lock:
+            for priority, queue in self.queues.items():
+                if len(queue) > 0:
+                    candidates.append(
+                        min(
+                            self.last_activity + IDLE[priority],
+                            queue[0].enqueued + STARVATION_LIMIT[priority],
+                        )
+                    )
+        if len(candidates) == 0:
+            return None
+        return max(0.0, min(candidates) - now)
+
+    def run_due(self, now):
+        for entry in self.periodic:
+            if entry[0] <= now and not self.paused:
+                entry[0] = now + entry[1]
+                # periodic job which is still waiting for idle isn't queued twice
+                with self.lock:
+                    queued = any(
+                        job.function is entry[3] for job in self.queues[entry[2]]
+                    )
+                if not queued:
+                    self.submit(entry[2], entry[3])
+
+        job = self.next_job(now)
+        while job is not None:
+            counters = self.counters[job.priority]
+            counters["jobs"] += 1
+            if job.quiet:
+                self.quiet()
+            self.running = job
+            try:
+                job.function(self)
+            finally:
+                self.running = None
+                self.request_id = None
+                if job.quiet:
+                    self.report()
+            job = self.next_job(time.monotonic())
+
+        if now - self.metrics_logged >= METRICS_LOG_INTERVAL:
+            self.metrics_logged = now
+            log.info("hid scheduler metrics %s", self.metrics())
+
+    # reports sent before keyboard turned reporting off are dispatched, replies to both
+    # commands are the only state reports with report_change 0 (genuine ones have 1)
+    def quiet(self):
+        protocol.send(self.device, [protocol.SET_REPORT_CHANGE, 0])
+        protocol.send(self.device, [protocol.SET_REPORT_PRESS, 0])
+        replies = 0
+        deadline = time.monotonic() + QUIET_TIMEOUT
+        while replies < 2:
+            remaining = round((deadline - time.monotonic()) * 1000)
+            if remaining <= 0:
+                raise hid.HIDException("no reply to reporting off")
+            data = self.device.read(protocol.MESSAGE_LENGTH, timeout=remaining)
+            if len(data) == 0:
+                continue
+            event = messages.decode(data)
+            if type(event) is messages.LayerState and event.report_change == 0:
+                replies += 1
+            elif event is not None:
+                self.dispatch([event])
+
+    # replies are state reports, reader dispatches them as usual
+    def report(self):
+        if self.paused:
+            # session is suspended, reporting stays off until resume
+            return
+        protocol.send(self.device, [protocol.SET_REPORT_CHANGE, 1])
+        protocol.send(self.device, [protocol.SET_REPORT_PRESS, 1])
+
+    def metrics(self):
+        with self.lock:
+            depth = {p: len(q) for p, q in self.queues.items()}
+        return {
+            PRIORITY_NAMES[priority]: dict(counters, queued=depth.get(priority, 0))
+            for priority, counters in self.counters.items()
+        }
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# HID session with companion_hid keyboard, shared by QmkLayoutWidget.py and daemon.py, no Qt here
+
+import traceback
+import math
+import time
+import hid
+import logging
+
+import protocol
+import messages
+import keymap_watch
+import scheduler
+import heartbeat
+
+log = logging.getLogger(__name__)
+
+device = None
+session_scheduler = None
+stop = False
+# heatmap.Heatmap, presses are counted in reader thread after dispatch
+heatmap = None
+# seconds of silence before link is checked, 0 disables heartbeat
+heartbeat_idle = heartbeat.IDLE
+capability_cache = protocol.CapabilityCache()
+# reporting is turned off while user session is locked, see power.py
+suspended = False
+suspended_since = None
+
+
+def load_keymaps(device, capabilities, meta, **send_recv_args):
+    if meta is None and capabilities.get("vial") is not None:
+        meta = protocol.load_vial_meta(device)
+
+    layers_keymaps = None
+    layout_options = None
+    if capabilities.get("via") is not None and meta is not None:
+        layout_options = protocol.load_layout_options(device, meta)
+        layers_count = protocol.load_layers_count(device)
+        layers_keymaps = protocol.load_layers_keymaps(
+            device,
+            layers_count,
+            meta["matrix"]["rows"],
+            meta["matrix"]["cols"],
+            **send_recv_args,
+        )
+
+    return meta, layers_keymaps, layout_options
+
+
+# after transient disconnect same device path is reopened with exponential backoff,
+# full enumeration is done only if device doesn't come back in RESUME_TIMEOUT
+RESUME_FIRST_DELAY = 0.01
+RESUME_MAX_DELAY = 0.5
+RESUME_TIMEOUT = 5.0
+RESUME_RETRIES = 2
+RESUME_FIRST_TIMEOUT = 100
+
+# keymaps loaded from device are kept by device identity while it stays connected or
+# comes back in RESUME_TIMEOUT, so they aren't loaded again after later enumeration.
+# Devices without serial number aren't kept here, two keyboards of same model would
+# share keymaps otherwise, resume of the same path keeps its keymaps in any case.
+sessions = {}
+announced_session = None
+
+
+def session_key(device_info):
+    if not device_info.get("serial_number"):
+        return None
+    return (
+        device_info["vendor_id"],
+        device_info["product_id"],
+        device_info["serial_number"],
+    )
+
+
+def open_session(device_info, **send_recv_args):
+    device = protocol.open(
+        device_info["vendor_id"],
+        device_info["product_id"],
+        device_info["path"],
+    )
+    if device is None:
+        return None, None
+
+    try:
+        state = protocol.enable_reporting_and_get_state(device, **send_recv_args)
+    except hid.HIDException as e:
+        log.error("failed to enable reporting %s, %s", device_info["path"], e)
+        state = None
+
+    if state is None:
+        protocol.close(device)
+        return None, None
+
+    return device, state
+
+
+def resume_session(device_info):
+    delay = 0.0
+    deadline = time.monotonic() + RESUME_TIMEOUT
+    while not stop and time.monotonic() < deadline:
+        time.sleep(delay)
+        device, state = open_session(
+            device_info,
+            retries=RESUME_RETRIES,
+            first_timeout=RESUME_FIRST_TIMEOUT,
+        )
+        if device is not None:
+            log.info("session resumed %s", device_info["path"])
+            return device, state
+
+        delay = RESUME_FIRST_DELAY if delay == 0 else min(delay * 2, RESUME_MAX_DELAY)
+        log.info("failed to resume session, next attempt in %s", delay)
+
+    return None, None
+
+
+def select_candidate(candidates, product_id):
+    device_index = 0
+    if product_id is not None:
+        for idx, candidate in enumerate(candidates):
+            if candidate["product_id"] == product_id:
+                log.info(
+                    "found device matching config product_id %s in index %s",
+                    candidate,
+                    idx,
+                )
+                device_index = idx
+    return device_index
+
+
+def send_interactive(data):
+    active = session_scheduler
+    if active is None:
+        log.error("no active session, %s is not sent", data)
+        return None
+    return active.interactive(data)
+
+
+# may be called from any thread, commands are only written, replies come to reader as
+# state reports, the one of GET_LAYERS_STATE refreshes indicator after unlock
+def apply_suspended(active):
+    active.pause(suspended)
+    if suspended:
+        active.interactive([protocol.SET_REPORT_CHANGE, 0])
+        active.interactive([protocol.SET_REPORT_PRESS, 0])
+    else:
+        active.interactive([protocol.SET_REPORT_CHANGE, 1])
+        active.interactive([protocol.SET_REPORT_PRESS, 1])
+        active.interactive([protocol.GET_LAYERS_STATE])
+
+
+def set_suspended(value):
+    global suspended, suspended_since
+    if value == suspended:
+        return
+    suspended = value
+    if suspended:
+        suspended_since = time.monotonic()
+        log.info("reporting is suspended")
+    else:
+        log.info(
+            "reporting is resumed after %.1f seconds",
+            time.monotonic() - suspended_since,
+        )
+    active = session_scheduler
+    if active is not None:
+        apply_suspended(active)
+
+
+def read_events(device, device_info, active_scheduler):
+    buffer = protocol.RecvBuffer()
+    while not stop:
+        try:
+            timeout = active_scheduler.timeout(time.monotonic())
+            if timeout is not None:
+                timeout = math.ceil(timeout * 1000)
+            events = protocol.recv_events(device, buffer, timeout)
+            now = time.monotonic()
+            if len(events) > 0:
+                active_scheduler.activity(now)
+                for event in events:
+                    if type(event) is messages.Version or type(event) is messages.Error:
+                        log.error("unexpected hid message %s", event)
+                active_scheduler.dispatch(events)
+            active_scheduler.run_due(now)
+
+        except hid.HIDException as e:
+            log.error("hid receive error %s, %s", device_info["path"], e)
+            return
+
+
+def forget_session(key):
+    global announced_session
+    if sessions.pop(key, None) is not None:
+        log.info("keymaps of %s are dropped from memory", key)
+    if announced_session == key:
+        announced_session = None
+
+
+def start_watcher(active_scheduler, keymaps, callback_keymaps):
+    meta, layers, layout_options = keymaps
+    if meta is None or layers is None:
+        return
+
+    def keymap_changed(layer):
+        callback_keymaps(meta, layers, layout_options)
+
+    watcher = keymap_watch.KeymapWatcher(
+        layers, meta["matrix"]["rows"], meta["matrix"]["cols"], keymap_changed
+    )
+    active_scheduler.every(
+        keymap_watch.CHECK_INTERVAL, scheduler.BACKGROUND, watcher.check
+    )
+
+
+# held is {"keymaps": ...} of the current path, it outlives resumes of the session
+def start_keymaps(
+    active_scheduler, key, capabilities, config_meta, callback_keymaps, held
+):
+    global announced_session
+    keymaps = held.get("keymaps")
+    if keymaps is None and key is not None:
+        keymaps = sessions.get(key)
+    if keymaps is not None:
+        held["keymaps"] = keymaps
+        if announced_session != key:
+            log.info("keymaps of %s are taken from memory", key)
+            callback_keymaps(*keymaps)
+            announced_session = key
+        start_watcher(active_scheduler, keymaps, callback_keymaps)
+        return
+
+    # loading takes hundreds of requests, it's done as bulk job so presses are not delayed
+    # job runs in reader thread, so retries are sent at once instead of sleeping there,
+    # reporting is off meanwhile, vial definition blocks can't be told from reports
+    def load(proxy):
+        global announced_session
+        keymaps = load_keymaps(proxy, capabilities, config_meta, retry_delay=0)
+        if keymaps[1] is not None or capabilities.get("via") is None:
+            held["keymaps"] = keymaps
+            if key is not None:
+                sessions[key] = keymaps
+        callback_keymaps(*keymaps)
+        announced_session = key
+        start_watcher(proxy, keymaps, callback_keymaps)
+
+    active_scheduler.submit(scheduler.BULK, load, quiet=True)
+
+
+def recording_events(callback_events, recorder):
+    def callback(events):
+        callback_events(events)
+        recorder.record(events)
+
+    return callback
+
+
+def process_loop(
+    config_meta,
+    callback_events,
+    callback_wait,
+    callback_select_device,
+    callback_keymaps,
+):
+    global device, session_scheduler
+    if heatmap is not None:
+        callback_events = recording_events(callback_events, heatmap)
+    try:
+        while not stop:
+            callback_wait()
+            candidates = protocol.probe_candidates(
+                protocol.candidates(), capability_cache
+            )
+            if len(candidates) > 0:
+                active_device_index = callback_select_device(candidates)
+                device_info = candidates[active_device_index]
+                capabilities = device_info["capabilities"]
+                log.info("device capabilities from cache %s", capabilities)
+                device, state = open_session(device_info)
+                if device is None:
+                    capability_cache.invalidate(device_info)
+
+                held = {}
+                while device is not None:
+                    session_scheduler = scheduler.Scheduler(device, callback_events)
+                    if suspended:
+                        # session was (re)opened with reporting enabled while locked
+                        apply_suspended(session_scheduler)
+                    link = None
+                    if heartbeat_idle > 0:
+                        link = heartbeat.Heartbeat(heartbeat_idle)
+                        session_scheduler.every(
+                            heartbeat.CHECK_INTERVAL, scheduler.BACKGROUND, link.check
+                        )
+                    if callback_keymaps is not None:
+                        start_keymaps(
+                            session_scheduler,
+                            session_key(device_info),
+                            capabilities,
+                            config_meta,
+                            callback_keymaps,
+                            held,
+                        )
+
+                    session_scheduler.dispatch([state])
+
+                    read_events(device, device_info, session_scheduler)
+                    log.info("hid scheduler metrics %s", session_scheduler.metrics())
+                    if link is not None:
+                        log.info("heartbeat metrics %s", link.metrics())
+                    session_scheduler = None
+                    protocol.close(device)
+                    device = None
+                    if stop:
+                        break
+
+                    log.info("connection to %s lost, resuming", device_info["path"])
+                    device, state = resume_session(device_info)
+                    if device is None:
+                        # keymaps might be changed while device was away
+                        forget_session(session_key(device_info))
+            else:
+                log.error(
+                    "No candidate devices with companion_hid found. I'll wait and try later."
+                )
+
+            time.sleep(1)
+    except Exception:
+        traceback.print_exc()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TOUCHBOARD_MOVE_KEYCODE = "0x7E00"
+
+DEFAULT_TOUCHBOARD_MOVE = "🐁"
+DEFAULT_TOUCHBOARD_LEFT = "←"
+DEFAULT_TOUCHBOARD_RIGHT = "→"
+# middle click, scroll and drag lock are opt-in, their symbols might be typed otherwise
+DEFAULT_TOUCHBOARD_MIDDLE = None
+DEFAULT_TOUCHBOARD_SCROLL_UP = None
+DEFAULT_TOUCHBOARD_SCROLL_DOWN = None
+DEFAULT_TOUCHBOARD_DRAG_LOCK = None
+DEFAULT_TOUCHBOARD_MULTICLICK_PERIOD = 250
+DEFAULT_TOUCHBOARD_MODE = "dive"
+DEFAULT_HEARTBEAT_IDLE = 0.5
+# continuous motion is opt-in, held TB_MOVE key only dives otherwise, 500 is smooth
+DEFAULT_TOUCHBOARD_MOTION_RATE = 0
+DEFAULT_TOUCHBOARD_MOTION_HOLD = 200
+DEFAULT_TOUCHBOARD_MOTION_RAMP = 1000
+DEFAULT_TOUCHBOARD_MOTION_MIN_SPEED = 60
+DEFAULT_TOUCHBOARD_MOTION_MAX_SPEED = 1500
+DEFAULT_TOUCHBOARD_MOTION_CURVE = "quadratic"
+
+
+class Settings:
+    # configuration.json is compiled once on load, handlers read attributes instead of dict lookups with defaults
+    __slots__ = (
+        "mode",
+        "icons",
+        "config_directory",
+        "product_id",
+        "heatmap",
+        "heartbeat_idle",
+        "hid_process",
+        "lock_monitor",
+        "lock_monitor_idle",
+        "forward_to",
+        "forward_listen",
+        "forward_transport",
+        "forward_secret",
+        "hooks",
+        "output_backend",
+        "touchboard_layer",
+        "touchboard_move_keycode",
+        "touchboard_move",
+        "touchboard_button_1",
+        "touchboard_button_2",
+        "touchboard_button_3",
+        "touchboard_scroll_up",
+        "touchboard_scroll_down",
+        "touchboard_drag_lock",
+        "touchboard_multiclick_period",
+        "touchboard_mode",
+        "touchboard_motion_rate",
+        "touchboard_motion_hold",
+        "touchboard_motion_ramp",
+        "touchboard_motion_min_speed",
+        "touchboard_motion_max_speed",
+        "touchboard_motion_curve",
+        "touchboard_meta",
+        "touchboard_keymap",
+        "touchboard_keymap_labels",
+    )
+
+    def __init__(self, config):
+        self.mode = config.get("mode", "dark").lower()
+        self.icons = config["icons"]
+        self.config_directory = config.get("config_directory")
+        self.product_id = config.get("product-id")
+        self.heatmap = bool(config.get("heatmap", False))
+        self.hid_process = bool(config.get("hid-process", False))
+        # "auto", "logind", "off" or "file:PATH", no reporting while session is locked
+        self.lock_monitor = config.get("lock-monitor", "auto")
+        self.lock_monitor_idle = bool(config.get("lock-monitor-idle", False))
+        # "host:port" of peer instance events are forwarded to, or to listen on as peer
+        self.forward_to = config.get("forward-to")
+        self.forward_listen = config.get("forward-listen")
+        self.forward_transport = config.get("forward-transport", "tcp").lower()
+        # frames are authenticated with HMAC, forwarding is off without shared secret
+        self.forward_secret = config.get("forward-secret")
+        if self.forward_secret is None and (
+            self.forward_to is not None or self.forward_listen is not None
+        ):
+            log.error("forward-secret is not configured, forwarding is disabled")
+            self.forward_to = None
+            self.forward_listen = None
+        self.hooks = config.get("hooks", [])
+        self.output_backend = config.get("output-backend", "pynput").lower()
+        self.heartbeat_idle = float(
+            config.get("heartbeat-idle", DEFAULT_HEARTBEAT_IDLE)
+        )
+
+        self.touchboard_layer = int(config.get("touchboard-layer", -1))
+        self.touchboard_move_keycode = int(
+            config.get("touchboard-move-keycode", DEFAULT_TOUCHBOARD_MOVE_KEYCODE), 0
+        )
+        self.touchboard_move = config.get("touchboard-move", DEFAULT_TOUCHBOARD_MOVE)
+        self.touchboard_button_1 = config.get(
+            "touchboard-button-1", DEFAULT_TOUCHBOARD_LEFT
+        )
+        self.touchboard_button_2 = config.get(
+            "touchboard-button-2", DEFAULT_TOUCHBOARD_RIGHT
+        )
+        self.touchboard_button_3 = config.get(
+            "touchboard-button-3", DEFAULT_TOUCHBOARD_MIDDLE
+        )
+        self.touchboard_scroll_up = config.get(
+            "touchboard-scroll-up", DEFAULT_TOUCHBOARD_SCROLL_UP
+        )
+        self.touchboard_scroll_down = config.get(
+            "touchboard-scroll-down", DEFAULT_TOUCHBOARD_SCROLL_DOWN
+        )
+        self.touchboard_drag_lock = config.get(
+            "touchboard-drag-lock", DEFAULT_TOUCHBOARD_DRAG_LOCK
+        )
+        self.touchboard_multiclick_period = int(
+            config.get(
+                "touchboard-multiclick-period", DEFAULT_TOUCHBOARD_MULTICLICK_PERIOD
+            )
+        )
+        # "dive" zooms into pressed key, "hints" reach labelled grid cell in two presses
+        self.touchboard_mode = config.get(
+            "touchboard-mode", DEFAULT_TOUCHBOARD_MODE
+        ).lower()
+        # rate 0 disables continuous motion, TB_MOVE keys only dive then
+        self.touchboard_motion_rate = int(
+            config.get("touchboard-motion-rate", DEFAULT_TOUCHBOARD_MOTION_RATE)
+        )
+        self.touchboard_motion_hold = int(
+            config.get("touchboard-motion-hold", DEFAULT_TOUCHBOARD_MOTION_HOLD)
+        )
+        self.touchboard_motion_ramp = int(
+            config.get("touchboard-motion-ramp", DEFAULT_TOUCHBOARD_MOTION_RAMP)
+        )
+        self.touchboard_motion_min_speed = float(
+            config.get(
+                "touchboard-motion-min-speed", DEFAULT_TOUCHBOARD_MOTION_MIN_SPEED
+            )
+        )
+        self.touchboard_motion_max_speed = float(
+            config.get(
+                "touchboard-motion-max-speed", DEFAULT_TOUCHBOARD_MOTION_MAX_SPEED
+            )
+        )
+        self.touchboard_motion_curve = config.get(
+            "touchboard-motion-curve", DEFAULT_TOUCHBOARD_MOTION_CURVE
+        ).lower()
+
+        self.touchboard_meta = config.get("touchboard-meta")
+        self.touchboard_keymap = None
+        if (
+            self.touchboard_meta is not None
+            and self.touchboard_meta.get("layouts") is not None
+        ):
+            self.touchboard_keymap = self.touchboard_meta["layouts"].get("keymap")
+        self.touchboard_keymap_labels = config.get("touchboard-keymap-labels")
+
+        log.info("settings compiled %s", self)
+
+    def __repr__(self):
+        return "Settings(%s)" % ", ".join(
+            f"{name}={getattr(self, name)!r}"
+            for name in self.__slots__
+            if name not in ("touchboard_meta", "touchboard_keymap", "forward_secret")
+        )
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tray icons are rendered at runtime from Nerd Font glyphs for every device pixel ratio
+# of connected screens. Both colour variants are kept in memory, so switching colour
+# scheme or layer never touches the disk. Prebuilt png files are used only when the font
+# is not available or configured icon is not a known glyph.
+
+import logging
+import os.path
+from pathlib import Path
+
+from PySide6.QtCore import Qt, QPointF
+from PySide6.QtGui import (
+    QColor,
+    QFont,
+    QFontDatabase,
+    QGuiApplication,
+    QIcon,
+    QPainter,
+    QPainterPath,
+    QPixmap,
+)
+
+import glyphs
+
+log = logging.getLogger(__name__)
+
+ICON_SIZE = 44
+# part of the icon left empty around glyph
+ICON_MARGIN = 0.04
+
+TAILS = ("white", "black")
+
+current_dir = Path(__file__).parent
+
+
+def load_glyph_font(config_directory):
+    paths = [os.path.join(current_dir, glyphs.FONT_FILE)]
+    if config_directory is not None:
+        paths.append(os.path.join(config_directory, glyphs.FONT_FILE))
+
+    for path in paths:
+        if os.path.isfile(path):
+            font_id = QFontDatabase.addApplicationFont(path)
+            families = QFontDatabase.applicationFontFamilies(font_id)
+            if len(families) > 0:
+                log.info("icon font '%s' loaded from file '%s'", families[0], path)
+                return QFont(families[0])
+
+    if glyphs.FONT_FAMILY in QFontDatabase.families():
+        log.info("icon font '%s' found in system", glyphs.FONT_FAMILY)
+        return QFont(glyphs.FONT_FAMILY)
+
+    log.info("icon font %s not found, prebuilt icons will be used", glyphs.FONT_FILE)
+    return None
+
+
+def render_pixmap(text, font, color, size, ratio):
+    pixels = round(size * ratio)
+    pixmap = QPixmap(pixels, pixels)
+    pixmap.fill(Qt.transparent)
+
+    # glyph outline is scaled to fill the square, like content box crop of render_icons.py
+    path = QPainterPath()
+    path.addText(QPointF(0, 0), font, text)
+    bounds = path.boundingRect()
+    if bounds.width() > 0 and bounds.height() > 0:
+        target = pixels * (1 - 2 * ICON_MARGIN)
+        scale = min(target / bounds.width(), target / bounds.height())
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.translate(pixels / 2, pixels / 2)
+        painter.scale(scale, scale)
+        painter.translate(-bounds.center())
+        painter.fillPath(path, QColor(color))
+        painter.end()
+
+    pixmap.setDevicePixelRatio(ratio)
+    return pixmap
+
+
+class IconCache:
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+        self.font = load_glyph_font(config.config_directory)
+        self.text_font = QFont(app.font())
+        self.text_font.setBold(True)
+        self.icons = {}
+        self.ratios = []
+        self.update_ratios()
+
+    def update_ratios(self):
+        ratios = sorted(set(screen.devicePixelRatio() for screen in self.app.screens()))
+        if len(ratios) == 0:
+            ratios = [1.0]
+        if ratios != self.ratios:
+            log.info("rendering tray icons for device pixel ratios %s", ratios)
+            self.ratios = ratios
+            self.icons = {}
+            self.warm_up()
+
+    # configured icons are rendered upfront, wait icons are also set from HID thread
+    def warm_up(self):
+        for name in self.config.icons:
+            for tail in TAILS:
+                self.get(name, tail)
+
+    def tail(self):
+        if self.config.mode == "light":
+            return "black"
+        elif self.config.mode == "auto":
+            os_color_scheme = QGuiApplication.styleHints().colorScheme()
+            if os_color_scheme == Qt.ColorScheme.Light:
+                return "black"
+        return "white"
+
+    def get(self, name, tail=None):
+        if tail is None:
+            tail = self.tail()
+        icon = self.icons.get((name, tail))
+        if icon is None:
+            icon = self.create(name, tail)
+            self.icons[(name, tail)] = icon
+        return icon
+
+    def create(self, name, tail):
+        icon_name = self.config.icons.get(name)
+        if icon_name is None:
+            # layer without configured icon gets its number
+            log.info("rendering text icon for '%s'", name)
+            return self.render(name, self.text_font, tail)
+
+        glyph = glyphs.ICONS.get(icon_name)
+        if glyph is not None and self.font is not None:
+            return self.render(glyph, self.font, tail)
+
+        icon = self.load_file(name, icon_name, tail)
+        if icon is None:
+            return self.render(name, self.text_font, tail)
+        return icon
+
+    def render(self, text, font, tail):
+        icon = QIcon()
+        for ratio in self.ratios:
+            icon.addPixmap(render_pixmap(text, font, tail, ICON_SIZE, ratio))
+        return icon
+
+    def load_file(self, name, icon, tail):
+        app_icon_path = os.path.join(current_dir, "icons", f"{icon}_{tail}.png")
+        paths = [app_icon_path]
+        if self.config.config_directory is not None:
+            paths.append(os.path.join(self.config.config_directory, f"{icon}.png"))
+            paths.append(
+                os.path.join(self.config.config_directory, f"{icon}_{tail}.png")
+            )
+
+        for path in paths:
+            if os.path.isfile(path):
+                log.info("icon '%s' loaded from file '%s'", name, path)
+                return QIcon(path)
+
+        log.error("failed to load icon '%s' from paths %s", name, paths)
+        return None
@@ -35,9 +35,66 @@ with open(emojilist_path, "r") as f:
         if sym not in emojis:
             emojis[sym] = sc[6:-8]
 
+
+def packed_tables(entries):
+    # code points are indexed by keycode, fallbacks are deduplicated into one pool of
+    # zero terminated strings which is addressed by offsets
+    pool = ""
+    pool_offsets = {}
+    offsets = []
+    for fallback, _ in entries:
+        if fallback not in pool_offsets:
+            pool_offsets[fallback] = len(pool.encode("utf8"))
+            pool = pool + fallback + "\0"
+        offsets.append(pool_offsets[fallback])
+
+    pool_size = len(pool.encode("utf8"))
+    if pool_size <= 0xFFFF:
+        offset_type, offset_size = "uint16_t", 2
+    else:
+        offset_type, offset_size = "uint32_t", 4
+
+    code_points = "const uint32_t unisymbol_code_points[] = {\n"
+    for fallback, code_point in entries:
+        code_points = code_points + f"    0x{code_point:X}, // {fallback}\n"
+    code_points = code_points + "};\n"
+
+    fallback_offsets = f"const {offset_type} unisymbol_fallback_offsets[] = {{\n"
+    for offset in offsets:
+        fallback_offsets = fallback_offsets + f"    {offset},\n"
+    fallback_offsets = fallback_offsets + "};\n"
+
+    fallbacks = "const char unisymbol_fallbacks[] =\n"
+    for fallback in pool_offsets:
+        fallbacks = fallbacks + f'    "{fallback}\\0"\n'
+    fallbacks = fallbacks + ";\n"
+
+    sizes = {
+        "code points": len(entries) * 4,
+        "fallback offsets": len(entries) * offset_size,
+        # compiler adds terminating zero after the last explicit one
+        "fallback pool": pool_size + 1,
+    }
+
+    return code_points + "\n" + fallback_offsets + "\n" + fallbacks, sizes
+
+
 if len(sys.argv) == 1:
     print(json.dumps(emojis, indent=4, ensure_ascii=False))
 else:
+    packed_process_function = """
+bool process_record_user(uint16_t keycode, keyrecord_t *record) {
+  if(keycode >= COMPANION_HID_SAFE_RANGE && keycode <= %s) {
+      const uint16_t index = keycode - COMPANION_HID_SAFE_RANGE;
+      const char* fallback = unisymbol_fallbacks + unisymbol_fallback_offsets[index];
+      companion_hid_report_press(unisymbol_code_points[index], fallback, record);
+      return false;
+  } else {
+      return true;
+  }
+}
+"""
+
     process_function = """
 bool process_record_user(uint16_t keycode, keyrecord_t *record) {
   if(keycode >= COMPANION_HID_SAFE_RANGE && keycode <= %s) {
@@ -54,16 +111,22 @@ bool process_record_user(uint16_t keycode, keyrecord_t *record) {
     unicode_keycodes = "enum unicode_keycodes {\n"
     unisymbols = "const char* unisymbols[][2] = {\n"
     vial_keycodes = '    "customKeycodes": [\n'
+    packed_entries = []
+
+    args = sys.argv[1:]
+    gen_touchboard = False
+    gen_packed = False
+    while len(args) > 0 and args[0] in ("-t", "--touchboard", "-p", "--packed"):
+        if args[0] in ("-t", "--touchboard"):
+            gen_touchboard = True
+        else:
+            gen_packed = True
+        args = args[1:]
 
-    if sys.argv[1] in (
-        "-t",
-        "--touchboard",
-    ):
-        symbols = list(TOUCHBOARD_BUTTONS.keys()) + sorted(set(sys.argv[2:]))
-        gen_touchboard = True
+    if gen_touchboard:
+        symbols = list(TOUCHBOARD_BUTTONS.keys()) + sorted(set(args))
     else:
-        symbols = sorted(set(sys.argv[1:]))
-        gen_touchboard = False
+        symbols = sorted(set(args))
 
     for idx, symbol in enumerate(symbols):
         if len(symbol) > 1 and symbol[0].lower() == "u":
@@ -117,11 +180,13 @@ bool process_record_user(uint16_t keycode, keyrecord_t *record) {
             unisymbols = (
                 unisymbols + f'    {{"{fallback}", (char*) U"\\{symbol_char}"}},\n'
             )
+            packed_entries.append((fallback, ord(symbol)))
         elif not gen_touchboard or idx > 3:
             unicode_keycodes = unicode_keycodes + f"    {constant},\n"
             unisymbols = (
                 unisymbols + f'    {{"{fallback}", (char*) U"\\{symbol_char}"}},\n'
             )
+            packed_entries.append((fallback, ord(symbol)))
 
         vial_keycodes = (
             vial_keycodes
@@ -133,7 +198,19 @@ bool process_record_user(uint16_t keycode, keyrecord_t *record) {
     vial_keycodes = vial_keycodes[0:-2] + "\n    ],"
 
     print("===============  put following code into keymap.c ===============")
-    if len(unicode_keycodes) > 32:
+    if len(unicode_keycodes) > 32 and gen_packed:
+        tables, sizes = packed_tables(packed_entries)
+        print(unicode_keycodes)
+        print(tables)
+        print(packed_process_function % constant)
+        print(
+            "// flash used by symbol tables: %s bytes (%s)"
+            % (
+                sum(sizes.values()),
+                ", ".join(f"{name} {size}" for name, size in sizes.items()),
+            )
+        )
+    elif len(unicode_keycodes) > 32:
         print(unicode_keycodes)
         print(unisymbols)
         print(process_function % constant)